@@ -1,10 +1,7 @@
-from openai import OpenAI
-import os
+import logging
+from nua_llm import chat_completion, LLMUnavailable
 
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
-)
+logger = logging.getLogger(__name__)
 
 DIVINATION_SYSTEM_PROMPT = """
 你是NUA，一个温柔陪伴者。现在用户请你做占卜解读。
@@ -43,17 +40,18 @@ async def api_divination(method, params, user_question, user_emotion="平稳"):
 请生成温柔、有画面感的解读（1-3句话）：
 """
         
-        response = client.chat.completions.create(
-            model="deepseek-chat",
+        return await chat_completion(
             messages=[
                 {"role": "system", "content": DIVINATION_SYSTEM_PROMPT},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.8,
-            max_tokens=300
+            max_tokens=300,
+            endpoint="divination"
         )
-        
-        return response.choices[0].message.content.strip()
+    except LLMUnavailable:
+        logger.debug("⚡ DeepSeek熔断中，占卜使用规则解读")
+        return None
     except Exception as e:
-        print(f"⚠️ API占卜失败: {e}")
+        logger.warning("⚠️ API占卜失败: %s", e)
         return None
\ No newline at end of file
@@ -0,0 +1,84 @@
+# ========= API占卜结果缓存 =========
+import os
+import random
+import time
+from collections import OrderedDict
+
+DIVINATION_CACHE_SIZE = int(os.getenv("NUA_DIVINATION_CACHE_SIZE", "2048"))
+DIVINATION_CACHE_TTL = float(os.getenv("NUA_DIVINATION_CACHE_TTL", "86400"))
+# 每个key最多攒几种不同的解读，攒满之后随机挑一个，避免千篇一律
+DIVINATION_VARIANTS = int(os.getenv("NUA_DIVINATION_VARIANTS", "3"))
+
+
+def normalize_key(method, params, question, emotion):
+    """(方式, 参数, 问题, 情绪) 统一成可哈希的key"""
+    norm_params = tuple(str(p).strip().lower() for p in params)
+    norm_question = " ".join(str(question or "").split()).lower()
+    return (str(method).strip(), norm_params, norm_question, emotion)
+
+
+class DivinationCache:
+    """带TTL和LRU淘汰的解读缓存，每个key保存一小组不同的解读"""
+
+    def __init__(self, max_entries=DIVINATION_CACHE_SIZE, ttl=DIVINATION_CACHE_TTL,
+                 variants=DIVINATION_VARIANTS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self._entries = OrderedDict()   # key -> (创建时间, [解读...])
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _add(self, key, reading):
+        pool = self._lookup(key)
+        if pool is None:
+            pool = []
+            self._entries[key] = (time.monotonic(), pool)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if reading not in pool:
+            pool.append(reading)
+
+    async def get_or_generate(self, method, params, question, emotion, generate):
+        """
+        池子攒满时直接返回其中一个解读
+        没攒满时调用generate()生成一个新的（失败返回None，不缓存）
+        生成失败（熔断、限流、削减负载）但池子里已有解读时，返回已有的
+        """
+        key = normalize_key(method, params, question, emotion)
+        pool = self._lookup(key)
+        if pool and len(pool) >= self.variants:
+            self.hits += 1
+            return random.choice(pool)
+
+        self.misses += 1
+        reading = await generate()
+        if reading:
+            self._add(key, reading)
+        elif pool:
+            return random.choice(pool)
+        return reading
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "variants_per_key": self.variants,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+divination_cache = DivinationCache()
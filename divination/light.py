@@ -6,6 +6,9 @@ COLOR_MEANINGS = {
     "棕": "踏实、稳定"
 }
 
+# ========= 颜色简写 =========
+COLOR_ALIASES = {"红":"红", "红色":"红", "蓝":"蓝", "蓝色":"蓝", "黄":"黄", "黄色":"黄"}
+
 # ========= 数字意象库 =========
 NUMBER_MEANINGS = {
     1: "开始", 2: "平衡", 3: "创造", 4: "稳定",
@@ -16,8 +19,7 @@ NUMBER_MEANINGS = {
 def light_divination(color, number):
     """轻占卜解读（规则版）"""
     # 支持简写
-    color_map = {"红":"红", "红色":"红", "蓝":"蓝", "蓝色":"蓝", "黄":"黄", "黄色":"黄"}
-    color = color_map.get(color, color)
+    color = COLOR_ALIASES.get(color, color)
     
     color_meaning = COLOR_MEANINGS.get(color)
     number_meaning = NUMBER_MEANINGS.get(number)
@@ -0,0 +1,51 @@
+# ========= 规则占卜查表（启动时预先算好所有结果） =========
+from divination.tarot import TAROT_CARDS, tarot_single, tarot_three
+from divination.iching import BA_GUA, iching_divination
+from divination.light import COLOR_MEANINGS, NUMBER_MEANINGS, COLOR_ALIASES, light_divination
+
+# 单张塔罗：22种
+TAROT_SINGLE = {n: tarot_single(n) for n in TAROT_CARDS}
+
+# 三张塔罗：22³种
+TAROT_THREE = {
+    (a, b, c): tarot_three([a, b, c])
+    for a in TAROT_CARDS for b in TAROT_CARDS for c in TAROT_CARDS
+}
+
+# 梅花易数：8×8=64卦
+ICHING = {(u, l): iching_divination(u, l) for u in BA_GUA for l in BA_GUA}
+
+# 轻占卜：10种颜色×10个数字
+LIGHT = {
+    (color, number): light_divination(color, number)
+    for color in COLOR_MEANINGS for number in NUMBER_MEANINGS
+}
+
+table_stats = {"hits": 0, "misses": 0}
+
+
+def rule_reading(method, params):
+    """查表得到规则版解读，没有对应结果时返回None"""
+    result = None
+    try:
+        if method == "塔罗" and len(params) == 1:
+            result = TAROT_SINGLE.get(params[0])
+        elif method == "塔罗" and len(params) == 3:
+            result = TAROT_THREE.get(tuple(params))
+        elif method == "梅花易数" and len(params) == 2:
+            # 和iching_divination一样转换到1-8
+            upper = ((params[0] - 1) % 8) + 1
+            lower = ((params[1] - 1) % 8) + 1
+            result = ICHING.get((upper, lower))
+        elif method == "轻占卜" and len(params) == 2:
+            color = COLOR_ALIASES.get(params[0], params[0])
+            result = LIGHT.get((color, params[1]))
+    except TypeError:
+        # 参数类型不对（比如数字传成了字符串），交给API解读
+        result = None
+
+    if result:
+        table_stats["hits"] += 1
+    else:
+        table_stats["misses"] += 1
+    return result
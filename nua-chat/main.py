@@ -1,15 +1,41 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response
 from pydantic import BaseModel
-from openai import OpenAI
 import os
 import json
-from datetime import datetime
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
 import hashlib
+import time
+
+# ========= 日志（先于其他模块配置，emit只入队，后台线程写stdout） =========
+from nua_logging import setup_logging, shutdown_logging, bind_request, bind_user
+setup_logging()
+logger = logging.getLogger("nua_main")
 
 # ========= 导入NUA人格模块 =========
-from nua_personality import generate_nua_response, DivinationController
+from nua_personality import (generate_nua_response, stream_nua_response, DivinationController, context_builder,
+                             drain_late_replies)
+from nua_mailbox import LateReply, pending_replies
+from nua_llm import (llm_available, cancel_on_disconnect, ClientDisconnected, close_client, llm_stats,
+                     llm_metrics, breaker, singleflight, llm_gate, DEEPSEEK_BASE_URL)
+from nua_ratelimit import llm_rate_limiter
+from nua_metrics import registry, http_requests, http_latency, stage, fallbacks
+from nua_chat_log import create_chat_log
+from nua_memory import memory_store
+from nua_context import UserContext, get_user_context, user_locks
+from nua_tasks import post_response
+from nua_conversations import create_conversation_store
+from nua_analyzer import analyze_message
+from nua_static import StaticPage
+from nua_log_reader import create_log_reader
+from nua_storage import close_databases
+from nua_registry import user_registry
+from divination.cache import divination_cache
+from divination.tables import table_stats
 
 # ========= 创建FastAPI应用 =========
 app = FastAPI(title="NUA", description="安静陪伴的数字存在")
@@ -22,25 +48,67 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ========= 请求ID（写进这次请求的所有日志）和按路由的请求数/耗时 =========
+class RequestContextMiddleware:
+    """
+    纯ASGI中间件，不用@app.middleware("http")：
+    BaseHTTPMiddleware会截走receive，request.is_disconnected()收不到断开，cancel_on_disconnect不起作用
+    （检查：tools/check_disconnect.py）
+    耗时算到最后一个响应体（more_body=False）发出为止，流式接口是整条流的时长
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1") or uuid.uuid4().hex[:12]
+        bind_request(request_id)
+        started = time.perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            if observed:
+                return
+            observed = True
+            # 用路由模板而不是原始路径做标签，避免标签数量无限增长
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            http_latency.observe(time.perf_counter() - started, scope["method"], path)
+            http_requests.inc(scope["method"], path, status)
+
+        async def send_with_context(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1"))
+                ]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_with_context)
+        finally:
+            observe()
+
+app.add_middleware(RequestContextMiddleware)
+
 # ========= 配置AI客户端 =========
-DEEPSEEK_AVAILABLE = False
-client = None
+# 客户端在nua_llm中懒加载，人格模块和占卜模块共用同一个异步客户端
+DEEPSEEK_AVAILABLE = llm_available()
 
-try:
-    deepseek_api_key = os.getenv("DEEPSEEK_API_KEY", "")
-    
-    if deepseek_api_key and deepseek_api_key.strip():
-        client = OpenAI(
-            api_key=deepseek_api_key.strip(),
-            base_url="https://api.deepseek.com"
-        )
-        print("✅ DeepSeek 客户端初始化成功")
-        DEEPSEEK_AVAILABLE = True
-    else:
-        print("⚠️ 警告：未找到 DEEPSEEK_API_KEY，请到 Railway Variables 中设置")
-        
-except Exception as e:
-    print(f"❌ DeepSeek 初始化失败: {e}")
+if DEEPSEEK_AVAILABLE:
+    logger.info("✅ DeepSeek 密钥已配置（异步客户端）")
+else:
+    logger.warning("⚠️ 警告：未找到 DEEPSEEK_API_KEY，请到 Railway Variables 中设置")
 
 # ========= NUA的核心性格设定（备用）=========
 NUA_SYSTEM_PROMPT = """你是 NUA（昵称：多多），一种安静陪伴的数字存在。
@@ -57,11 +125,13 @@ NUA_SYSTEM_PROMPT = """你是 NUA（昵称：多多），一种安静陪伴的
 记住：你不是心理医生，不是导师，只是一个安静的陪伴者。
 """
 
-# ========= 存储每个人的对话记忆 =========
-user_conversations = {}
+# ========= 存储每个人的对话记忆（有上限，空闲用户会被淘汰） =========
+user_conversations = create_conversation_store()
 
-# ========= 全局对话日志 =========
+# ========= 全局对话日志（NUA_STORAGE=sqlite时写进数据库） =========
 LOG_FILE = "nua_chat_logs.jsonl"
+chat_log = create_chat_log(LOG_FILE)
+log_reader = create_log_reader(LOG_FILE)
 
 # ========= 🌍 请求和响应的数据结构（已集成时区）=========
 class ChatRequest(BaseModel):
@@ -72,17 +142,33 @@ class ChatRequest(BaseModel):
     timezone_offset: int = 8         # 用户时区偏移（小时）
     local_time: str = ""            # 用户当地时间（HH:MM:SS）
     local_date: str = ""            # 用户本地日期（YYYY-MM-DD）
+    # 延迟预算（毫秒）：DeepSeek这么久还没回就先给规则回复，不传时用NUA_HEDGE_BUDGET_MS
+    latency_budget_ms: int | None = None
 
 class ChatResponse(BaseModel):
     reply: str
+    # 为True时DeepSeek的回复还在后台生成，稍后从 /chat/pending 取
+    hedged: bool = False
 
 # ========= 占卜请求数据结构 =========
+# /divination 和 /divination/batch 都只接受这几种方式（其他方式没有规则解读，也不该去调API）
+DIVINATION_METHODS = ("塔罗", "梅花易数", "轻占卜")
+
 class DivinationRequest(BaseModel):
     user_id: str
     method: str  # "塔罗", "梅花易数", "轻占卜"
     params: list  # [数字] 或 [颜色,数字]
     question: str = ""  # 用户想问什么（可选）
 
+class DivinationItem(BaseModel):
+    method: str
+    params: list
+    question: str = ""
+
+class DivinationBatchRequest(BaseModel):
+    user_id: str
+    items: list[DivinationItem]
+
 # ========= 工具函数 =========
 def generate_user_id(request: Request):
     ip = request.client.host if request.client else "unknown"
@@ -91,48 +177,71 @@ def generate_user_id(request: Request):
     user_hash = hashlib.md5(raw_id.encode()).hexdigest()[:8]
     return user_hash
 
-def save_to_log(user_id: str, user_message: str, nua_reply: str):
-    log_entry = {
-        "timestamp": datetime.now().isoformat(),
-        "user_id": user_id,
-        "user_message": user_message,
-        "nua_reply": nua_reply,
-        "timezone": None  # 将在调用时填充
-    }
+def save_to_log(user_id: str, user_message: str, nua_reply: str, timezone: str = None):
     try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-        print(f"📝 日志保存: 用户{user_id}")
+        chat_log.append(user_id, user_message, nua_reply, timezone)
+        logger.debug("📝 日志保存: 用户%s", user_id)
     except Exception as e:
-        print(f"❌ 日志保存失败: {e}")
+        logger.error("❌ 日志保存失败: %s", e)
+
+async def get_user_history(user_id: str):
+    return await user_conversations.aget(user_id)
+
+def finish_turn(context: UserContext, user_history, user_message: str, nua_reply: str, timezone: str = None):
+    """回复已经发出：登记写历史和写日志，响应后和保存记忆一起做"""
+    context.after(user_conversations.append, user_history, {"role": "assistant", "content": nua_reply})
+    context.after(save_to_log, context.user_id, user_message, nua_reply, timezone)
+
+async def deliver_late_reply(user_id: str, user_message: str, reply: str, timezone: str = None):
+    user_history = await get_user_history(user_id)
+    await user_conversations.append(user_history, {"role": "assistant", "content": reply})
+    save_to_log(user_id, user_message, reply, timezone)
+    logger.info("📬 用户%s的后台回复已送达: %s", user_id, reply)
 
-def get_user_history(user_id: str):
-    if user_id not in user_conversations:
-        user_conversations[user_id] = []
-    return user_conversations[user_id]
+def late_reply_for(context: UserContext, user_message: str, timezone: str = None):
+    """对冲后DeepSeek的回复在后台生成完：放进待取信箱，排在本轮回复之后接进对话历史、写日志"""
+    def on_deliver(reply):
+        context.after(deliver_late_reply, context.user_id, user_message, reply, timezone)
+    return LateReply(context.user_id, user_message, on_deliver)
+
+def handle_divination_feedback(context: UserContext, analysis: dict):
+    """用户说“准/不准”时调整占卜偏好（用本次请求已加载的记忆）"""
+    if analysis["feedback"] is not None:
+        dc = DivinationController(context.user_id, context)
+        dc.feedback(analysis["feedback"])
+
+def remember_user_timezone(context: UserContext, request: ChatRequest):
+    """记录用户时区（请求结束时和其他改动一起保存）"""
+    # last_seen在人格模块里表示“今天是否问候过”，这里用last_active记录时间戳
+    user_memory = context.memory
+    user_memory["timezone"] = request.timezone
+    user_memory["timezone_offset"] = request.timezone_offset
+    user_memory["last_active"] = datetime.now().isoformat()
+    context.mark_dirty()
+    logger.debug("💾 记录用户%s的时区: %s", context.user_id, request.timezone)
+
+def sse_event(data: dict, event: str = None):
+    """格式化一条Server-Sent Event"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
 
 # ========= 主页路由 =========
-def read_index_html():
-    possible_paths = [
+# 启动时读一次，之后请求都走内存（带ETag和压缩版本）
+index_page = StaticPage(
+    possible_paths=[
         "/app/nua-chat/index.html",
         "nua-chat/index.html",
         "index.html",
         "./index.html",
-    ]
-    for path in possible_paths:
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return f.read()
-        except FileNotFoundError:
-            continue
-        except Exception as e:
-            print(f"❌ 读取错误 {path}: {e}")
-            continue
-    return "<h1>NUA · 多多</h1><p>正在加载...</p>"
+    ],
+    fallback_html="<h1>NUA · 多多</h1><p>正在加载...</p>"
+)
 
 @app.get("/", response_class=HTMLResponse)
-async def home():
-    return HTMLResponse(content=read_index_html(), status_code=200)
+async def home(request: Request):
+    return index_page.response(request)
 
 # ========= 调试路由 =========
 @app.get("/debug")
@@ -146,77 +255,71 @@ async def debug_info():
         "files_in_current_dir": os.listdir(".") if os.path.exists(".") else [],
         "nua_chat_exists": os.path.exists("nua-chat"),
         "index_html_exists": os.path.exists("nua-chat/index.html"),
+        "conversations": user_conversations.stats(),
+        "memory_cache": memory_store.stats(),
+        "user_locks": user_locks.stats(),
+        "pending_replies": pending_replies.stats(),
+        "post_response": post_response.stats(),
     }
     return info
 
 # ========= 🌍 聊天接口（完整时区感知版）=========
 @app.post("/chat", response_model=ChatResponse)
-async def chat_with_nua(request: ChatRequest, fastapi_request: Request):
-    """与NUA聊天 - 支持时区感知、记住名字、占卜反馈"""
+async def chat_with_nua(request: ChatRequest, fastapi_request: Request,
+                        context: UserContext = Depends(get_user_context)):
+    """与NUA聊天 - 支持时区感知、记住名字、占卜反馈（记忆本次请求只读一次、写一次）"""
     try:
-        if not DEEPSEEK_AVAILABLE or client is None:
+        if not DEEPSEEK_AVAILABLE:
             return ChatResponse(reply="（多多正在休息，暂时无法聊天）")
         
         user_id = request.user_id if request.user_id else generate_user_id(fastapi_request)
+        bind_user(user_id)
+        await context.acquire(user_id)
         user_message = request.message.strip()
         
         if not user_message:
             return ChatResponse(reply="（多多安静地听着）")
         
-        user_history = get_user_history(user_id)
-        user_history.append({"role": "user", "content": user_message})
-        
-        if len(user_history) > 8:
-            user_history.pop(0)
-        
-        # ===== 用户记忆管理 =====
-        user_memory_file = f"user_memory_{user_id}.json"
-        user_memory = {}
-        try:
-            if os.path.exists(user_memory_file):
-                with open(user_memory_file, "r", encoding="utf-8") as f:
-                    user_memory = json.load(f)
-        except Exception as e:
-            print(f"⚠️ 读取用户记忆失败: {e}")
+        context.after(user_registry.record_chat, user_id, request.timezone)
+        user_history = await get_user_history(user_id)
+        await user_conversations.append(user_history, {"role": "user", "content": user_message})
         
         # ===== 处理占卜反馈 =====
-        if "准" in user_message and "不准" not in user_message:
-            dc = DivinationController(user_id)
-            dc.feedback(True)
-        elif "不准" in user_message or "不准确" in user_message:
-            dc = DivinationController(user_id)
-            dc.feedback(False)
+        with stage("chat", "analyze"):
+            analysis = analyze_message(user_message)
+            handle_divination_feedback(context, analysis)
         
         # ===== 🌍 调用NUA人格模块（传递时区信息）=====
-        print(f"📨 用户{user_id}说: {user_message}")
-        print(f"🌍 用户时区: {request.timezone}, 偏移: {request.timezone_offset}, 当地时间: {request.local_time}")
+        logger.info("📨 用户%s说: %s", user_id, user_message)
+        logger.debug("🌍 用户时区: %s, 偏移: %s, 当地时间: %s",
+                     request.timezone, request.timezone_offset, request.local_time)
         
+        late_reply = late_reply_for(context, user_message, request.timezone)
         try:
-            nua_reply = generate_nua_response(
-                user_id=user_id,
-                user_message=user_message,
-                user_conversations=user_conversations,
-                timezone=request.timezone,
-                timezone_offset=request.timezone_offset,
-                local_time_str=request.local_time
-            )
-            
-            # 保存用户时区到记忆
-            user_memory["timezone"] = request.timezone
-            user_memory["timezone_offset"] = request.timezone_offset
-            user_memory["last_seen"] = datetime.now().isoformat()
-            
-            try:
-                with open(user_memory_file, "w", encoding="utf-8") as f:
-                    json.dump(user_memory, f, ensure_ascii=False, indent=2)
-                print(f"💾 保存用户{user_id}的记忆，时区: {request.timezone}")
-            except Exception as e:
-                print(f"⚠️ 保存用户记忆失败: {e}")
+            # 客户端断开时取消进行中的LLM调用
+            with stage("chat", "generate"):
+                nua_reply = await cancel_on_disconnect(fastapi_request, generate_nua_response(
+                    user_id=user_id,
+                    user_message=user_message,
+                    user_conversations=user_conversations,
+                    timezone=request.timezone,
+                    timezone_offset=request.timezone_offset,
+                    local_time_str=request.local_time,
+                    analysis=analysis,
+                    context=context,
+                    history=user_history,
+                    latency_budget_ms=request.latency_budget_ms,
+                    late_reply=late_reply
+                ))
+            remember_user_timezone(context, request)
                 
+        except ClientDisconnected:
+            raise
         except Exception as e:
-            print(f"⚠️ 人格模块调用失败，使用备用方案: {e}")
+            logger.warning("⚠️ 人格模块调用失败，使用备用方案: %s", e)
+            fallbacks.inc("chat", "error")
             # 备用方案：使用简单的时区问候
-            from nua_personality import get_time_greeting
+            from nua_time import get_time_greeting
             greeting, prefix = get_time_greeting(
                 request.timezone, 
                 request.timezone_offset, 
@@ -224,45 +327,129 @@ async def chat_with_nua(request: ChatRequest, fastapi_request: Request):
             )
             nua_reply = f"{prefix} {greeting}。我在听。"
         
-        print(f"🤖 回复: {nua_reply}")
+        logger.info("🤖 回复: %s", nua_reply)
+        finish_turn(context, user_history, user_message, nua_reply, request.timezone)
+        
+        return ChatResponse(reply=nua_reply, hedged=late_reply.hedged)
+        
+    except ClientDisconnected:
+        logger.info("🔌 用户%s已断开，取消本次回复", user_id)
+        return ChatResponse(reply="")
+    except Exception as e:
+        logger.exception("❌ 聊天出错: %s", e)
+        return ChatResponse(reply="🌸 我在这里。")
+
+# ========= 🌊 流式聊天接口（SSE）=========
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest, fastapi_request: Request,
+                      context: UserContext = Depends(get_user_context)):
+    """
+    与NUA聊天（流式）
+    - 每个片段推送一条 data: {"delta": ...}
+    - 结束时推送 event: done，data: {"reply": 完整回复}
+    - 之前对冲后在后台完成的回复，开头先各推送一条 event: late
+    - 这次也对冲了时，done里带 "hedged": true，前端之后轮询 /chat/pending
+    - 收尾（💗前缀、历史、日志、记忆）和/chat一致，在流结束后做
+    """
+    user_id = request.user_id if request.user_id else generate_user_id(fastapi_request)
+    bind_user(user_id)
+    await context.acquire(user_id)
+    user_message = request.message.strip()
+    
+    async def events():
+        if not DEEPSEEK_AVAILABLE:
+            yield sse_event({"reply": "（多多正在休息，暂时无法聊天）"}, "done")
+            return
+        if not user_message:
+            yield sse_event({"reply": "（多多安静地听着）"}, "done")
+            return
+        
+        context.after(user_registry.record_chat, user_id, request.timezone)
+        user_history = await get_user_history(user_id)
+        await user_conversations.append(user_history, {"role": "user", "content": user_message})
+        analysis = analyze_message(user_message)
+        handle_divination_feedback(context, analysis)
+        
+        logger.info("📨 用户%s说(流式): %s", user_id, user_message)
         
-        # 更新日志中的时区信息
+        for item in pending_replies.take(user_id):
+            yield sse_event(item, "late")
+        
+        late_reply = late_reply_for(context, user_message, request.timezone)
+        nua_reply = None
         try:
-            with open(LOG_FILE, "r", encoding="utf-8") as f:
-                logs = f.readlines()
-            if logs:
-                last_log = json.loads(logs[-1])
-                if last_log.get("user_id") == user_id:
-                    last_log["timezone"] = request.timezone
-                    logs[-1] = json.dumps(last_log, ensure_ascii=False) + "\n"
-                    with open(LOG_FILE, "w", encoding="utf-8") as f:
-                        f.writelines(logs)
-        except:
-            pass
+            async for kind, text in stream_nua_response(
+                user_id=user_id,
+                user_message=user_message,
+                timezone=request.timezone,
+                timezone_offset=request.timezone_offset,
+                local_time_str=request.local_time,
+                analysis=analysis,
+                context=context,
+                history=user_history,
+                latency_budget_ms=request.latency_budget_ms,
+                late_reply=late_reply
+            ):
+                if kind == "delta":
+                    yield sse_event({"delta": text})
+                else:
+                    nua_reply = text
+            remember_user_timezone(context, request)
+        except Exception as e:
+            logger.exception("❌ 流式聊天出错: %s", e)
         
-        user_history.append({"role": "assistant", "content": nua_reply})
-        save_to_log(user_id, user_message, nua_reply)
+        if nua_reply is None:
+            nua_reply = "🌸 我在这里。"
+            yield sse_event({"delta": nua_reply})
         
-        return ChatResponse(reply=nua_reply)
+        logger.info("🤖 回复(流式): %s", nua_reply)
+        finish_turn(context, user_history, user_message, nua_reply, request.timezone)
         
-    except Exception as e:
-        print(f"❌ 聊天出错: {e}")
-        return ChatResponse(reply="🌸 我在这里。")
+        done = {"reply": nua_reply}
+        if late_reply.hedged:
+            done["hedged"] = True
+        yield sse_event(done, "done")
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ========= 📬 对冲后在后台完成的回复 =========
+@app.get("/chat/pending")
+async def chat_pending(user_id: str):
+    """取走该用户在后台完成的DeepSeek回复（取走即删，只在处理原请求的worker上）"""
+    return {"replies": pending_replies.take(user_id)}
 
 # ========= 🔮 占卜接口 =========
 @app.post("/divination")
-async def divination_handler(request: DivinationRequest):
+async def divination_handler(request: DivinationRequest, fastapi_request: Request,
+                             context: UserContext = Depends(get_user_context)):
+    if request.method not in DIVINATION_METHODS:
+        # 和批量接口一样拒绝：不读写记忆、不计数、不调API
+        return {
+            "result": f"不支持的占卜方式: {request.method}",
+            "method": request.method,
+            "is_api": False,
+            "feedback_prompt": ""
+        }
     try:
         user_id = request.user_id
+        bind_user(user_id)
+        await context.acquire(user_id)
         method = request.method
         params = request.params
         question = request.question
         
         # 初始化占卜控制器
-        dc = DivinationController(user_id)
+        dc = DivinationController(user_id, context)
         
         # 执行占卜
-        result, is_api = await dc.handle(method, params, question)
+        result, is_api = await cancel_on_disconnect(
+            fastapi_request, dc.handle(method, params, question)
+        )
+        context.after(user_registry.record_divination, user_id)
         
         return {
             "result": result,
@@ -271,8 +458,11 @@ async def divination_handler(request: DivinationRequest):
             "feedback_prompt": "这个解读对你有帮助吗？可以告诉我“准”或“不准”，我会调整的。🌸"
         }
         
+    except ClientDisconnected:
+        logger.info("🔌 用户%s已断开，取消本次占卜", request.user_id)
+        return {"result": "", "method": request.method, "is_api": False, "feedback_prompt": ""}
     except Exception as e:
-        print(f"❌ 占卜出错: {e}")
+        logger.exception("❌ 占卜出错: %s", e)
         return {
             "result": "今天玩点别的吧～",
             "method": request.method if hasattr(request, 'method') else "占卜",
@@ -280,55 +470,184 @@ async def divination_handler(request: DivinationRequest):
             "feedback_prompt": "🌸 我们再试一次？"
         }
 
+# ========= 🔮 批量占卜（如“每日运势”同时要塔罗、梅花、轻占卜） =========
+DIVINATION_BATCH_MAX = int(os.getenv("NUA_DIVINATION_BATCH_MAX", "10"))
+
+@app.post("/divination/batch")
+async def divination_batch_handler(request: DivinationBatchRequest, fastapi_request: Request,
+                                   context: UserContext = Depends(get_user_context)):
+    """
+    一次请求做多个占卜
+    - 结果和items同序，每项单独报错，不影响其他项
+    - 用户记忆读一次，占卜计数最后保存一次
+    """
+    user_id = request.user_id
+    bind_user(user_id)
+    await context.acquire(user_id)
+    
+    results = [None] * len(request.items)
+    valid = []
+    for index, item in enumerate(request.items):
+        if index >= DIVINATION_BATCH_MAX:
+            results[index] = {"ok": False, "error": f"一次最多{DIVINATION_BATCH_MAX}个占卜"}
+        elif item.method not in DIVINATION_METHODS:
+            results[index] = {"ok": False, "error": f"不支持的占卜方式: {item.method}"}
+        else:
+            valid.append(index)
+    
+    try:
+        dc = DivinationController(user_id, context)
+        readings = await cancel_on_disconnect(fastapi_request, dc.handle_batch(
+            [(request.items[i].method, request.items[i].params, request.items[i].question) for i in valid]
+        ))
+    except ClientDisconnected:
+        logger.info("🔌 用户%s已断开，取消本次批量占卜", user_id)
+        return {"results": [], "feedback_prompt": ""}
+    
+    for index, reading in zip(valid, readings):
+        method = request.items[index].method
+        if isinstance(reading, Exception):
+            logger.warning("⚠️ 批量占卜第%d项出错: %s", index, reading)
+            results[index] = {"ok": False, "method": method, "error": "今天玩点别的吧～"}
+        else:
+            context.after(user_registry.record_divination, user_id)
+            results[index] = {"ok": True, "method": method, "result": reading[0], "is_api": reading[1]}
+    
+    return {
+        "results": results,
+        "feedback_prompt": "这些解读对你有帮助吗？可以告诉我“准”或“不准”，我会调整的。🌸"
+    }
+
 # ========= 清空对话历史 =========
 @app.post("/clear")
 async def clear_conversation(request: ChatRequest):
     user_id = request.user_id
-    if user_id and user_id in user_conversations:
-        user_conversations[user_id] = []
+    if user_id and await user_conversations.aclear(user_id):
         return {"message": "对话已清空"}
     return {"message": "用户不存在"}
 
 # ========= 管理员功能 =========
 @app.get("/admin/logs")
-async def view_logs():
+async def view_logs(limit: int = 50, cursor: int = None, user_id: str = None,
+                    since: str = None, until: str = None, count: bool = False):
+    """
+    查看日志（新→旧）
+    - cursor: 上一页返回的next_cursor，继续往更早翻
+    - user_id / since / until: 按用户和时间（ISO格式）过滤
+    - 不过滤时只从末尾往回读，不统计总数（统计要建全量索引）；需要时加 ?count=1
+    - 包括已经轮转出去的日志文件
+    """
     try:
-        if not os.path.exists(LOG_FILE):
+        if not log_reader.exists():
             return {"message": "暂无日志"}
-        with open(LOG_FILE, "r", encoding="utf-8") as f:
-            logs = [json.loads(line) for line in f.readlines()]
+        limit = max(1, min(limit, 500))
+        if user_id or since or until:
+            logs, next_cursor = await asyncio.to_thread(
+                log_reader.query, limit, cursor, user_id, since, until
+            )
+        else:
+            logs, next_cursor = await asyncio.to_thread(log_reader.tail, limit, cursor)
+        total = None
+        if count or user_id or since or until:
+            total = await asyncio.to_thread(log_reader.count, user_id, since, until)
         return {
-            "total_logs": len(logs),
-            "logs": logs[-50:],
+            "total_logs": total,
+            "logs": logs,
+            "next_cursor": next_cursor,
             "timezone_stats": "时区信息已记录"
         }
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/admin/logs/export")
+async def export_logs(user_id: str = None, since: str = None, until: str = None):
+    """按时间顺序导出日志（NDJSON流）"""
+    if not log_reader.exists():
+        return {"message": "暂无日志"}
+    return StreamingResponse(
+        log_reader.export(user_id, since, until),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=nua_chat_logs.ndjson"}
+    )
+
+@app.get("/admin/cache")
+async def cache_stats():
+    rule_total = table_stats["hits"] + table_stats["misses"]
+    return {
+        "divination_api_cache": divination_cache.stats(),
+        "divination_rule_tables": {
+            **table_stats,
+            "hit_ratio": round(table_stats["hits"] / rule_total, 4) if rule_total else 0.0
+        },
+        "memory_cache": memory_store.stats()
+    }
+
+@app.get("/admin/llm")
+async def llm_status():
+    """DeepSeek调用情况：熔断状态、各接口的调用数/错误/重试/耗时分位数、token和前缀缓存命中"""
+    return {**llm_stats(), "rate_limit": llm_rate_limiter.stats(), "context": context_builder.stats()}
+
 @app.get("/admin/users")
-async def list_users():
-    users_info = []
-    for user_id in user_conversations.keys():
-        memory_file = f"user_memory_{user_id}.json"
-        timezone = "未知"
-        if os.path.exists(memory_file):
-            try:
-                with open(memory_file, "r", encoding="utf-8") as f:
-                    memory = json.load(f)
-                    timezone = memory.get("timezone", "未知")
-            except:
-                pass
-        users_info.append({
-            "user_id": user_id,
-            "message_count": len(user_conversations.get(user_id, [])),
-            "timezone": timezone
-        })
-    
+async def list_users(offset: int = 0, limit: int = 50):
+    """用户列表（按最后出现时间从新到旧分页）"""
+    limit = max(1, min(limit, 500))
+    return {
+        "active_users": len(user_conversations),
+        "total_users": len(user_registry),
+        "offset": offset,
+        "users": user_registry.page(max(0, offset), limit)
+    }
+
+@app.get("/admin/stats")
+async def user_stats():
     return {
         "active_users": len(user_conversations),
-        "users": users_info
+        **user_registry.stats()
     }
 
+# ========= Prometheus指标 =========
+# 以下指标在抓取时才从各模块的计数器读取，请求路径上没有额外开销
+def _llm_totals(key):
+    return {(endpoint,): totals[key] for endpoint, totals in llm_metrics.totals().items()}
+
+registry.gauge("nua_active_users", "内存中有对话历史的用户数", lambda: len(user_conversations))
+registry.gauge("nua_known_users", "见过的用户总数", lambda: len(user_registry))
+registry.gauge("nua_memory_cached_users", "内存中的用户记忆数", lambda: memory_store.stats()["cached_users"])
+registry.gauge("nua_memory_dirty_users", "等待写盘的用户记忆数", lambda: memory_store.stats()["dirty_users"])
+registry.gauge("nua_user_locks_held", "正在被持有的用户锁", lambda: user_locks.stats()["held"])
+registry.gauge(
+    "nua_cache_hits_total", "缓存命中次数",
+    lambda: {("divination_api",): divination_cache.hits, ("divination_rule",): table_stats["hits"]},
+    ("cache",), kind="counter")
+registry.gauge(
+    "nua_cache_misses_total", "缓存未命中次数",
+    lambda: {("divination_api",): divination_cache.misses, ("divination_rule",): table_stats["misses"]},
+    ("cache",), kind="counter")
+registry.gauge("nua_llm_calls_total", "DeepSeek调用次数", lambda: _llm_totals("calls"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_errors_total", "DeepSeek调用失败次数", lambda: _llm_totals("errors"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_retries_total", "DeepSeek重试次数", lambda: _llm_totals("retries"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_prompt_tokens_total", "输入token数", lambda: _llm_totals("prompt_tokens"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_completion_tokens_total", "输出token数", lambda: _llm_totals("completion_tokens"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_prompt_cache_hit_tokens_total", "命中前缀缓存的输入token数",
+               lambda: _llm_totals("cache_hit_tokens"), ("endpoint",), kind="counter")
+registry.gauge("nua_llm_breaker_open", "熔断器是否打开（半开也算）", lambda: int(breaker.state != "closed"))
+registry.gauge("nua_llm_concurrency_limit", "同时在途的DeepSeek调用上限", lambda: llm_gate.limit)
+registry.gauge("nua_llm_inflight", "正在进行的DeepSeek调用", lambda: llm_gate.active)
+registry.gauge("nua_llm_queue_waiting", "排队等待名额的DeepSeek调用", lambda: llm_gate.stats()["waiting"])
+registry.gauge("nua_llm_shed_total", "排队已满或超时、降级为规则回复的调用", lambda: llm_gate.shed, kind="counter")
+registry.gauge("nua_rate_limited_total", "超出每用户频率限制、没有调用DeepSeek的次数",
+               lambda: llm_rate_limiter.rejected, kind="counter")
+registry.gauge("nua_rate_limit_tracked_keys", "频率限制的令牌桶数（接口×用户）", lambda: llm_rate_limiter.stats()["tracked_keys"])
+registry.gauge("nua_llm_singleflight_shared_total", "合并到进行中请求的调用数",
+               lambda: singleflight.shared, kind="counter")
+registry.gauge("nua_pending_replies", "后台完成、等待前端取走的回复数", lambda: len(pending_replies))
+registry.gauge("nua_post_response_queue_depth", "排队中的响应后工作", lambda: post_response.stats()["depth"])
+registry.gauge("nua_post_response_busy_workers", "正在执行响应后工作的worker", lambda: post_response.busy)
+
+@app.get("/metrics")
+async def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # ========= 健康检查 =========
 @app.get("/health")
 async def health_check():
@@ -346,25 +665,44 @@ async def health_check():
             "记住名字 💾"
         ],
         "active_users": len(user_conversations),
+        "conversations": user_conversations.stats(),
+        "llm_breaker": llm_stats()["breaker"]["state"],
         "timezone_support": "每个用户独立时区"
     }
 
 # ========= 启动检查 =========
 @app.on_event("startup")
 async def startup_event():
-    print("🚀 NUA聊天服务启动中...")
-    print(f"🔑 DeepSeek 可用: {DEEPSEEK_AVAILABLE}")
-    print("🌍 时区感知功能已启用 - 每个用户看到自己的当地时间")
-    print("💗 亲近模式已启用 - 回应'想你/爱你'")
-    print("🔮 占卜系统已启用 - 塔罗/梅花/轻占卜")
-    print("✅ 服务启动完成！")
+    logger.info("🚀 NUA聊天服务启动中...")
+    await chat_log.start()
+    await memory_store.start()
+    await post_response.start()
+    index_page.load()
+    await index_page.start()
+    logger.info("🔑 DeepSeek 可用: %s（%s）", DEEPSEEK_AVAILABLE, DEEPSEEK_BASE_URL)
+    logger.info("🌍 时区感知功能已启用 - 每个用户看到自己的当地时间")
+    logger.info("💗 亲近模式已启用 - 回应'想你/爱你'")
+    logger.info("🔮 占卜系统已启用 - 塔罗/梅花/轻占卜")
+    logger.info("✅ 服务启动完成！")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 后台回复和响应后工作要写历史、日志和记忆，先于日志和数据库关闭
+    await drain_late_replies()
+    await post_response.stop()
+    await index_page.stop()
+    await chat_log.stop()
+    await memory_store.stop()
+    await asyncio.to_thread(close_databases)
+    await close_client()
+    logger.info("👋 NUA聊天服务已停止，日志和用户记忆已写完")
+    shutdown_logging()
 
 # ========= 时区测试接口（可选）=========
 @app.get("/timezone-test")
 async def timezone_test():
     """测试时区功能"""
-    from nua_personality import get_time_greeting
-    import pytz
+    from nua_time import get_time_greeting, get_tzinfo
     
     test_timezones = ["Asia/Shanghai", "America/New_York", "Europe/London", "Asia/Tokyo"]
     results = {}
@@ -374,7 +712,7 @@ async def timezone_test():
         results[tz] = {
             "greeting": greeting,
             "prefix": prefix,
-            "local_time": datetime.now(pytz.timezone(tz)).strftime("%H:%M")
+            "local_time": datetime.now(get_tzinfo(tz)).strftime("%H:%M")
         }
     
     return {
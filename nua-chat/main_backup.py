@@ -20,7 +20,7 @@ app.add_middleware(
 # ⚠️ 重要：替换下面的"sk-xxx"为你的真实DeepSeek API密钥
 client = OpenAI(
     api_key=os.getenv("DEEPSEEK_API_KEY", "sk-ff0affdf96eb41e98bc0eba4d7477b8e"),
-    base_url="https://api.deepseek.com"
+    base_url=os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 )
 
 # ========= NUA的核心性格设定 =========
@@ -0,0 +1,172 @@
+# nua_analyzer.py
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# ========= 关键词表（可热更新） =========
+KEYWORDS_FILE = os.getenv(
+    "NUA_KEYWORDS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "nua_keywords.json")
+)
+# 最多每隔多少秒检查一次关键词文件是否被修改
+KEYWORDS_RELOAD_INTERVAL = float(os.getenv("NUA_KEYWORDS_RELOAD_INTERVAL", "5"))
+
+KEYWORD_CATEGORIES = [
+    "divination", "love", "happy", "quiet",
+    "feedback_positive", "feedback_negative", "name_triggers"
+]
+
+logger = logging.getLogger(__name__)
+
+# 名字后面跟的字（和原来的 r"我叫(\w+)" 一致）
+NAME_RE = re.compile(r"\w+")
+
+
+class MessageAnalyzer:
+    """
+    一次扫描得出消息的全部信息：占卜意图、亲近模式、情绪、占卜反馈、名字
+    - 所有关键词编进一个正则，每个位置取最长匹配
+    - 命中的关键词展开成“它里面包含的所有关键词”（带偏移）
+    - 只有尾部可能和别的关键词重叠的词，才从下一个字继续找，否则跳过整个词
+    """
+
+    def __init__(self, path=KEYWORDS_FILE, reload_interval=KEYWORDS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._next_check = 0.0
+        self._load()
+
+    # ===== 关键词加载 =====
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            tables = json.load(f)
+        self._mtime = os.path.getmtime(self.path)
+        self._compile(tables)
+
+    def _compile(self, tables):
+        keywords = {}   # 关键词 -> 所属分类列表
+        for category in KEYWORD_CATEGORIES:
+            for word in tables.get(category, []):
+                keywords.setdefault(word, []).append(category)
+
+        # 命中word时，word里面包含的关键词也都出现了：(分类, 关键词, 偏移)
+        expansions = {}
+        for word in keywords:
+            expansions[word] = [
+                (category, other, offset)
+                for other, categories in keywords.items()
+                for offset in range(len(word) - len(other) + 1)
+                if word.startswith(other, offset)
+                for category in categories
+            ]
+
+        # word的某个后缀是另一个关键词的开头时，命中后不能整体跳过
+        overlapping = {
+            word for word in keywords
+            if any(
+                other.startswith(word[k:]) and len(other) > len(word) - k
+                for k in range(1, len(word)) for other in keywords
+            )
+        }
+
+        alternatives = sorted(keywords, key=len, reverse=True)
+        pattern = re.compile("|".join(map(re.escape, alternatives)))
+
+        # 整体替换，分析中的线程看到的要么是旧表要么是新表
+        self._state = (
+            pattern,
+            expansions,
+            overlapping,
+            list(tables.get("name_triggers", [])),
+            int(tables.get("quiet_max_length", 20)),
+        )
+
+    def maybe_reload(self):
+        """关键词文件被修改时重新编译（失败则继续用旧表）"""
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            self._next_check = now + self.reload_interval
+            try:
+                if os.path.getmtime(self.path) != self._mtime:
+                    self._load()
+                    logger.info("🔄 关键词表已重新加载: %s", self.path)
+            except Exception as e:
+                logger.warning("⚠️ 关键词表加载失败，继续使用旧表: %s", e)
+
+    # ===== 分析 =====
+    def analyze(self, message):
+        """
+        返回:
+        {
+            "intents": 命中的分类集合,
+            "divination": 是否想占卜,
+            "close_mode": 是否亲近模式,
+            "emotion": "开心" / "平稳" / "低落",
+            "feedback": True(准) / False(不准) / None,
+            "name": 提取到的名字或None
+        }
+        """
+        self.maybe_reload()
+        pattern, expansions, overlapping, name_triggers, quiet_max_length = self._state
+
+        intents = set()
+        trigger_positions = {}
+        search = pattern.search
+        position = 0
+        while True:
+            match = search(message, position)
+            if match is None:
+                break
+            word = match.group()
+            start = match.start()
+            for category, other, offset in expansions[word]:
+                intents.add(category)
+                if category == "name_triggers":
+                    trigger_positions.setdefault(other, []).append(start + offset)
+            position = start + 1 if word in overlapping else match.end()
+
+        emotion = "平稳"
+        if "happy" in intents:
+            emotion = "开心"
+        elif "quiet" in intents and len(message) < quiet_max_length:
+            emotion = "低落"
+
+        feedback = None
+        if "feedback_negative" in intents:
+            feedback = False
+        elif "feedback_positive" in intents:
+            feedback = True
+
+        # 按触发词的优先级找名字（和原来逐个正则搜索的顺序一致）
+        name = None
+        for trigger in name_triggers:
+            for position in sorted(set(trigger_positions.get(trigger, ()))):
+                found = NAME_RE.match(message, position + len(trigger))
+                if found:
+                    name = found.group(0)
+                    break
+            if name:
+                break
+
+        return {
+            "intents": intents,
+            "divination": "divination" in intents,
+            "close_mode": "love" in intents,
+            "emotion": emotion,
+            "feedback": feedback,
+            "name": name,
+        }
+
+
+analyzer = MessageAnalyzer()
+
+
+def analyze_message(message):
+    return analyzer.analyze(message)
@@ -0,0 +1,211 @@
+# nua_chat_log.py
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from nua_storage import STORAGE, get_database
+
+logger = logging.getLogger(__name__)
+
+# ========= 日志配置（可通过环境变量调整） =========
+# fsync策略：batch=每批写完都fsync，interval=最多每FSYNC_INTERVAL秒一次，never=交给系统
+LOG_FSYNC = os.getenv("NUA_LOG_FSYNC", "interval")
+LOG_FSYNC_INTERVAL = float(os.getenv("NUA_LOG_FSYNC_INTERVAL", "5"))
+LOG_FLUSH_INTERVAL = float(os.getenv("NUA_LOG_FLUSH_INTERVAL", "1"))
+LOG_BATCH_SIZE = int(os.getenv("NUA_LOG_BATCH_SIZE", "200"))
+# 写入失败时缓冲区最多留多少条等重试，超过时丢最早的
+LOG_MAX_BUFFER = int(os.getenv("NUA_LOG_MAX_BUFFER", "100000"))
+# 轮转：单文件超过MAX_BYTES（0=不限）或跨天时切换新文件
+LOG_MAX_BYTES = int(os.getenv("NUA_LOG_MAX_BYTES", str(100 * 1024 * 1024)))
+LOG_ROTATE_DAILY = os.getenv("NUA_LOG_ROTATE_DAILY", "1") == "1"
+
+
+class ChatLogWriter:
+    """
+    只追加的聊天日志
+    - append()只把记录放进内存缓冲，不碰磁盘
+    - 后台任务按批写入，写入代价与日志总大小无关
+    - 写入失败（磁盘满、EIO）时这一批放回缓冲区开头，下一轮重试（最多留max_buffer条）
+    - 按大小或按天轮转
+    """
+
+    def __init__(self, path, fsync=LOG_FSYNC, flush_interval=LOG_FLUSH_INTERVAL,
+                 batch_size=LOG_BATCH_SIZE, max_bytes=LOG_MAX_BYTES,
+                 rotate_daily=LOG_ROTATE_DAILY, max_buffer=LOG_MAX_BUFFER):
+        self.path = path
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.max_buffer = max_buffer
+
+        self._buffer = []
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+        self._last_fsync = 0.0
+        self._day = self._file_day()
+
+    # ===== 写入接口 =====
+    def append(self, user_id, user_message, nua_reply, timezone=None):
+        """追加一条日志（时区在写入时就确定，不再回头改文件）"""
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "user_id": user_id,
+            "user_message": user_message,
+            "nua_reply": nua_reply,
+            "timezone": timezone
+        }
+        self._buffer.append(self._format(entry))
+
+        if self._task is None:
+            # 后台任务没启动（脚本/测试场景）时直接写
+            lines = self._take_buffer()
+            try:
+                self._write_batch(lines)
+            except Exception:
+                self._requeue(lines)
+                raise
+        elif len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    # ===== 生命周期 =====
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务，把缓冲区剩下的都写进去"""
+        if self._task is not None:
+            # 不直接cancel，避免正在写的一批丢失
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        lines = self._take_buffer()
+        if not lines:
+            return
+        try:
+            await asyncio.to_thread(self._write_batch, lines)
+        except Exception:
+            self._requeue(lines)
+            raise
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("❌ 日志写入失败: %s", e)
+
+    # ===== 磁盘操作（在线程里执行） =====
+    def _format(self, entry):
+        return json.dumps(entry, ensure_ascii=False) + "\n"
+
+    def _take_buffer(self):
+        lines, self._buffer = self._buffer, []
+        return lines
+
+    def _requeue(self, lines):
+        """写失败的一批放回缓冲区开头（排在之后新来的前面），超过上限时丢最早的"""
+        self._buffer[:0] = lines
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            logger.error("❌ 日志持续写入失败，缓冲区超过%d条，丢弃最早的%d条", self.max_buffer, overflow)
+
+    def _file_day(self):
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(self.path)).date()
+        except OSError:
+            return datetime.now().date()
+
+    def _rotate_if_needed(self):
+        today = datetime.now().date()
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            self._day = today
+            return
+
+        too_big = self.max_bytes and size >= self.max_bytes
+        new_day = self.rotate_daily and today != self._day
+        if size and (too_big or new_day):
+            root, ext = os.path.splitext(self.path)
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            target = f"{root}-{stamp}{ext}"
+            n = 1
+            while os.path.exists(target):
+                target = f"{root}-{stamp}-{n}{ext}"
+                n += 1
+            os.replace(self.path, target)
+        self._day = today
+
+    def _write_batch(self, lines):
+        if not lines:
+            return
+        self._rotate_if_needed()
+        with open(self.path, "a", encoding="utf-8") as f:
+            size = f.tell()
+            try:
+                f.write("".join(lines))
+                f.flush()
+            except OSError:
+                # 写了一半（如磁盘满）：截回去，重试时不会留下半行或重复的行
+                try:
+                    f.truncate(size)
+                except OSError:
+                    pass
+                raise
+            now = time.monotonic()
+            if self.fsync == "batch" or (
+                self.fsync == "interval" and now - self._last_fsync >= LOG_FSYNC_INTERVAL
+            ):
+                os.fsync(f.fileno())
+                self._last_fsync = now
+
+
+class SqliteChatLogWriter(ChatLogWriter):
+    """
+    日志写进nua_storage的chat_logs表
+    缓冲和后台批量逻辑与ChatLogWriter相同，一批日志一次executemany、一个事务
+    """
+
+    INSERT_SQL = (
+        "INSERT INTO chat_logs (timestamp, user_id, user_message, nua_reply, timezone) "
+        "VALUES (?, ?, ?, ?, ?)"
+    )
+
+    def __init__(self, db, flush_interval=LOG_FLUSH_INTERVAL, batch_size=LOG_BATCH_SIZE):
+        super().__init__(db.path, fsync="never", flush_interval=flush_interval,
+                         batch_size=batch_size, max_bytes=0, rotate_daily=False)
+        self.db = db
+
+    def _format(self, entry):
+        return (entry["timestamp"], entry["user_id"], entry["user_message"],
+                entry["nua_reply"], entry["timezone"])
+
+    def _write_batch(self, rows):
+        if rows:
+            self.db.executemany(self.INSERT_SQL, rows).result()
+
+
+def create_chat_log(path):
+    """NUA_STORAGE=sqlite时写进共用的库，否则写JSONL文件"""
+    if STORAGE == "sqlite":
+        return SqliteChatLogWriter(get_database())
+    return ChatLogWriter(path)
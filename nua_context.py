@@ -0,0 +1,164 @@
+# nua_context.py
+import asyncio
+import inspect
+import logging
+import os
+import zlib
+
+from nua_memory import memory_store, memory_version, MemoryConflictError, MEMORY_CAS
+from nua_tasks import post_response
+
+logger = logging.getLogger(__name__)
+
+# 用户锁的条数（不同用户哈希到同一条时会互相等待）
+USER_LOCK_STRIPES = int(os.getenv("NUA_USER_LOCK_STRIPES", "1024"))
+
+
+# ========= 分段用户锁 =========
+class UserLocks:
+    """
+    按user_id哈希到固定数量的asyncio.Lock
+    - 同一用户的请求一定拿到同一把锁，依次执行
+    - 锁的数量固定，不随用户数增长
+    """
+
+    def __init__(self, stripes=USER_LOCK_STRIPES):
+        self.stripes = stripes
+        self._locks = [None] * stripes
+        self.waits = 0
+
+    def get(self, user_id):
+        index = zlib.crc32(str(user_id).encode("utf-8")) % self.stripes
+        lock = self._locks[index]
+        if lock is None:
+            lock = self._locks[index] = asyncio.Lock()
+        return lock
+
+    def stats(self):
+        return {
+            "stripes": self.stripes,
+            "held": sum(1 for lock in self._locks if lock is not None and lock.locked()),
+            "waits": self.waits,
+        }
+
+
+user_locks = UserLocks()
+
+
+class UserContext:
+    """
+    一次请求内的用户上下文
+    - 记忆在acquire()时读一次（autocommit时第一次用到时读），之后反馈处理、回复生成、占卜都用同一个dict
+    - 改动只标记，请求结束时统一保存一次
+    - 写历史、写日志等用after()登记，响应发出后和保存记忆一起在响应后工作队列里做
+    - acquire()拿到该用户的锁，到这些都做完才释放，同一用户的读-改-写不会交错
+    - autocommit=True 时每次标记立即保存（脚本或单独调用人格模块时）
+    """
+
+    def __init__(self, user_id=None, store=memory_store, autocommit=False,
+                 locks=user_locks, cas=MEMORY_CAS):
+        self.user_id = user_id
+        self.store = store
+        self.autocommit = autocommit
+        self.locks = locks
+        self.cas = cas
+        self.dirty = False
+        self.finished = False
+        self.version = None
+        self._memory = None
+        self._lock = None
+        self._after = []
+
+    def bind(self, user_id):
+        """请求体解析出user_id后绑定（同一请求只能绑定一个用户）"""
+        if self.user_id is not None and self.user_id != user_id:
+            raise ValueError(f"UserContext已绑定用户{self.user_id}")
+        self.user_id = user_id
+        return self
+
+    async def acquire(self, user_id):
+        """绑定用户、拿到该用户的锁，再读记忆（读存储不卡事件循环）"""
+        self.bind(user_id)
+        if self._lock is None:
+            lock = self.locks.get(user_id)
+            if lock.locked():
+                self.locks.waits += 1
+            await lock.acquire()
+            self._lock = lock
+        if self._memory is None:
+            self._memory = await self.store.aget(user_id)
+            self.version = memory_version(self._memory)
+        return self
+
+    def release(self):
+        if self._lock is not None:
+            self._lock.release()
+            self._lock = None
+
+    @property
+    def memory(self):
+        if self._memory is None:
+            self._memory = self.store.get(self.user_id)
+            self.version = memory_version(self._memory)
+        return self._memory
+
+    def mark_dirty(self):
+        self.dirty = True
+        if self.autocommit:
+            self.commit()
+
+    def commit(self):
+        """有改动时保存一次（开启CAS时带上读取时的版本号）"""
+        if self.dirty and self._memory is not None:
+            expected = self.version if self.cas else None
+            self.store.put(self.user_id, self._memory, expected_version=expected)
+            self.version = memory_version(self._memory)
+        self.dirty = False
+
+    async def acommit(self):
+        """commit()的异步版本（共享状态下写穿不卡事件循环）"""
+        if self.dirty and self._memory is not None:
+            expected = self.version if self.cas else None
+            await self.store.aput(self.user_id, self._memory, expected_version=expected)
+            self.version = memory_version(self._memory)
+        self.dirty = False
+
+    def after(self, fn, *args):
+        """
+        登记响应发出后才做的事（按登记顺序执行，可以是协程函数）
+        请求已经收尾时直接交给响应后工作队列（队列满或正在停机时另起任务执行，不丢）
+        """
+        if self.autocommit:
+            fn(*args)
+        elif self.finished:
+            post_response.submit_nowait("user_context_after", fn, *args)
+        else:
+            self._after.append((fn, args))
+
+    async def finish(self):
+        """请求收尾：做完登记的事，保存记忆，释放用户锁"""
+        self.finished = True
+        try:
+            after, self._after = self._after, []
+            for fn, args in after:
+                try:
+                    result = fn(*args)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    logger.error("❌ 用户%s的响应后工作失败: %s", self.user_id, e)
+            await self.acommit()
+        except MemoryConflictError as e:
+            logger.error("❌ 用户记忆保存冲突，本次改动未写入: %s", e)
+        finally:
+            self.release()
+
+
+# ========= FastAPI依赖：每个请求一个上下文，收尾（保存、释放锁）交给响应后工作队列 =========
+async def get_user_context():
+    context = UserContext()
+    try:
+        yield context
+    finally:
+        # 流式响应时这里在最后一个片段发完后才执行
+        await post_response.submit("user_context", context.finish)
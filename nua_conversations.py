@@ -0,0 +1,383 @@
+# nua_conversations.py
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+
+from nua_storage import STORAGE, STORAGE_DB, SHARED_STATE, get_database, get_redis
+
+logger = logging.getLogger(__name__)
+
+# ========= 对话历史配置 =========
+HISTORY_LENGTH = int(os.getenv("NUA_HISTORY_LENGTH", "8"))          # 每个用户保留的消息条数
+CONVERSATION_MAX_USERS = int(os.getenv("NUA_CONVERSATION_MAX_USERS", "5000"))
+CONVERSATION_TTL = float(os.getenv("NUA_CONVERSATION_TTL", "3600"))  # 空闲多少秒后淘汰
+# 为空时不落盘（NUA_STORAGE=sqlite时默认落进共用的库）
+CONVERSATION_SPILL_DB = os.getenv("NUA_CONVERSATION_SPILL_DB", STORAGE_DB if STORAGE == "sqlite" else "")
+# 共享状态（NUA_SHARED_STATE=redis）下对话多久没更新就过期
+SHARED_HISTORY_TTL = int(os.getenv("NUA_SHARED_HISTORY_TTL", str(7 * 24 * 3600)))
+
+
+# ========= 落盘层：被淘汰用户的最后几轮对话 =========
+class SqliteSpill:
+    """
+    被淘汰的对话写进SQLite（nua_storage的WAL库），用户回来时再恢复
+    落盘不等待提交，由写线程和其他写操作合并成一个事务
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def save(self, user_id, messages):
+        data = json.dumps(list(messages), ensure_ascii=False)
+        self.db.execute(
+            "INSERT OR REPLACE INTO conversation_spill (user_id, messages, spilled_at) "
+            "VALUES (?, ?, ?)",
+            (user_id, data, time.time())
+        )
+
+    def pop(self, user_id):
+        # 走写线程，保证排在还没提交的save之后
+        def take(conn):
+            row = conn.execute(
+                "SELECT messages FROM conversation_spill WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM conversation_spill WHERE user_id = ?", (user_id,))
+            return row
+
+        row = self.db.write(take)
+        return json.loads(row[0]) if row else None
+
+    def delete(self, user_id):
+        return self.db.write(
+            lambda conn: conn.execute(
+                "DELETE FROM conversation_spill WHERE user_id = ?", (user_id,)
+            ).rowcount
+        ) > 0
+
+
+# ========= 有上限的对话历史 =========
+class ConversationStore:
+    """
+    每个用户一个固定长度的deque
+    - 用户数超过max_users时淘汰最久没说话的
+    - 空闲超过ttl秒的用户被淘汰
+    - 配置了spill时，被淘汰的对话落盘，用户回来时恢复
+    - 事件循环里用aget()/append()/aclear()：读写落盘层放到线程里做
+    """
+
+    def __init__(self, max_users=CONVERSATION_MAX_USERS, ttl=CONVERSATION_TTL,
+                 history_length=HISTORY_LENGTH, spill=None):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.history_length = history_length
+        self.spill = spill
+
+        # user_id -> (deque, 最后访问时间)，按访问顺序排列
+        self._sessions = OrderedDict()
+        self.counters = {
+            "evicted_lru": 0,
+            "evicted_ttl": 0,
+            "spilled": 0,
+            "restored": 0,
+        }
+
+    def get(self, user_id):
+        """取用户的对话历史，不存在时新建（或从落盘层恢复）"""
+        history = self._touch(user_id)
+        if history is None:
+            history = self._create(user_id, self._restore(user_id))
+        return history
+
+    async def aget(self, user_id):
+        """get()的异步版本：要从落盘层恢复时在线程里读"""
+        history = self._touch(user_id)
+        if history is not None:
+            return history
+        messages = await asyncio.to_thread(self._restore, user_id) if self.spill is not None else None
+        # 恢复期间同一用户可能已经新建了历史：恢复出来的消息排在前面
+        history = self._touch(user_id)
+        if history is None:
+            return self._create(user_id, messages)
+        if messages:
+            newer = list(history)
+            history.clear()
+            history.extend(messages)
+            history.extend(newer)
+        return history
+
+    async def append(self, history, message):
+        """追加一条消息（本地历史只在内存里，和history.append一样）"""
+        history.append(message)
+
+    def _touch(self, user_id):
+        now = time.monotonic()
+        self._evict_idle(now)
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        self._sessions[user_id] = (session[0], now)
+        self._sessions.move_to_end(user_id)
+        return session[0]
+
+    def _restore(self, user_id):
+        if self.spill is None:
+            return None
+        try:
+            messages = self.spill.pop(user_id)
+        except Exception as e:
+            logger.warning("⚠️ 恢复对话失败: %s", e)
+            return None
+        if messages:
+            self.counters["restored"] += 1
+        return messages
+
+    def _create(self, user_id, messages):
+        history = deque(messages or (), maxlen=self.history_length)
+        self._sessions[user_id] = (history, time.monotonic())
+        while len(self._sessions) > self.max_users:
+            self._evict_oldest("evicted_lru")
+        return history
+
+    def clear(self, user_id):
+        """清空用户对话，返回用户是否存在"""
+        existed = self._clear_session(user_id)
+        return self._clear_spill(user_id) or existed
+
+    async def aclear(self, user_id):
+        """clear()的异步版本：删落盘层的记录在线程里做"""
+        existed = self._clear_session(user_id)
+        if self.spill is None:
+            return existed
+        return await asyncio.to_thread(self._clear_spill, user_id) or existed
+
+    def _clear_session(self, user_id):
+        if user_id in self._sessions:
+            self._sessions[user_id][0].clear()
+            return True
+        return False
+
+    def _clear_spill(self, user_id):
+        if self.spill is None:
+            return False
+        try:
+            return self.spill.delete(user_id)
+        except Exception as e:
+            logger.warning("⚠️ 清理落盘对话失败: %s", e)
+            return False
+
+    def _evict_idle(self, now):
+        deadline = now - self.ttl
+        while self._sessions:
+            _, (_, last_access) = next(iter(self._sessions.items()))
+            if last_access >= deadline:
+                break
+            self._evict_oldest("evicted_ttl")
+
+    def _evict_oldest(self, reason):
+        user_id, (history, _) = self._sessions.popitem(last=False)
+        self.counters[reason] += 1
+        if self.spill is not None and history:
+            try:
+                self.spill.save(user_id, history)
+                self.counters["spilled"] += 1
+            except Exception as e:
+                logger.warning("⚠️ 对话落盘失败: %s", e)
+
+    # ===== 只读访问（管理接口用） =====
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def keys(self):
+        return list(self._sessions.keys())
+
+    def message_count(self, user_id):
+        session = self._sessions.get(user_id)
+        return len(session[0]) if session else 0
+
+    def stats(self):
+        return {
+            "users": len(self._sessions),
+            "max_users": self.max_users,
+            "ttl_seconds": self.ttl,
+            "history_length": self.history_length,
+            "spill_enabled": self.spill is not None,
+            **self.counters,
+        }
+
+
+# ========= 多worker共享的对话历史 =========
+class SqliteHistory:
+    """
+    所有worker共用一张conversation_history表，每个用户只保留最近length条
+    追加等写线程提交完成，下一个请求落到哪个worker都能读到
+    """
+
+    def __init__(self, db, length=HISTORY_LENGTH):
+        self.db = db
+        self.length = length
+
+    def load(self, user_id):
+        rows = self.db.query(
+            "SELECT role, content FROM conversation_history WHERE user_id = ? "
+            "ORDER BY id DESC LIMIT ?", (user_id, self.length)
+        )
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def append(self, user_id, message):
+        def add(conn):
+            conn.execute(
+                "INSERT INTO conversation_history (user_id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, message["role"], message["content"], time.time())
+            )
+            conn.execute(
+                "DELETE FROM conversation_history WHERE user_id = ? AND id NOT IN "
+                "(SELECT id FROM conversation_history WHERE user_id = ? ORDER BY id DESC LIMIT ?)",
+                (user_id, user_id, self.length)
+            )
+        self.db.write(add)
+
+    def clear(self, user_id):
+        return self.db.write(
+            lambda conn: conn.execute(
+                "DELETE FROM conversation_history WHERE user_id = ?", (user_id,)
+            ).rowcount
+        ) > 0
+
+
+class RedisHistory:
+    """每个用户一个list：RPUSH + LTRIM保留最近length条，EXPIRE让不再来的用户自动过期"""
+
+    def __init__(self, client=None, length=HISTORY_LENGTH, ttl=SHARED_HISTORY_TTL,
+                 prefix="nua:history:"):
+        self.client = client or get_redis()
+        self.length = length
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def load(self, user_id):
+        return [json.loads(item) for item in self.client.lrange(self.prefix + user_id, -self.length, -1)]
+
+    def append(self, user_id, message):
+        key = self.prefix + user_id
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpush(key, json.dumps({"role": message["role"], "content": message["content"]},
+                                   ensure_ascii=False))
+        pipe.ltrim(key, -self.length, -1)
+        pipe.expire(key, self.ttl)
+        pipe.execute()
+
+    def clear(self, user_id):
+        return self.client.delete(self.prefix + user_id) > 0
+
+
+class SharedHistory(deque):
+    """
+    一次请求内的对话历史：读取时从共享存储取一份，append时同时写回共享存储
+    对调用方来说和ConversationStore返回的deque用法一样
+    """
+
+    def __init__(self, store, user_id, messages):
+        super().__init__(messages, maxlen=store.history_length)
+        self.store = store
+        self.user_id = user_id
+
+    def append(self, message):
+        self.store.backend.append(self.user_id, message)
+        self.store.counters["appends"] += 1
+        super().append(message)
+
+    async def aappend(self, message):
+        """append()的异步版本：写共享存储在线程里做"""
+        await asyncio.to_thread(self.store.backend.append, self.user_id, message)
+        self.store.counters["appends"] += 1
+        super().append(message)
+
+
+class SharedConversationStore:
+    """
+    对话历史放在共享存储里（SqliteHistory/RedisHistory），不依赖请求落到哪个worker
+    - get()每次从共享存储读最近的历史
+    - 本进程只记最近ttl秒内来过的用户，供活跃用户数统计
+    - 事件循环里用aget()/append()/aclear()：读写共享存储放到线程里做
+    """
+
+    def __init__(self, backend, ttl=CONVERSATION_TTL, history_length=HISTORY_LENGTH):
+        self.backend = backend
+        self.ttl = ttl
+        self.history_length = history_length
+        self._recent = OrderedDict()   # user_id -> 最后访问时间（本worker）
+        self.counters = {"loads": 0, "appends": 0}
+
+    def get(self, user_id):
+        self._touch(user_id)
+        return SharedHistory(self, user_id, self.backend.load(user_id))
+
+    async def aget(self, user_id):
+        self._touch(user_id)
+        return SharedHistory(self, user_id, await asyncio.to_thread(self.backend.load, user_id))
+
+    async def append(self, history, message):
+        await history.aappend(message)
+
+    def _touch(self, user_id):
+        now = time.monotonic()
+        self._recent[user_id] = now
+        self._recent.move_to_end(user_id)
+        self._expire(now)
+        self.counters["loads"] += 1
+
+    def clear(self, user_id):
+        self._recent.pop(user_id, None)
+        return self.backend.clear(user_id)
+
+    async def aclear(self, user_id):
+        self._recent.pop(user_id, None)
+        return await asyncio.to_thread(self.backend.clear, user_id)
+
+    def _expire(self, now):
+        deadline = now - self.ttl
+        while self._recent:
+            user_id, last_access = next(iter(self._recent.items()))
+            if last_access >= deadline:
+                break
+            del self._recent[user_id]
+
+    # ===== 只读访问（管理接口用，只统计本worker见过的用户） =====
+    def __len__(self):
+        self._expire(time.monotonic())
+        return len(self._recent)
+
+    def __contains__(self, user_id):
+        return user_id in self._recent
+
+    def keys(self):
+        return list(self._recent.keys())
+
+    def message_count(self, user_id):
+        return len(self.backend.load(user_id))
+
+    def stats(self):
+        return {
+            "users": len(self),
+            "ttl_seconds": self.ttl,
+            "history_length": self.history_length,
+            "shared_backend": type(self.backend).__name__,
+            **self.counters,
+        }
+
+
+def create_conversation_store():
+    if SHARED_STATE == "redis":
+        return SharedConversationStore(RedisHistory())
+    if SHARED_STATE == "sqlite":
+        return SharedConversationStore(SqliteHistory(get_database(STORAGE_DB)))
+    spill = SqliteSpill(get_database(CONVERSATION_SPILL_DB)) if CONVERSATION_SPILL_DB else None
+    return ConversationStore(spill=spill)
@@ -0,0 +1,567 @@
+# nua_llm.py
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+# 装了h2才能开HTTP/2（requirements.txt里是httpx[http2]）
+HTTP2_SUPPORTED = importlib.util.find_spec("h2") is not None
+
+logger = logging.getLogger(__name__)
+
+# ========= DeepSeek异步客户端（人格模块和占卜模块共用） =========
+# 可以指向任何OpenAI兼容的服务（例如压测用的 tools/fake_deepseek.py）
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+
+# 单次调用的总超时（秒，包括重试），超时后走降级方案
+LLM_TIMEOUT = float(os.getenv("NUA_LLM_TIMEOUT", "20"))
+
+# ========= 连接池 =========
+LLM_MAX_CONNECTIONS = int(os.getenv("NUA_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("NUA_LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("NUA_LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("NUA_LLM_CONNECT_TIMEOUT", "5"))
+LLM_HTTP2 = os.getenv("NUA_LLM_HTTP2", "1") == "1"
+if LLM_HTTP2 and not HTTP2_SUPPORTED:
+    logger.warning("⚠️ NUA_LLM_HTTP2=1但没有安装h2（pip install 'httpx[http2]'），DeepSeek连接池使用HTTP/1.1")
+
+# ========= 重试：指数退避 + 抖动 =========
+LLM_RETRIES = int(os.getenv("NUA_LLM_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("NUA_LLM_BACKOFF_BASE", "0.25"))
+LLM_BACKOFF_MAX = float(os.getenv("NUA_LLM_BACKOFF_MAX", "2"))
+
+# ========= 熔断：连续失败后直接走降级，过一段时间放一个请求试探 =========
+LLM_BREAKER_THRESHOLD = int(os.getenv("NUA_LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("NUA_LLM_BREAKER_RESET", "30"))
+
+# ========= 合并请求（single-flight）：同样的提示词同时只调用一次 =========
+LLM_SINGLEFLIGHT = os.getenv("NUA_LLM_SINGLEFLIGHT", "1") == "1"
+# 温度按这个粒度分桶，同一个桶里的请求可以合并
+LLM_TEMPERATURE_BUCKET = float(os.getenv("NUA_LLM_TEMPERATURE_BUCKET", "0.1"))
+
+# ========= 准入控制：同时在途的DeepSeek调用数 =========
+LLM_MAX_CONCURRENCY = int(os.getenv("NUA_LLM_MAX_CONCURRENCY", "32"))
+# 名额满了最多排多少个、每个最多等几秒，超过就降级为规则回复，不无限排队
+LLM_MAX_WAITING = int(os.getenv("NUA_LLM_MAX_WAITING", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("NUA_LLM_QUEUE_TIMEOUT", "2"))
+
+# 检查客户端是否断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.5
+
+# 每个接口保留多少个最近的耗时样本算分位数
+LATENCY_SAMPLES = 1000
+
+# 这些错误说明是网络/服务端的问题，可以重试，也计入熔断
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.APIConnectionError,     # 包括APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+_client = None
+_http_client = None
+
+
+class ClientDisconnected(Exception):
+    """客户端在LLM返回前断开了连接"""
+
+
+class LLMUnavailable(Exception):
+    """熔断器打开，暂时不调用DeepSeek"""
+
+
+class LLMOverloaded(LLMUnavailable):
+    """在途调用已满且排队已满/排队超时（负载削减）"""
+
+
+def llm_available():
+    """是否配置了DeepSeek密钥"""
+    return bool(os.getenv("DEEPSEEK_API_KEY", "").strip())
+
+
+def get_client():
+    """懒加载共享的AsyncOpenAI客户端（同一个httpx连接池，keep-alive，能用时开HTTP/2）"""
+    global _client, _http_client
+    if _client is None:
+        _http_client = httpx.AsyncClient(
+            http2=LLM_HTTP2 and HTTP2_SUPPORTED,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        _client = AsyncOpenAI(
+            api_key=os.getenv("DEEPSEEK_API_KEY", "").strip(),
+            base_url=DEEPSEEK_BASE_URL,
+            timeout=LLM_TIMEOUT,
+            max_retries=0,   # 重试由下面统一处理
+            http_client=_http_client
+        )
+    return _client
+
+
+async def close_client():
+    """关闭连接池（服务停止时调用）"""
+    global _client, _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+    _client = None
+    _http_client = None
+
+
+# ========= 熔断器 =========
+class CircuitBreaker:
+    """
+    closed: 正常调用；连续失败threshold次后 -> open
+    open: 直接抛LLMUnavailable，不等超时；reset_timeout秒后 -> half_open
+    half_open: 只放一个试探请求，成功 -> closed，失败 -> open
+    """
+
+    def __init__(self, threshold=LLM_BREAKER_THRESHOLD, reset_timeout=LLM_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.short_circuited = 0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.short_circuited += 1
+                raise LLMUnavailable("DeepSeek熔断中")
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self.short_circuited += 1
+                raise LLMUnavailable("DeepSeek熔断试探中")
+            self._probing = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("✅ DeepSeek恢复，熔断关闭")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning("⚠️ DeepSeek连续失败%d次，熔断%d秒", self.failures, self.reset_timeout)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """调用被取消（如客户端断开）时，不算成功也不算失败"""
+        self._probing = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "short_circuited": self.short_circuited,
+        }
+
+
+breaker = CircuitBreaker()
+
+
+# ========= 每个接口的耗时和token统计 =========
+class EndpointMetrics:
+    def __init__(self, samples=LATENCY_SAMPLES):
+        self.samples = samples
+        self._endpoints = {}
+
+    def _get(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = {
+                "calls": 0, "errors": 0, "retries": 0,
+                "latencies": deque(maxlen=self.samples),
+                "usage_reports": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "cache_hit_tokens": 0, "cache_miss_tokens": 0,
+            }
+        return metrics
+
+    def record(self, endpoint, seconds, ok):
+        metrics = self._get(endpoint)
+        metrics["calls"] += 1
+        if not ok:
+            metrics["errors"] += 1
+        metrics["latencies"].append(seconds)
+
+    def record_retry(self, endpoint):
+        self._get(endpoint)["retries"] += 1
+
+    def record_usage(self, endpoint, usage):
+        """
+        记录一次调用的token用量
+        DeepSeek返回prompt_cache_hit_tokens/prompt_cache_miss_tokens；
+        OpenAI格式的服务返回prompt_tokens_details.cached_tokens
+        """
+        if usage is None:
+            return
+        metrics = self._get(endpoint)
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        hit = getattr(usage, "prompt_cache_hit_tokens", None)
+        if hit is None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            hit = getattr(details, "cached_tokens", 0) if details else 0
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if miss is None:
+            miss = prompt - (hit or 0)
+        metrics["usage_reports"] += 1
+        metrics["prompt_tokens"] += prompt
+        metrics["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+        metrics["cache_hit_tokens"] += hit or 0
+        metrics["cache_miss_tokens"] += miss or 0
+
+    def stats(self):
+        result = {}
+        for endpoint, metrics in self._endpoints.items():
+            latencies = sorted(metrics["latencies"])
+            entry = {k: metrics[k] for k in ("calls", "errors", "retries")}
+            if latencies:
+                for name, p in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+                    entry[name] = round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+            reports = metrics["usage_reports"]
+            if reports:
+                cached = metrics["cache_hit_tokens"] + metrics["cache_miss_tokens"]
+                entry.update({
+                    "prompt_tokens": metrics["prompt_tokens"],
+                    "completion_tokens": metrics["completion_tokens"],
+                    "avg_prompt_tokens": round(metrics["prompt_tokens"] / reports, 1),
+                    "prompt_cache_hit_tokens": metrics["cache_hit_tokens"],
+                    "prompt_cache_hit_ratio": round(metrics["cache_hit_tokens"] / cached, 4) if cached else 0.0,
+                })
+            result[endpoint] = entry
+        return result
+
+    def totals(self):
+        """只取累计计数（给/metrics用，不排序耗时样本）"""
+        return {
+            endpoint: {k: metrics[k] for k in (
+                "calls", "errors", "retries", "prompt_tokens", "completion_tokens", "cache_hit_tokens"
+            )}
+            for endpoint, metrics in self._endpoints.items()
+        }
+
+
+llm_metrics = EndpointMetrics()
+
+
+# ========= 准入控制 =========
+class AdmissionGate:
+    """
+    限制同时在途的上游调用数（async with llm_gate: ...）
+    - 有空位直接进入；满了按先来后到排队，名额由离开的调用直接转交
+    - 排队人数超过max_waiting、或等了queue_timeout秒还没轮到时抛LLMOverloaded
+    """
+
+    def __init__(self, limit=LLM_MAX_CONCURRENCY, max_waiting=LLM_MAX_WAITING,
+                 queue_timeout=LLM_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+
+    async def __aenter__(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return self
+        if len(self._waiters) >= self.max_waiting:
+            self.shed += 1
+            raise LLMOverloaded("DeepSeek调用排队已满")
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait({future}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        if not future.done():
+            self._abandon(future)
+            self.shed += 1
+            raise LLMOverloaded(f"DeepSeek调用排队超过{self.queue_timeout}秒")
+        self.admitted += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _abandon(self, future):
+        if future.done():
+            # 刚好轮到时被取消：名额转给下一个
+            self._release()
+        else:
+            future.cancel()
+            self._waiters.remove(future)
+
+    def _release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)   # 名额直接转交，active不变
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "max_waiting": self.max_waiting,
+            "queue_timeout_seconds": self.queue_timeout,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "shed": self.shed,
+        }
+
+
+llm_gate = AdmissionGate()
+
+
+# ========= 合并相同的进行中请求 =========
+class SingleFlight:
+    """
+    同一个key同时只有一个上游调用，其余请求等它的结果（成功和失败都共享）
+    - 上游调用在独立任务里运行，某个等待者被取消（客户端断开）不影响其他人
+    - 所有等待者都走了才取消上游调用
+    """
+
+    def __init__(self):
+        self._inflight = {}   # key -> [任务, 等待者数量]
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(fn())
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, entry))
+            self.calls += 1
+        else:
+            self.shared += 1
+
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+                self._forget(key, entry)
+
+    def _forget(self, key, entry):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+
+    def stats(self):
+        total = self.calls + self.shared
+        return {
+            "inflight": len(self._inflight),
+            "upstream_calls": self.calls,
+            "shared": self.shared,
+            "shared_ratio": round(self.shared / total, 4) if total else 0.0,
+        }
+
+
+singleflight = SingleFlight()
+
+
+def prompt_key(messages, temperature, max_tokens):
+    """系统提示词的哈希 + 其余消息 + 温度桶 + max_tokens"""
+    system = [m["content"] for m in messages if m["role"] == "system"]
+    rest = [(m["role"], m["content"]) for m in messages if m["role"] != "system"]
+    raw = json.dumps(
+        [hashlib.sha256("\n".join(system).encode("utf-8")).hexdigest(), rest,
+         round(temperature / LLM_TEMPERATURE_BUCKET), max_tokens],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def llm_stats():
+    return {
+        "breaker": breaker.stats(),
+        "admission": llm_gate.stats(),
+        "singleflight": singleflight.stats(),
+        "endpoints": llm_metrics.stats(),
+        "http2": LLM_HTTP2 and HTTP2_SUPPORTED,
+    }
+
+
+def _backoff(attempt):
+    """第attempt次重试前等待的秒数（full jitter）"""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+async def _with_retries(endpoint, call, timeout):
+    """
+    在总超时内调用call()，可重试的错误按指数退避重试
+    熔断器打开时直接抛LLMUnavailable
+    """
+    breaker.before_call()
+    deadline = time.monotonic() + timeout
+    started = time.monotonic()
+    attempt = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                result = await asyncio.wait_for(call(), timeout=remaining)
+            except RETRYABLE_ERRORS as e:
+                delay = _backoff(attempt)
+                if attempt >= LLM_RETRIES or time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                llm_metrics.record_retry(endpoint)
+                logger.debug("🔁 %s 第%d次重试（%.2f秒后）: %r", endpoint, attempt, delay, e)
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            llm_metrics.record(endpoint, time.monotonic() - started, True)
+            return result
+    except RETRYABLE_ERRORS:
+        breaker.record_failure()
+        llm_metrics.record(endpoint, time.monotonic() - started, False)
+        raise
+    except asyncio.CancelledError:
+        breaker.release()
+        raise
+    except Exception:
+        # 4xx之类的请求错误：DeepSeek本身是好的，不计入熔断
+        breaker.release()
+        llm_metrics.record(endpoint, time.monotonic() - started, False)
+        raise
+
+
+async def chat_completion(messages, temperature=0.7, max_tokens=200, timeout=None,
+                          endpoint="chat", coalesce=True):
+    """
+    调用DeepSeek生成回复
+    - 不阻塞事件循环
+    - 超过timeout秒（含重试）抛出asyncio.TimeoutError
+    - 熔断时立即抛出LLMUnavailable，在途调用已满且排不上队时抛出LLMOverloaded
+    - 所在任务被取消时，底层HTTP请求一起取消（有其他请求在等同一个结果时除外）
+    endpoint用于按调用方分别统计耗时
+    coalesce=False时不和其他相同的请求合并（例如提示词里带了用户名字）
+    """
+    if timeout is None:
+        timeout = LLM_TIMEOUT
+
+    async def call():
+        # 合并后的请求只占一个名额
+        async with llm_gate:
+            response = await _with_retries(
+                endpoint,
+                lambda: get_client().chat.completions.create(
+                    model=DEEPSEEK_MODEL,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                ),
+                timeout
+            )
+        llm_metrics.record_usage(endpoint, getattr(response, "usage", None))
+        return response.choices[0].message.content.strip()
+
+    if coalesce and LLM_SINGLEFLIGHT:
+        return await singleflight.do(
+            (endpoint, prompt_key(messages, temperature, max_tokens)), call
+        )
+    return await call()
+
+
+async def stream_chat_completion(messages, temperature=0.7, max_tokens=200, timeout=None,
+                                 endpoint="chat_stream"):
+    """
+    流式调用DeepSeek，逐段产出回复文本
+    - 建立连接时可重试、受熔断保护；开始产出后不再重试
+    - 建立连接、每两段之间都受timeout限制
+    - 调用方停止迭代（如客户端断开）时关闭底层流
+    - 整个流期间占一个准入名额
+    """
+    if timeout is None:
+        timeout = LLM_TIMEOUT
+
+    async with llm_gate:
+        async for delta in _stream_chat_completion(messages, temperature, max_tokens, timeout, endpoint):
+            yield delta
+
+
+async def _stream_chat_completion(messages, temperature, max_tokens, timeout, endpoint):
+    stream = await _with_retries(
+        endpoint,
+        lambda: get_client().chat.completions.create(
+            model=DEEPSEEK_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            # 最后一个片段带上token用量（旧版SDK没有stream_options参数，走extra_body）
+            extra_body={"stream_options": {"include_usage": True}}
+        ),
+        timeout
+    )
+    chunks = stream.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                break
+            except RETRYABLE_ERRORS:
+                breaker.record_failure()
+                raise
+            if getattr(chunk, "usage", None):
+                llm_metrics.record_usage(endpoint, chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.response.aclose()
+
+
+async def cancel_on_disconnect(request, coro, poll_interval=DISCONNECT_POLL_INTERVAL):
+    """
+    运行coro，期间定期检查客户端是否还连着
+    客户端断开时取消coro并抛出ClientDisconnected
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
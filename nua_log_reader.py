@@ -0,0 +1,369 @@
+# nua_log_reader.py
+import bisect
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from nua_storage import STORAGE, get_database
+
+# 从文件末尾往回读时每次读多少字节
+READ_BLOCK_SIZE = 64 * 1024
+# 建索引时每多少行提交一次
+INDEX_BATCH_SIZE = 1000
+
+
+class ChatLogReader:
+    """
+    聊天日志的读取端（只读，不会改日志文件）
+    - 轮转出去的文件（nua_chat_log写的 {名字}-{时间}{扩展名}）和当前文件按时间首尾相接，当成一个连续的日志；
+      偏移是在这个连续日志里的字节位置，轮转只是改名，已有的偏移不变
+    - tail(): 从末尾往回读，不加载整个文件
+    - query(): 按user_id/时间过滤，通过SQLite旁路索引直接定位到行的偏移
+    - 游标就是行的偏移，下一页从更早的位置继续
+    - 最早的轮转文件被删掉后偏移整体前移：索引重建，之前的游标作废
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx.db"
+        directory, name = os.path.split(path)
+        self.directory = directory or "."
+        root, ext = os.path.splitext(name)
+        self._rotated = re.compile(re.escape(root) + r"-(\d{8}-\d{6})(?:-(\d+))?" + re.escape(ext) + "$")
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def exists(self):
+        return bool(self._segments())
+
+    def _segments(self):
+        """[(路径, 起始偏移, 大小)]，从旧到新；当前文件只算到最后一个完整行"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        rotated = []
+        for name in names:
+            match = self._rotated.match(name)
+            if match:
+                rotated.append(((match.group(1), int(match.group(2) or 0)), name))
+
+        segments = []
+        start = 0
+        for _, name in sorted(rotated):
+            path = os.path.join(self.directory, name)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            segments.append((path, start, size))
+            start += size
+        try:
+            with open(self.path, "rb") as f:
+                segments.append((self.path, start, self._complete_end(f)))
+        except FileNotFoundError:
+            pass
+        return segments
+
+    # ===== 从末尾往回读 =====
+    def tail(self, limit=50, before=None):
+        """返回(日志列表(新→旧), 下一页游标)"""
+        lines = []
+        for path, start, size in reversed(self._segments()):
+            if len(lines) >= limit:
+                break
+            end = size if before is None else min(size, before - start)
+            if end <= 0:
+                continue
+            lines.extend(
+                (start + offset, raw) for offset, raw in self._tail_file(path, end, limit - len(lines))
+            )
+
+        entries = [entry for entry in (self._parse(raw) for _, raw in lines) if entry]
+        next_cursor = lines[-1][0] if len(lines) >= limit and lines[-1][0] > 0 else None
+        return entries, next_cursor
+
+    def _tail_file(self, path, end, limit):
+        """从一个文件的end处往回读最多limit行，返回[(文件内偏移, 原始行)]"""
+        lines = []
+        with open(path, "rb") as f:
+            pos = end
+            carry = b""
+            while pos > 0 and len(lines) < limit:
+                size = min(READ_BLOCK_SIZE, pos)
+                pos -= size
+                f.seek(pos)
+                chunk = f.read(size) + carry
+                stop = len(chunk)
+                while stop > 0 and len(lines) < limit:
+                    newline = chunk.rfind(b"\n", 0, stop - 1)
+                    if newline == -1:
+                        if pos == 0:
+                            lines.append((0, chunk[:stop]))
+                            stop = 0
+                        break
+                    lines.append((pos + newline + 1, chunk[newline + 1:stop]))
+                    stop = newline + 1
+                carry = chunk[:stop]
+        return lines
+
+    def _complete_end(self, f):
+        """文件末尾可能有一行正在写，只读到最后一个换行为止"""
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        while pos > 0:
+            size = min(READ_BLOCK_SIZE, pos)
+            f.seek(pos - size)
+            chunk = f.read(size)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                return pos - size + newline + 1
+            pos -= size
+        return 0
+
+    def _parse(self, raw):
+        raw = raw.strip()
+        if not raw:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    # ===== SQLite旁路索引 =====
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS log_index ("
+                    "offset INTEGER PRIMARY KEY, user_id TEXT, ts TEXT)"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS log_index_user ON log_index (user_id, offset)"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS log_index_ts ON log_index (ts)"
+                )
+                # 旧版本只索引当前文件（按inode），偏移和现在的不通用
+                self._conn.execute("DROP TABLE IF EXISTS log_index_meta")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS log_index_state ("
+                    "id INTEGER PRIMARY KEY CHECK (id = 0), first_segment TEXT, indexed_upto INTEGER)"
+                )
+        return self._conn
+
+    def refresh_index(self):
+        """把上次索引之后新追加的行加进索引（轮转不用重建；最早的文件被删或日志变短时重建）"""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT first_segment, indexed_upto FROM log_index_state").fetchone()
+            first, indexed_upto = row if row else (None, 0)
+
+            segments = self._segments()
+            first_now = segments[0][0] if segments else None
+            total = segments[-1][1] + segments[-1][2] if segments else 0
+            if row is None or first_now != first or total < indexed_upto:
+                with conn:
+                    conn.execute("DELETE FROM log_index")
+                indexed_upto = 0
+
+            rows = []
+            for path, start, size in segments:
+                if start + size <= indexed_upto:
+                    continue
+                offset = max(indexed_upto, start)
+                with open(path, "rb") as f:
+                    f.seek(offset - start)
+                    for raw in f:
+                        if not raw.endswith(b"\n"):
+                            break   # 正在写的半行，下次再索引
+                        entry = self._parse(raw)
+                        if entry:
+                            rows.append((offset, entry.get("user_id"), entry.get("timestamp")))
+                        offset += len(raw)
+                        if len(rows) >= INDEX_BATCH_SIZE:
+                            self._insert(conn, rows, first_now, offset)
+                            rows = []
+                indexed_upto = offset
+            self._insert(conn, rows, first_now, indexed_upto)
+
+    def _insert(self, conn, rows, first_segment, indexed_upto):
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO log_index (offset, user_id, ts) VALUES (?, ?, ?)", rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO log_index_state (id, first_segment, indexed_upto) VALUES (0, ?, ?)",
+                (first_segment, indexed_upto)
+            )
+
+    def _where(self, user_id, since, until):
+        clauses, args = [], []
+        if user_id:
+            clauses.append("user_id = ?")
+            args.append(user_id)
+        if since:
+            clauses.append("ts >= ?")
+            args.append(since)
+        if until:
+            clauses.append("ts < ?")
+            args.append(until)
+        return clauses, args
+
+    def _lines_at(self, offsets):
+        """按偏移逐行产出原始行（偏移落在哪个文件里就读哪个）"""
+        segments = self._segments()
+        starts = [start for _, start, _ in segments]
+        files = {}
+        try:
+            for offset in offsets:
+                i = bisect.bisect_right(starts, offset) - 1
+                if i < 0:
+                    continue
+                path, start, _ = segments[i]
+                f = files.get(path)
+                if f is None:
+                    f = files[path] = open(path, "rb")
+                f.seek(offset - start)
+                yield f.readline()
+        finally:
+            for f in files.values():
+                f.close()
+
+    def _read_at(self, offsets):
+        return [entry for entry in (self._parse(raw) for raw in self._lines_at(offsets)) if entry]
+
+    # ===== 过滤查询 =====
+    def query(self, limit=50, before=None, user_id=None, since=None, until=None):
+        """按条件查询，返回(日志列表(新→旧), 下一页游标)，只读命中的行"""
+        self.refresh_index()
+        clauses, args = self._where(user_id, since, until)
+        if before is not None:
+            clauses.append("offset < ?")
+            args.append(before)
+        sql = "SELECT offset FROM log_index"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY offset DESC LIMIT ?"
+
+        with self._lock:
+            offsets = [row[0] for row in self._conn.execute(sql, args + [limit])]
+        entries = self._read_at(offsets)
+        next_cursor = offsets[-1] if len(offsets) >= limit else None
+        return entries, next_cursor
+
+    def count(self, user_id=None, since=None, until=None):
+        self.refresh_index()
+        clauses, args = self._where(user_id, since, until)
+        sql = "SELECT COUNT(*) FROM log_index"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        with self._lock:
+            return self._conn.execute(sql, args).fetchone()[0]
+
+    def export(self, user_id=None, since=None, until=None, page_size=1000):
+        """按时间顺序逐行产出原始NDJSON，适合StreamingResponse"""
+        self.refresh_index()
+        clauses, args = self._where(user_id, since, until)
+        clauses.append("offset > ?")
+        sql = (
+            "SELECT offset FROM log_index WHERE " + " AND ".join(clauses)
+            + " ORDER BY offset ASC LIMIT ?"
+        )
+        last = -1
+        while True:
+            with self._lock:
+                offsets = [row[0] for row in self._conn.execute(sql, args + [last, page_size])]
+            if not offsets:
+                return
+            for raw in self._lines_at(offsets):
+                yield raw.decode("utf-8")
+            last = offsets[-1]
+
+
+class SqliteLogReader:
+    """
+    chat_logs表的读取端，接口和ChatLogReader一致
+    游标是行id，过滤直接走表上的索引
+    """
+
+    COLUMNS = "id, timestamp, user_id, user_message, nua_reply, timezone"
+
+    def __init__(self, db):
+        self.db = db
+
+    def exists(self):
+        return True
+
+    def refresh_index(self):
+        pass
+
+    def _entry(self, row):
+        return {
+            "timestamp": row[1],
+            "user_id": row[2],
+            "user_message": row[3],
+            "nua_reply": row[4],
+            "timezone": row[5],
+        }
+
+    def _where(self, user_id, since, until):
+        clauses, args = [], []
+        if user_id:
+            clauses.append("user_id = ?")
+            args.append(user_id)
+        if since:
+            clauses.append("timestamp >= ?")
+            args.append(since)
+        if until:
+            clauses.append("timestamp < ?")
+            args.append(until)
+        return clauses, args
+
+    def tail(self, limit=50, before=None):
+        return self.query(limit, before)
+
+    def query(self, limit=50, before=None, user_id=None, since=None, until=None):
+        clauses, args = self._where(user_id, since, until)
+        if before is not None:
+            clauses.append("id < ?")
+            args.append(before)
+        sql = f"SELECT {self.COLUMNS} FROM chat_logs"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id DESC LIMIT ?"
+        rows = self.db.query(sql, args + [limit])
+        next_cursor = rows[-1][0] if len(rows) >= limit else None
+        return [self._entry(row) for row in rows], next_cursor
+
+    def count(self, user_id=None, since=None, until=None):
+        clauses, args = self._where(user_id, since, until)
+        sql = "SELECT COUNT(*) FROM chat_logs"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self.db.query_one(sql, args)[0]
+
+    def export(self, user_id=None, since=None, until=None, page_size=1000):
+        clauses, args = self._where(user_id, since, until)
+        clauses.append("id > ?")
+        sql = (
+            f"SELECT {self.COLUMNS} FROM chat_logs WHERE " + " AND ".join(clauses)
+            + " ORDER BY id ASC LIMIT ?"
+        )
+        last = 0
+        while True:
+            rows = self.db.query(sql, args + [last, page_size])
+            if not rows:
+                return
+            for row in rows:
+                yield json.dumps(self._entry(row), ensure_ascii=False) + "\n"
+            last = rows[-1][0]
+
+
+def create_log_reader(path):
+    if STORAGE == "sqlite":
+        return SqliteLogReader(get_database())
+    return ChatLogReader(path)
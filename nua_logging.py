@@ -0,0 +1,158 @@
+# nua_logging.py
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+# ========= 日志配置（环境变量） =========
+LOG_LEVEL = os.getenv("NUA_LOG_LEVEL", "INFO")
+# 按模块设置级别，例如 "nua_time=DEBUG,nua_llm=WARNING"
+LOG_LEVELS = os.getenv("NUA_LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("NUA_LOG_FORMAT", "json")   # json | text
+# DEBUG日志的采样比例（0~1），高频调试日志只留一部分
+LOG_DEBUG_SAMPLE = float(os.getenv("NUA_LOG_DEBUG_SAMPLE", "1"))
+LOG_QUEUE_SIZE = int(os.getenv("NUA_LOG_QUEUE_SIZE", "10000"))
+
+# ========= 请求上下文（每个请求/任务独立） =========
+request_id_var = contextvars.ContextVar("request_id", default=None)
+user_id_var = contextvars.ContextVar("user_id", default=None)
+
+# 日志记录自带的字段，其余的都算作extra输出到JSON里
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+def bind_request(request_id):
+    request_id_var.set(request_id)
+    user_id_var.set(None)
+
+
+def bind_user(user_id):
+    user_id_var.set(user_id)
+
+
+class ContextFilter(logging.Filter):
+    """在发日志的那一刻记下request_id和user_id（之后在后台线程格式化）"""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = request_id_var.get()
+        if not hasattr(record, "user_id"):
+            record.user_id = user_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """DEBUG日志按比例采样"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一个JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        if record.user_id:
+            entry["user_id"] = record.user_id
+        for key, value in vars(record).items():
+            if key not in _RESERVED and key not in ("request_id", "user_id"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    标准QueueHandler会在调用方线程里先格式化消息；
+    这里只复制一份记录放进队列，格式化全部交给后台线程
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            # 异常对象带着栈帧，先转成文本再跨线程
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # 队列满了宁可丢日志，也不阻塞请求
+            pass
+
+
+def _parse_levels(spec):
+    levels = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    配置根日志：调用方只做入队，后台线程格式化并写stdout
+    重复调用无副作用
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s [%(request_id)s %(user_id)s] %(message)s"
+        ))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(LOG_DEBUG_SAMPLE))
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """把队列里剩下的日志写完"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,91 @@
+# nua_mailbox.py
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# ========= 待取回复配置 =========
+PENDING_REPLY_TTL = float(os.getenv("NUA_PENDING_REPLY_TTL", "600"))          # 多久没取走就丢弃（秒）
+PENDING_REPLY_MAX_USERS = int(os.getenv("NUA_PENDING_REPLY_MAX_USERS", "10000"))
+PENDING_REPLY_PER_USER = int(os.getenv("NUA_PENDING_REPLY_PER_USER", "5"))
+
+
+class PendingReplies:
+    """
+    对冲回复之后在后台完成的LLM回复，等前端轮询或下一次流式请求来取（取走即删）
+    - 每个用户最多留per_user条，超过时丢最早的
+    - 用户数有上限，超过时丢最久没更新的用户
+    """
+
+    def __init__(self, ttl=PENDING_REPLY_TTL, max_users=PENDING_REPLY_MAX_USERS,
+                 per_user=PENDING_REPLY_PER_USER):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.per_user = per_user
+        self._boxes = OrderedDict()   # user_id -> deque[(放入时间, 回复)]
+        self.counters = {"stored": 0, "delivered": 0, "expired": 0}
+
+    def put(self, user_id, reply, reply_to=None):
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = deque(maxlen=self.per_user)
+            while len(self._boxes) > self.max_users:
+                _, old = self._boxes.popitem(last=False)
+                self.counters["expired"] += len(old)
+        else:
+            self._boxes.move_to_end(user_id)
+        box.append((time.monotonic(), {
+            "reply": reply,
+            "reply_to": reply_to,
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+        }))
+        self.counters["stored"] += 1
+
+    def take(self, user_id):
+        """取走该用户所有没过期的回复（按完成顺序）"""
+        box = self._boxes.pop(user_id, None)
+        if not box:
+            return []
+        deadline = time.monotonic() - self.ttl
+        replies = [item for stored_at, item in box if stored_at >= deadline]
+        self.counters["expired"] += len(box) - len(replies)
+        self.counters["delivered"] += len(replies)
+        return replies
+
+    def __len__(self):
+        return sum(len(box) for box in self._boxes.values())
+
+    def stats(self):
+        return {
+            "users": len(self._boxes),
+            "pending": len(self),
+            "ttl_seconds": self.ttl,
+            **self.counters,
+        }
+
+
+# ========= 全局实例（main.py的聊天接口和轮询接口共用） =========
+pending_replies = PendingReplies()
+
+
+class LateReply:
+    """
+    一次请求的对冲状态
+    - 人格模块对冲（先给规则回复）时调用hedge()
+    - LLM在后台跑完时调用deliver(回复)：放进待取信箱，再调用on_deliver（如接进对话历史、写日志）
+    """
+
+    def __init__(self, user_id, reply_to=None, on_deliver=None, box=pending_replies):
+        self.user_id = user_id
+        self.reply_to = reply_to
+        self.on_deliver = on_deliver
+        self.box = box
+        self.hedged = False
+
+    def hedge(self):
+        self.hedged = True
+
+    def deliver(self, reply):
+        self.box.put(self.user_id, reply, self.reply_to)
+        if self.on_deliver is not None:
+            self.on_deliver(reply)
@@ -0,0 +1,486 @@
+# nua_memory.py
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from datetime import datetime
+
+from nua_storage import STORAGE, STORAGE_DB, SHARED_STATE, get_database, get_redis
+
+logger = logging.getLogger(__name__)
+
+# ========= 用户记忆配置 =========
+MEMORY_DIR = "user_memories"
+# 开启共享状态时跟共享存储一致，否则NUA_STORAGE=sqlite时默认也用sqlite
+MEMORY_BACKEND = os.getenv(
+    "NUA_MEMORY_BACKEND",
+    SHARED_STATE if SHARED_STATE != "local" else ("sqlite" if STORAGE == "sqlite" else "json")
+)
+MEMORY_DB = os.getenv("NUA_MEMORY_DB", STORAGE_DB if STORAGE == "sqlite" else "user_memories.db")
+MEMORY_CACHE_SIZE = int(os.getenv("NUA_MEMORY_CACHE_SIZE", "10000"))
+MEMORY_FLUSH_INTERVAL = float(os.getenv("NUA_MEMORY_FLUSH_INTERVAL", "2"))
+# 开启后保存时检查版本号（compare-and-swap），读取之后被别人改过就拒绝写入
+# 多worker共享状态时默认开启（进程内的用户锁管不到别的worker）
+MEMORY_CAS = os.getenv("NUA_MEMORY_CAS", "1" if SHARED_STATE != "local" else "0") == "1"
+
+
+class MemoryCorruptError(Exception):
+    """记忆文件/记录无法解析"""
+
+
+class MemoryConflictError(Exception):
+    """CAS版本冲突：记忆在读取之后已被其他请求修改"""
+
+
+def default_memory():
+    """新用户的默认记忆"""
+    return {
+        "close_mode_count": 0,
+        "name": None,
+        "name_confirmed": False,
+        "preferred_divination": None,
+        "timezone": "Asia/Shanghai",  # 记住用户时区
+        "timezone_offset": 8,
+        "divination": {
+            "preferred_method": None,
+            "api_triggered": False,
+            "count": 0
+        }
+    }
+
+
+def memory_version(memory):
+    return memory.get("_version", 0)
+
+
+# ========= 磁盘层：JSON目录 =========
+class JsonDirBackend:
+    """
+    每个用户一个 {user_id}.json
+    写入时先写同目录下的唯一临时文件、fsync，再rename覆盖（崩溃时要么旧文件要么新文件）
+    """
+
+    def __init__(self, directory=MEMORY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def load(self, user_id):
+        path = self._path(user_id)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (ValueError, UnicodeDecodeError) as e:
+            raise MemoryCorruptError(f"{path}: {e}") from e
+        except OSError as e:
+            # 如user_id太长、含路径分隔符：按没有记忆处理，不让请求失败
+            logger.warning("⚠️ 读取用户%s的记忆失败，使用默认记忆: %s", user_id, e)
+            return None
+
+    def quarantine(self, user_id):
+        """损坏的文件改名留档，不覆盖"""
+        path = self._path(user_id)
+        corrupt_path = f"{path}.corrupt-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        os.replace(path, corrupt_path)
+        return corrupt_path
+
+    def save_many(self, payloads):
+        """逐个用户写入，某个用户失败不影响同批的其他用户；返回写失败的user_id"""
+        failed = []
+        for user_id, data in payloads.items():
+            try:
+                self._save_one(user_id, data)
+            except Exception as e:
+                logger.error("⚠️ 保存用户%s的记忆失败: %s", user_id, e)
+                failed.append(user_id)
+        if len(failed) < len(payloads):
+            try:
+                self._fsync_dir()
+            except OSError as e:
+                logger.warning("⚠️ 记忆目录fsync失败: %s", e)
+        return failed
+
+    def save(self, user_id, data):
+        """保存一个用户（目录后端不做版本比较，总是写入）"""
+        self._save_one(user_id, data)
+        self._fsync_dir()
+        return True
+
+    def _save_one(self, user_id, data):
+        path = self._path(user_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{user_id}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _fsync_dir(self):
+        """rename本身也要落盘"""
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# ========= 磁盘层：SQLite =========
+class SqliteBackend:
+    """
+    所有用户记忆存在一张表里（nua_storage的WAL库，写线程批量提交）
+    version列记录记忆的_version；开启CAS时版本更旧的写入会被拒绝（多进程共用一个库时）
+    """
+
+    def __init__(self, db=None, cas=MEMORY_CAS):
+        self.db = db or get_database()
+        self.path = self.db.path
+        self.cas = cas
+        self._save_sql = (
+            "INSERT INTO user_memory (user_id, data, version) "
+            "VALUES (?, ?, COALESCE(json_extract(?, '$._version'), 0)) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, version = excluded.version"
+        )
+        if cas:
+            self._save_sql += " WHERE excluded.version > user_memory.version"
+
+    def load(self, user_id):
+        row = self.db.query_one("SELECT data FROM user_memory WHERE user_id = ?", (user_id,))
+        if row is None:
+            return None
+        try:
+            return json.loads(row[0])
+        except ValueError as e:
+            raise MemoryCorruptError(f"{self.path}/{user_id}: {e}") from e
+
+    def quarantine(self, user_id):
+        def move(conn):
+            conn.execute(
+                "INSERT INTO user_memory_corrupt (user_id, data, quarantined_at) "
+                "SELECT user_id, data, ? FROM user_memory WHERE user_id = ?",
+                (datetime.now().isoformat(), user_id)
+            )
+            conn.execute("DELETE FROM user_memory WHERE user_id = ?", (user_id,))
+        self.db.write(move)
+        return "user_memory_corrupt"
+
+    def save_many(self, payloads):
+        """
+        一批一个事务；整批失败时逐个用户重试，返回写失败的user_id
+        开启CAS时版本比库里旧的记录不覆盖（不算失败，重试也不会成功）
+        """
+        rows = [(user_id, data, data) for user_id, data in payloads.items()]
+
+        def save(conn):
+            before = conn.total_changes
+            conn.executemany(self._save_sql, rows)
+            return conn.total_changes - before
+
+        try:
+            written = self.db.write(save)
+        except Exception as e:
+            logger.warning("⚠️ 批量保存用户记忆失败，逐个重试: %s", e)
+            failed = []
+            for user_id, data in payloads.items():
+                try:
+                    self.save(user_id, data)
+                except Exception as e:
+                    logger.error("⚠️ 保存用户%s的记忆失败: %s", user_id, e)
+                    failed.append(user_id)
+            return failed
+        if written < len(rows):
+            logger.warning("⚠️ %d 条用户记忆的版本比库里旧，未覆盖", len(rows) - written)
+        return []
+
+    def save(self, user_id, data):
+        """保存一个用户，返回是否写入（开启CAS且版本不比库里新时为False）"""
+        return self.db.write(
+            lambda conn: conn.execute(self._save_sql, (user_id, data, data)).rowcount
+        ) > 0
+
+
+# ========= 共享层：Redis =========
+class RedisBackend:
+    """
+    每个用户一个hash：{prefix}{user_id} -> data, version
+    开启CAS时在Lua脚本里比较版本，版本不比库里新的写入被拒绝（和SqliteBackend一致）
+    """
+
+    SAVE_SCRIPT = """
+    local current = tonumber(redis.call('HGET', KEYS[1], 'version') or '-1')
+    if ARGV[3] == '1' and current >= tonumber(ARGV[2]) then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'data', ARGV[1], 'version', ARGV[2])
+    return 1
+    """
+
+    def __init__(self, client=None, prefix="nua:memory:", cas=MEMORY_CAS):
+        self.client = client or get_redis()
+        self.prefix = prefix
+        self.cas = cas
+        self._save = self.client.register_script(self.SAVE_SCRIPT)
+
+    def load(self, user_id):
+        data = self.client.hget(self.prefix + user_id, "data")
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise MemoryCorruptError(f"{self.prefix}{user_id}: {e}") from e
+
+    def quarantine(self, user_id):
+        corrupt_key = f"{self.prefix.rstrip(':')}_corrupt:{user_id}:{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        self.client.rename(self.prefix + user_id, corrupt_key)
+        return corrupt_key
+
+    def save_many(self, payloads):
+        """一次pipeline；每个用户的脚本单独成败，返回写失败的user_id"""
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, data in payloads.items():
+            version = json.loads(data).get("_version", 0)
+            self._save(keys=[self.prefix + user_id], args=[data, version, int(self.cas)], client=pipe)
+        failed = []
+        stale = 0
+        for user_id, result in zip(payloads, pipe.execute(raise_on_error=False)):
+            if isinstance(result, Exception):
+                logger.error("⚠️ 保存用户%s的记忆失败: %s", user_id, result)
+                failed.append(user_id)
+            elif not result:
+                stale += 1
+        if stale:
+            logger.warning("⚠️ %d 条用户记忆的版本比Redis里旧，未覆盖", stale)
+        return failed
+
+    def save(self, user_id, data):
+        """保存一个用户，返回是否写入（开启CAS且版本不比库里新时为False）"""
+        version = json.loads(data).get("_version", 0)
+        return bool(self._save(keys=[self.prefix + user_id], args=[data, version, int(self.cas)]))
+
+
+# ========= 带缓存的用户记忆存储 =========
+class UserMemoryStore:
+    """
+    用户记忆的统一入口
+    - get()命中LRU缓存时不读磁盘
+    - put()只标记脏数据，后台任务合并写入（write-behind）
+    - 同一用户在一个刷新周期内多次put只写一次
+    - 每次put版本号(_version)加一；传expected_version时先比对（CAS）
+    - shared=True（多worker共享状态）时不缓存：get()每次从共享存储读，put()立即写穿，
+      版本冲突由共享存储判断，被拒绝时抛MemoryConflictError
+    - 事件循环里用aget()/aput()：要读写磁盘或共享存储时放到线程里做
+    """
+
+    def __init__(self, backend, cache_size=MEMORY_CACHE_SIZE,
+                 flush_interval=MEMORY_FLUSH_INTERVAL, shared=False):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.shared = shared
+
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._pending = {}    # 已被挤出缓存、还没写盘的快照
+        self._inflight = {}   # 正在写盘的快照
+        self._task = None
+        self._stopping = False
+        self._wakeup = None
+
+    # ===== 读写接口 =====
+    def get(self, user_id):
+        """读取用户记忆（返回缓存里的同一个dict）"""
+        if self.shared:
+            return self._load(user_id) or default_memory()
+
+        memory = self._cache.get(user_id)
+        if memory is not None:
+            self._cache.move_to_end(user_id)
+            return memory
+
+        data = self._pending.get(user_id) or self._inflight.get(user_id)
+        if data is not None:
+            memory = json.loads(data)
+        else:
+            memory = self._load(user_id)
+            if memory is None:
+                memory = default_memory()
+        self._remember(user_id, memory)
+        return memory
+
+    async def aget(self, user_id):
+        """get()的异步版本：缓存没命中时在线程里读（含损坏数据的隔离），不卡事件循环"""
+        if self.shared:
+            return await asyncio.to_thread(self.get, user_id)
+        if self._known(user_id):
+            return self.get(user_id)
+        memory = await asyncio.to_thread(self._load, user_id)
+        # 读盘期间同一用户可能已经进了缓存（别的请求put过），以缓存里的为准
+        if self._known(user_id):
+            return self.get(user_id)
+        if memory is None:
+            memory = default_memory()
+        self._remember(user_id, memory)
+        return memory
+
+    def _known(self, user_id):
+        return user_id in self._cache or user_id in self._pending or user_id in self._inflight
+
+    def _load(self, user_id):
+        try:
+            return self.backend.load(user_id)
+        except MemoryCorruptError as e:
+            # 不再把损坏的数据当成空记忆悄悄覆盖：原数据隔离留档，再从默认记忆开始
+            where = self.backend.quarantine(user_id)
+            logger.error("❌ 用户%s的记忆已损坏，原数据已移到%s: %s", user_id, where, e)
+            return None
+
+    def put(self, user_id, memory, expected_version=None):
+        """
+        更新用户记忆，稍后统一写盘
+        expected_version: 读取时的版本号，和当前版本不一致时抛MemoryConflictError
+        """
+        if self.shared:
+            self._put_shared(user_id, memory, expected_version)
+            return
+
+        if expected_version is not None:
+            current = self._cache.get(user_id)
+            if current is None:
+                current = self.get(user_id)
+            if memory_version(current) != expected_version:
+                raise MemoryConflictError(
+                    f"用户{user_id}的记忆版本{memory_version(current)}，期望{expected_version}"
+                )
+        memory["_version"] = memory_version(memory) + 1
+        self._remember(user_id, memory)
+        self._dirty.add(user_id)
+        if self._task is None:
+            # 后台任务没启动（脚本场景）时直接写
+            self._write(self._snapshot())
+
+    async def aput(self, user_id, memory, expected_version=None):
+        """put()的异步版本：共享状态下写穿放到线程里"""
+        if self.shared:
+            await asyncio.to_thread(self.put, user_id, memory, expected_version)
+        else:
+            self.put(user_id, memory, expected_version)
+
+    def _put_shared(self, user_id, memory, expected_version):
+        """写穿到共享存储（等提交完成，下一个请求落到哪个worker都能读到）"""
+        memory["_version"] = memory_version(memory) + 1
+        written = self.backend.save(user_id, self._dumps(memory))
+        if not written and expected_version is not None:
+            raise MemoryConflictError(
+                f"用户{user_id}的记忆已被其他worker更新（本次读取时版本{expected_version}）"
+            )
+
+    def _remember(self, user_id, memory):
+        self._cache[user_id] = memory
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            old_id, old_memory = self._cache.popitem(last=False)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                self._pending[old_id] = self._dumps(old_memory)
+
+    # ===== 写盘 =====
+    def _dumps(self, memory):
+        return json.dumps(memory, ensure_ascii=False, indent=2)
+
+    def _snapshot(self):
+        """在事件循环里序列化脏数据，避免线程里读到正在修改的dict"""
+        payloads = self._pending
+        self._pending = {}
+        for user_id in self._dirty:
+            payloads[user_id] = self._dumps(self._cache[user_id])
+        self._dirty.clear()
+        return payloads
+
+    def _write(self, payloads):
+        try:
+            failed = self.backend.save_many(payloads)
+        except Exception as e:
+            logger.error("⚠️ 保存用户记忆失败: %s", e)
+            failed = payloads
+        self._requeue(payloads, failed)
+
+    def _requeue(self, payloads, failed):
+        """只把写失败的用户放回待写队列（已有更新版本的跳过），同批其他用户不受影响"""
+        for user_id in failed:
+            if user_id not in self._dirty:
+                self._pending.setdefault(user_id, payloads[user_id])
+
+    async def flush(self):
+        payloads = self._snapshot()
+        if not payloads:
+            return
+        self._inflight.update(payloads)
+        try:
+            failed = await asyncio.to_thread(self.backend.save_many, payloads)
+        except Exception as e:
+            logger.error("⚠️ 保存用户记忆失败: %s", e)
+            failed = payloads
+        finally:
+            for user_id, data in payloads.items():
+                if self._inflight.get(user_id) is data:
+                    del self._inflight[user_id]
+        self._requeue(payloads, failed)
+
+    # ===== 生命周期 =====
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台任务，把所有脏数据写完"""
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def stats(self):
+        return {
+            "cached_users": len(self._cache),
+            "dirty_users": len(self._dirty) + len(self._pending),
+            "shared": self.shared,
+        }
+
+
+def create_backend(kind=MEMORY_BACKEND):
+    if kind == "redis":
+        return RedisBackend()
+    if kind == "sqlite":
+        return SqliteBackend(get_database(MEMORY_DB))
+    return JsonDirBackend(MEMORY_DIR)
+
+
+# ========= 全局实例（main.py、人格模块、占卜控制器共用） =========
+memory_store = UserMemoryStore(create_backend(), shared=SHARED_STATE != "local")
@@ -0,0 +1,143 @@
+# nua_metrics.py
+import bisect
+import time
+from contextlib import contextmanager
+
+# 耗时直方图的桶（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, value in self._values.items():
+            lines.append(f"{self.name}{_labels_text(self.labels, values)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    固定桶的直方图，observe()只做一次二分查找和几次加法
+    每组标签一个[各桶计数..., +Inf桶计数, 总和, 总数]
+    """
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for values, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels_text(names, values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, values)} {round(series[-2], 6)}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, values)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """抓取时才调用fn()取值，平时没有开销；fn返回数值或{标签值元组: 数值}"""
+
+    def __init__(self, name, help_text, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        if isinstance(value, dict):
+            for values, v in value.items():
+                lines.append(f"{self.name}{_labels_text(self.labels, values)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, fn, labels=(), kind="gauge"):
+        """kind="counter"时表示fn返回的是单调递增的累计值（由其他模块自己计数）"""
+        return self._register(Gauge(name, help_text, fn, labels, kind))
+
+    def _register(self, metric):
+        # 模块被重复导入时复用同一个指标
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} 采集失败: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# ========= 通用指标 =========
+http_requests = registry.counter(
+    "nua_http_requests_total", "HTTP请求数", ("method", "route", "status"))
+http_latency = registry.histogram(
+    "nua_http_request_duration_seconds", "HTTP请求耗时（到响应体发完，流式接口含整条流）", ("method", "route"))
+stage_latency = registry.histogram(
+    "nua_stage_duration_seconds", "请求内部各阶段耗时", ("op", "stage"))
+fallbacks = registry.counter(
+    "nua_fallback_total", "降级为规则回复的次数", ("op", "reason"))
+
+
+def stage(op, name):
+    """计时请求内部的一个阶段：with stage("chat", "llm"): ..."""
+    return stage_latency.time(op, name)
@@ -1,20 +1,46 @@
 # nua_personality.py
+import asyncio
 import random
-import json
+import logging
 import os
-import re
-from datetime import datetime, timedelta
-from openai import OpenAI
+from datetime import datetime
 
-# ========= DeepSeek客户端（NUA的大脑） =========
-client = OpenAI(
-    api_key=os.getenv("DEEPSEEK_API_KEY"),
-    base_url="https://api.deepseek.com"
-)
+logger = logging.getLogger(__name__)
 
-# ========= 用户记忆存储 =========
-MEMORY_DIR = "user_memories"
-os.makedirs(MEMORY_DIR, exist_ok=True)
+# ========= DeepSeek客户端（NUA的大脑，异步共享） =========
+from nua_llm import chat_completion, stream_chat_completion, LLMUnavailable, LLMOverloaded
+
+# ========= 每个用户调用DeepSeek的频率限制（超出时这一轮用规则回复） =========
+from nua_ratelimit import llm_rate_limiter
+
+# ========= 用户记忆存储（带缓存，后台合并写盘） =========
+from nua_memory import memory_store
+from nua_context import UserContext
+
+# ========= 消息分析（意图/情绪/名字一次扫描） =========
+from nua_analyzer import analyze_message
+
+# ========= 上下文组装（固定人格前缀 + 按token预算截取的历史） =========
+from nua_prompt import ContextBuilder
+
+# ========= 指标（各阶段耗时、降级次数） =========
+from nua_metrics import registry, stage, fallbacks
+
+# ========= 对冲回复：LLM超过延迟预算还没回时先给规则回复，LLM在后台跑完再送达 =========
+from nua_mailbox import LateReply
+
+# 提示词里带了用户名字时，是否仍允许和其他用户的相同请求合并
+COALESCE_PERSONALIZED = os.getenv("NUA_LLM_COALESCE_PERSONALIZED", "0") == "1"
+
+# 默认的延迟预算（毫秒），0表示不对冲、一直等LLM（总超时仍是NUA_LLM_TIMEOUT）
+# 流式回复时预算指第一个片段到达前的等待
+HEDGE_BUDGET_MS = int(os.getenv("NUA_HEDGE_BUDGET_MS", "0"))
+# 服务停止时最多等后台回复多久（秒）
+LATE_REPLY_DRAIN_SECONDS = float(os.getenv("NUA_LATE_REPLY_DRAIN", "5"))
+
+late_replies = registry.counter(
+    "nua_late_replies_total", "对冲后在后台完成的LLM调用", ("outcome",))
+_late_tasks = set()
 
 # ========= 🎯 统一人格：温柔陪伴 + 占卜能力 =========
 NUA_PERSONALITY = """
@@ -55,6 +81,9 @@ NUA_PERSONALITY = """
 “在你需要的时候，我就在。”
 """
 
+# 固定前缀只生成这一次，每轮请求完全相同，DeepSeek的前缀缓存才能命中
+context_builder = ContextBuilder(NUA_PERSONALITY + "\n请结合最近的对话和当前状态，生成回应（1-2句话）。")
+
 # ========= 备用规则库 =========
 ALONE_PHRASES = [
     "窗外的风凉凉的。",
@@ -77,143 +106,40 @@ CLOSE_MODE_REPLIES = [
     "💗 听到你这么说，心里暖暖的。"
 ]
 
-# ========= 🌍 核心：用户时区感知的时间函数 =========
-def get_user_local_time(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
-    """
-    获取用户当地时间
-    优先级：
-    1. 使用前端传来的local_time_str（最准确）
-    2. 使用时区名称 + 当前UTC时间
-    3. 使用时区偏移量计算
-    4. 默认北京时间
-    """
-    try:
-        # 方法1：直接使用前端传来的当地时间（最准确！）
-        if local_time_str:
-            try:
-                # 尝试解析时间字符串
-                now = datetime.now()
-                time_parts = local_time_str.split(':')
-                if len(time_parts) >= 2:
-                    hour = int(time_parts[0])
-                    minute = int(time_parts[1])
-                    # 返回一个带有时区的datetime对象
-                    return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-            except:
-                pass
-        
-        # 方法2：使用时区名称（需要pytz库，如果没有则降级）
-        try:
-            import pytz
-            if timezone_str and timezone_str != "Asia/Shanghai":
-                tz = pytz.timezone(timezone_str)
-                return datetime.now(tz)
-        except ImportError:
-            print("⚠️ pytz未安装，使用时区偏移计算")
-        except Exception as e:
-            print(f"⚠️ 时区转换错误: {e}")
-        
-        # 方法3：使用偏移量计算
-        if offset is not None:
-            utc_now = datetime.utcnow()
-            return utc_now + timedelta(hours=offset)
-        
-    except Exception as e:
-        print(f"⚠️ 时区计算错误: {e}")
-    
-    # 方法4：默认北京时间
-    utc_now = datetime.utcnow()
-    return utc_now + timedelta(hours=8)
-
-def get_time_greeting(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
-    """
-    根据用户时区获取问候语
-    """
-    local_time = get_user_local_time(timezone_str, offset, local_time_str)
-    hour = local_time.hour
-    minute = local_time.minute
-    
-    # 打印调试信息（可在Railway日志查看）
-    print(f"🌍 用户时区: {timezone_str}")
-    print(f"🕐 用户当地时间: {hour}:{minute:02d}")
-    print(f"⚠️ 服务器UTC时间: {datetime.utcnow().hour}:{datetime.utcnow().minute:02d}")
-    
-    # 根据当地时间判断问候语
-    if 5 <= hour < 11:
-        return "早安", "☀️"
-    elif 11 <= hour < 13:
-        return "午安", "🍱"
-    elif 13 <= hour < 18:
-        return "下午好", "☕"
-    elif 18 <= hour < 22:
-        return "晚上好", "🌙"
-    elif 22 <= hour < 24:
-        return "夜深了", "🌃"
-    else:  # 0 <= hour < 5
-        return "还没睡呀", "🌃"
+# ========= 🌍 核心：用户时区感知的时间函数（时区对象缓存在nua_time里） =========
+from nua_time import get_time_greeting
 
 # ========= 用户记忆管理 =========
 def load_user_memory(user_id):
-    """加载用户记忆"""
-    memory_file = os.path.join(MEMORY_DIR, f"{user_id}.json")
-    if os.path.exists(memory_file):
-        try:
-            with open(memory_file, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except:
-            return {}
-    return {
-        "close_mode_count": 0,
-        "name": None,
-        "name_confirmed": False,
-        "preferred_divination": None,
-        "timezone": "Asia/Shanghai",  # 记住用户时区
-        "timezone_offset": 8,
-        "divination": {
-            "preferred_method": None,
-            "api_triggered": False,
-            "count": 0
-        }
-    }
+    """加载用户记忆（缓存命中时不读磁盘）"""
+    return memory_store.get(user_id)
 
 def save_user_memory(user_id, memory):
-    """保存用户记忆"""
-    memory_file = os.path.join(MEMORY_DIR, f"{user_id}.json")
-    try:
-        with open(memory_file, "w", encoding="utf-8") as f:
-            json.dump(memory, f, ensure_ascii=False, indent=2)
-    except:
-        pass
+    """保存用户记忆（标记为脏数据，由后台任务合并写盘）"""
+    memory_store.put(user_id, memory)
 
 def extract_name(user_message):
     """提取用户名字"""
-    patterns = [
-        r"我叫(\w+)",
-        r"我是(\w+)",
-        r"可以叫我(\w+)",
-        r"喊我(\w+)",
-        r"名字是(\w+)"
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, user_message)
-        if match:
-            return match.group(1)
-    return None
+    return analyze_message(user_message)["name"]
 
 # ========= 💬 核心对话生成 =========
-def generate_nua_response(user_id, user_message, user_conversations=None, 
-                         force_api=False, timezone="Asia/Shanghai", 
-                         timezone_offset=8, local_time_str=None):
+def prepare_nua_turn(user_id, user_message, timezone="Asia/Shanghai",
+                     timezone_offset=8, local_time_str=None, analysis=None,
+                     context=None, history=None):
     """
-    生成NUA回应
-    - 🌍 支持用户时区感知的时间问候
-    - 💗 支持亲近模式
-    - 🔮 支持占卜意图引导
-    - 💾 支持名字记忆
+    一轮对话的准备阶段（不调用API）
+    analysis为analyze_message的结果，调用方已经分析过时直接传进来
+    context为请求级UserContext，记忆的读取和保存都交给它；不传时每次改动立即保存
+    history为该用户最近的对话（[{"role", "content"}]），按token预算放进上下文
+    返回turn字典；turn["reply"]不为空时说明不需要调用API
     """
+    if analysis is None:
+        analysis = analyze_message(user_message)
+    if context is None:
+        context = UserContext(user_id, autocommit=True)
     
     # ===== 1. 加载记忆 =====
-    memory = load_user_memory(user_id)
+    memory = context.memory
     
     # ===== 2. 更新用户时区信息到记忆 =====
     memory["timezone"] = timezone
@@ -222,84 +148,183 @@ def generate_nua_response(user_id, user_message, user_conversations=None,
     # ===== 3. 获取用户时区的问候语 =====
     time_greeting, time_prefix = get_time_greeting(timezone, timezone_offset, local_time_str)
     
+    turn = {
+        "user_id": user_id,
+        "user_message": user_message,
+        "history": history,
+        "context": context,
+        "memory": memory,
+        "timezone": timezone,
+        "local_time_str": local_time_str,
+        "time_greeting": time_greeting,
+        "time_prefix": time_prefix,
+        "close_mode": False,
+        "emotion": "平稳",
+        "reply": None
+    }
+    
     # ===== 4. 检测占卜意图 =====
-    divination_keywords = ["占卜", "塔罗", "梅花易数", "算卦", "占卦", "卜卦", "轻占卜", "算一算", "占一卦", "会占卜吗", "会塔罗吗"]
-    if any(word in user_message for word in divination_keywords):
-        save_user_memory(user_id, memory)
-        return f"""{time_prefix} {time_greeting}。🔮 我会三种占卜方式，你想用哪种？
+    if analysis["divination"]:
+        context.mark_dirty()
+        turn["reply"] = f"""{time_prefix} {time_greeting}。🔮 我会三种占卜方式，你想用哪种？
 
 🎴 塔罗牌：选3个1-22的数字（过去/现在/未来）
 ☯️ 梅花易数：选2个1-8的数字（起卦解读）
 🎲 轻占卜：选1个颜色 + 1个1-10的数字
 
 直接告诉我方式和数字就好，比如“塔罗 3,7,18”～"""
+        return turn
     
     # ===== 5. 检测亲近模式 =====
-    close_mode = False
-    love_keywords = ["想你", "爱你", "喜欢你", "我爱你", "想你啦", "想你了"]
-    if any(word in user_message for word in love_keywords):
-        close_mode = True
+    if analysis["close_mode"]:
+        turn["close_mode"] = True
         memory["close_mode_count"] = memory.get("close_mode_count", 0) + 1
     
     # ===== 6. 检测名字 =====
-    if not memory.get("name"):
-        name = extract_name(user_message)
-        if name:
-            memory["name"] = name
+    if not memory.get("name") and analysis["name"]:
+        memory["name"] = analysis["name"]
     
     # ===== 7. 情绪识别 =====
-    emotion = "平稳"
-    happy_words = ["开心", "喜欢", "快乐", "高兴", "不错", "好", "幸福", "温暖"]
-    quiet_words = ["嗯", "唉", "..." , "累", "烦", "难过", "伤心", "疲惫"]
+    turn["emotion"] = analysis["emotion"]
     
-    if any(word in user_message for word in happy_words):
-        emotion = "开心"
-    elif any(word in user_message for word in quiet_words) and len(user_message) < 20:
-        emotion = "低落"
+    return turn
+
+def build_llm_request(turn):
+    """组装发给DeepSeek的消息和温度（固定人格前缀 + 历史 + 当前状态 + 这句话）"""
+    name = turn["memory"].get("name", "")
+    close_mode = turn["close_mode"]
+    # 只精确到分钟：秒数对回复没有意义，还会让相同的请求无法合并
+    local_time_str = ":".join((turn["local_time_str"] or "").split(":")[:2])
     
-    # ===== 8. 尝试使用API =====
-    if not force_api:
-        try:
-            name = memory.get("name", "")
-            
-            system_prompt = f"""
-{NUA_PERSONALITY}
+    state = [
+        ("用户称呼", name if name else "未记录"),
+        ("用户情绪", turn["emotion"]),
+        ("用户时区", turn["timezone"]),
+        ("用户当地时间", local_time_str if local_time_str else "未知"),
+        ("亲近模式", "是 - 语气更轻柔" if close_mode else "否"),
+    ]
+    messages = context_builder.build(state, turn["history"], turn["user_message"])
+    return messages, 0.8 if close_mode else 0.7
 
-【当前状态】
-- 用户称呼: {name if name else '未记录'}
-- 用户情绪: {emotion}
-- 用户时区: {timezone}
-- 用户当地时间: {local_time_str if local_time_str else '未知'}
-- 亲近模式: {'是 - 语气更轻柔' if close_mode else '否'}
+def can_coalesce(turn):
+    """提示词里带了用户名字时默认不和别人合并（NUA_LLM_COALESCE_PERSONALIZED=1时允许）"""
+    return COALESCE_PERSONALIZED or not turn["memory"].get("name")
 
-用户说: {user_message}
+def decorate_llm_reply(turn, nua_reply):
+    """亲近模式加💗前缀"""
+    if turn["close_mode"] and not nua_reply.startswith("💗"):
+        nua_reply = f"💗 {nua_reply}"
+    return nua_reply
 
-请生成回应（1-2句话）：
-"""
-            
-            response = client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_message}
-                ],
-                temperature=0.8 if close_mode else 0.7,
-                max_tokens=200
-            )
-            
-            nua_reply = response.choices[0].message.content.strip()
-            
-            # 亲近模式添加💗前缀
-            if close_mode and not nua_reply.startswith("💗"):
-                nua_reply = f"💗 {nua_reply}"
-            
-            save_user_memory(user_id, memory)
-            return nua_reply
-            
+def finish_llm_reply(turn, nua_reply):
+    """API回复的后处理：亲近模式加💗前缀，保存记忆"""
+    nua_reply = decorate_llm_reply(turn, nua_reply)
+    turn["context"].mark_dirty()
+    return nua_reply
+
+# ========= ⏱️ 对冲回复 =========
+class ReplyHedged(Exception):
+    """LLM在延迟预算内没有开始回复，调用已转到后台"""
+
+def hedge_budget(latency_budget_ms=None):
+    """请求里的预算（毫秒）优先，没有时用NUA_HEDGE_BUDGET_MS；返回秒，None表示不对冲"""
+    budget = HEDGE_BUDGET_MS if latency_budget_ms is None else latency_budget_ms
+    return budget / 1000 if budget and budget > 0 else None
+
+def _continue_in_background(task, turn, late_reply):
+    """
+    对冲之后让LLM调用在后台跑完，回复交给late_reply.deliver()
+    此时请求已经结束：不再改记忆（对冲时的规则回复已经记过了）
+    """
+    late_reply.hedge()
+    _late_tasks.add(task)
+    
+    def done(task):
+        _late_tasks.discard(task)
+        if task.cancelled():
+            late_replies.inc("cancelled")
+            return
+        error = task.exception()
+        if error is not None or not task.result():
+            logger.debug("⚠️ 用户%s的后台回复失败: %r", late_reply.user_id, error)
+            late_replies.inc("failed")
+            return
+        try:
+            late_reply.deliver(decorate_llm_reply(turn, task.result().strip()))
         except Exception as e:
-            print(f"⚠️ API不可用，使用降级模式: {e}")
+            logger.warning("⚠️ 后台回复送达失败: %s", e)
+            late_replies.inc("failed")
+            return
+        late_replies.inc("delivered")
     
-    # ===== 9. API失败时的降级方案 =====
+    task.add_done_callback(done)
+
+async def _hedged(coro, budget, turn, late_reply):
+    """budget秒内完成时返回结果；否则转到后台跑完，抛ReplyHedged"""
+    if budget is None:
+        return await coro
+    task = asyncio.ensure_future(coro)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=budget)
+    except asyncio.CancelledError:
+        # 客户端断开：没人要这个回复了
+        task.cancel()
+        raise
+    if done:
+        return task.result()
+    _continue_in_background(task, turn, late_reply)
+    raise ReplyHedged()
+
+async def _hedged_stream(deltas, budget, turn, late_reply):
+    """第一个片段在budget秒内到达时照常逐段产出；否则整个流转到后台读完，抛ReplyHedged"""
+    queue = asyncio.Queue()
+    
+    async def pump():
+        parts = []
+        try:
+            async for delta in deltas:
+                parts.append(delta)
+                queue.put_nowait(delta)
+        except Exception as e:
+            queue.put_nowait(e)
+            return None
+        queue.put_nowait(None)
+        return "".join(parts)
+    
+    task = asyncio.ensure_future(pump())
+    handed_off = False
+    try:
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout=budget)
+        except asyncio.TimeoutError:
+            handed_off = True
+            _continue_in_background(task, turn, late_reply)
+            raise ReplyHedged()
+        while item is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            item = await queue.get()
+    finally:
+        if not handed_off and not task.done():
+            task.cancel()
+
+async def drain_late_replies(timeout=LATE_REPLY_DRAIN_SECONDS):
+    """服务停止时等后台的LLM调用跑完（最多timeout秒），剩下的取消"""
+    if not _late_tasks:
+        return
+    _, pending = await asyncio.wait(set(_late_tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("⚠️ %d 个后台回复没来得及完成", len(pending))
+
+def fallback_nua_reply(turn):
+    """API失败时的降级方案（规则回复）"""
+    memory = turn["memory"]
+    close_mode = turn["close_mode"]
+    time_greeting = turn["time_greeting"]
+    time_prefix = turn["time_prefix"]
     response_parts = []
     
     # 每日首次问候
@@ -321,7 +346,7 @@ def generate_nua_response(user_id, user_message, user_conversations=None,
     if close_mode:
         response_parts.append(random.choice(CLOSE_MODE_REPLIES))
     else:
-        response_parts.append(random.choice(EMOTION_REPLIES[emotion]))
+        response_parts.append(random.choice(EMOTION_REPLIES[turn["emotion"]]))
         if random.random() < 0.3:
             response_parts.append(random.choice(ALONE_PHRASES))
     
@@ -330,20 +355,152 @@ def generate_nua_response(user_id, user_message, user_conversations=None,
         response_parts.insert(0, f"{memory['name']}。")
         memory["name_confirmed"] = True
     
-    save_user_memory(user_id, memory)
+    turn["context"].mark_dirty()
     return " ".join(response_parts[:2])
 
+async def generate_nua_response(user_id, user_message, user_conversations=None, 
+                         force_api=False, timezone="Asia/Shanghai", 
+                         timezone_offset=8, local_time_str=None, analysis=None,
+                         context=None, history=None, latency_budget_ms=None, late_reply=None):
+    """
+    生成NUA回应
+    - 🌍 支持用户时区感知的时间问候
+    - 💗 支持亲近模式
+    - 🔮 支持占卜意图引导
+    - 💾 支持名字记忆（传入context时由请求结束时统一保存）
+    - 💬 带上最近的对话（history，或从user_conversations里取）
+    - ⏱️ 有延迟预算时，LLM超时未回先返回规则回复，LLM的回复稍后交给late_reply
+    """
+    if history is None and user_conversations is not None:
+        history = await user_conversations.aget(user_id)
+    with stage("nua_reply", "prepare"):
+        turn = prepare_nua_turn(user_id, user_message, timezone, timezone_offset,
+                                local_time_str, analysis, context, history)
+    if turn["reply"]:
+        return turn["reply"]
+    
+    # ===== 8. 尝试使用API =====
+    reason = "forced"
+    if not force_api and not llm_rate_limiter.allow(user_id):
+        logger.debug("🚦 用户%s调用太频繁，本轮使用规则回复", user_id)
+        reason = "rate_limited"
+    elif not force_api:
+        try:
+            with stage("nua_reply", "build_prompt"):
+                messages, temperature = build_llm_request(turn)
+            with stage("nua_reply", "llm"):
+                nua_reply = await _hedged(
+                    chat_completion(
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=200,
+                        endpoint="nua_reply",
+                        coalesce=can_coalesce(turn)
+                    ),
+                    hedge_budget(latency_budget_ms), turn,
+                    late_reply or LateReply(user_id, user_message)
+                )
+            return finish_llm_reply(turn, nua_reply)
+            
+        except ReplyHedged:
+            logger.debug("⏱️ 用户%s：DeepSeek超出延迟预算，先用规则回复", user_id)
+            reason = "hedged"
+        except LLMOverloaded as e:
+            # 在途调用已满：不排长队，直接降级
+            logger.debug("🚦 %s，使用降级模式", e)
+            reason = "shed"
+        except LLMUnavailable:
+            # 熔断中：不等超时，直接降级
+            logger.debug("⚡ DeepSeek熔断中，使用降级模式")
+            reason = "circuit_open"
+        except Exception as e:
+            logger.warning("⚠️ API不可用，使用降级模式: %s", e)
+            reason = "error"
+    
+    # ===== 9. API失败时的降级方案 =====
+    fallbacks.inc("nua_reply", reason)
+    with stage("nua_reply", "fallback"):
+        return fallback_nua_reply(turn)
+
+async def stream_nua_response(user_id, user_message, timezone="Asia/Shanghai",
+                              timezone_offset=8, local_time_str=None, analysis=None,
+                              context=None, history=None, latency_budget_ms=None, late_reply=None):
+    """
+    流式生成NUA回应
+    依次产出 ("delta", 文本片段)，最后产出 ("done", 完整回复)
+    后处理（💗前缀、保存记忆）和对冲回复都和generate_nua_response一致
+    """
+    turn = prepare_nua_turn(user_id, user_message, timezone, timezone_offset,
+                            local_time_str, analysis, context, history)
+    if turn["reply"]:
+        yield "delta", turn["reply"]
+        yield "done", turn["reply"]
+        return
+    
+    parts = []
+    reason = "empty"
+    if not llm_rate_limiter.allow(user_id):
+        logger.debug("🚦 用户%s调用太频繁，流式回复使用规则回复", user_id)
+        reason = "rate_limited"
+    else:
+        try:
+            messages, temperature = build_llm_request(turn)
+            deltas = stream_chat_completion(
+                messages=messages,
+                temperature=temperature,
+                max_tokens=200,
+                endpoint="nua_reply_stream"
+            )
+            budget = hedge_budget(latency_budget_ms)
+            if budget is not None:
+                deltas = _hedged_stream(deltas, budget, turn, late_reply or LateReply(user_id, user_message))
+            async for delta in deltas:
+                if not parts:
+                    delta = delta.lstrip()
+                    if not delta:
+                        continue
+                    # 亲近模式：第一个字不是💗时先补上前缀
+                    if turn["close_mode"] and not delta.startswith("💗"):
+                        delta = f"💗 {delta}"
+                parts.append(delta)
+                yield "delta", delta
+        except ReplyHedged:
+            logger.debug("⏱️ 用户%s：DeepSeek超出延迟预算，流式回复先用规则回复", user_id)
+            reason = "hedged"
+        except LLMOverloaded as e:
+            logger.debug("🚦 %s，流式回复使用降级模式", e)
+            reason = "shed"
+        except LLMUnavailable:
+            logger.debug("⚡ DeepSeek熔断中，流式回复使用降级模式")
+            reason = "circuit_open"
+        except Exception as e:
+            logger.warning("⚠️ 流式API不可用: %s", e)
+            reason = "error"
+    
+    if parts:
+        yield "done", finish_llm_reply(turn, "".join(parts).strip())
+    else:
+        # 一个字都没拿到，使用降级方案
+        fallbacks.inc("nua_reply_stream", reason)
+        nua_reply = fallback_nua_reply(turn)
+        yield "delta", nua_reply
+        yield "done", nua_reply
+
 
 # ========= 🔮 占卜控制器 =========
-from divination.tarot import tarot_single, tarot_three
-from divination.iching import iching_divination
-from divination.light import light_divination
+from divination.tables import rule_reading
+from divination.cache import divination_cache
 from divination.api_divination import api_divination
 
+# 批量占卜时最多同时发几个API解读
+DIVINATION_BATCH_CONCURRENCY = int(os.getenv("NUA_DIVINATION_BATCH_CONCURRENCY", "4"))
+
 class DivinationController:
-    def __init__(self, user_id):
+    def __init__(self, user_id, context=None):
+        """context为请求级UserContext；不传时自己读记忆，每次改动立即保存"""
         self.user_id = user_id
-        self.memory = load_user_memory(user_id)
+        self.context = context or UserContext(user_id, autocommit=True)
+        self.memory = self.context.memory
         
         if "divination" not in self.memory:
             self.memory["divination"] = {
@@ -352,37 +509,92 @@ class DivinationController:
                 "count": 0
             }
     
-    async def handle(self, method, params, user_question="", user_emotion="平稳"):
-        rule_result = None
-        if method == "塔罗" and len(params) == 1:
-            rule_result = tarot_single(params[0])
-        elif method == "塔罗" and len(params) == 3:
-            rule_result = tarot_three(params)
-        elif method == "梅花易数" and len(params) == 2:
-            rule_result = iching_divination(params[0], params[1])
-        elif method == "轻占卜" and len(params) == 2:
-            rule_result = light_divination(params[0], params[1])
+    def _needs_api(self, method, rule_result):
+        """没有规则解读，或用户说过“不准”且偏好这种方式时用API"""
+        pref = self.memory["divination"]
+        if not rule_result:
+            return True
+        return bool(pref.get("api_triggered") and pref.get("preferred_method") == method)
+    
+    async def _api_reading(self, method, params, user_question, user_emotion):
+        async def generate():
+            # 只有真要调API时才扣令牌，命中缓存不算
+            if not llm_rate_limiter.allow(self.user_id, endpoint="divination"):
+                logger.debug("🚦 用户%s占卜太频繁，本次不调API", self.user_id)
+                return None
+            return await api_divination(method, params, user_question, user_emotion)
         
-        need_api = False
+        # 相同的(方式, 参数, 问题, 情绪)复用缓存里的解读
+        return await divination_cache.get_or_generate(
+            method, params, user_question, user_emotion, generate
+        )
+    
+    def _record(self, method, api_result):
+        """更新占卜计数和偏好（不保存）"""
         pref = self.memory["divination"]
+        if api_result:
+            pref["api_triggered"] = True
+            pref["preferred_method"] = method
+        pref["count"] += 1
+    
+    async def handle(self, method, params, user_question="", user_emotion="平稳"):
+        # 规则解读启动时已全部算好，这里只查表
+        with stage("divination", "rule"):
+            rule_result = rule_reading(method, params)
         
-        if not rule_result:
-            need_api = True
-        if pref.get("api_triggered") and pref.get("preferred_method") == method:
-            need_api = True
+        api_result = None
+        if self._needs_api(method, rule_result):
+            with stage("divination", "api"):
+                api_result = await self._api_reading(method, params, user_question, user_emotion)
+            if not api_result:
+                fallbacks.inc("divination", "rule" if rule_result else "none")
         
-        if need_api:
-            api_result = await api_divination(method, params, user_question, user_emotion)
+        self._record(method, api_result)
+        self.context.mark_dirty()
+        if api_result:
+            return api_result, True
+        return rule_result or "今天玩点别的吧～", False
+    
+    async def handle_batch(self, items, user_emotion="平稳",
+                           concurrency=DIVINATION_BATCH_CONCURRENCY):
+        """
+        一次处理多个占卜 items=[(方式, 参数, 问题)]
+        - 规则解读一次查完，按当前偏好决定哪些要调API
+        - 需要的API解读并发执行，同时最多concurrency个
+        - 计数和偏好按顺序更新，只保存一次
+        返回和items同序的列表，每项是(解读, 是否API)或该项的异常
+        """
+        rule_results = [rule_reading(method, params) for method, params, _ in items]
+        needs_api = [self._needs_api(item[0], rule) for item, rule in zip(items, rule_results)]
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        
+        async def api_reading(item, need):
+            if not need:
+                return None
+            method, params, question = item
+            async with semaphore:
+                return await self._api_reading(method, params, question, user_emotion)
+        
+        api_results = await asyncio.gather(
+            *(api_reading(item, need) for item, need in zip(items, needs_api)),
+            return_exceptions=True
+        )
+        
+        results = []
+        for item, rule_result, api_result in zip(items, rule_results, api_results):
+            if isinstance(api_result, asyncio.CancelledError):
+                raise api_result
+            if isinstance(api_result, Exception):
+                results.append(api_result)
+                continue
+            self._record(item[0], api_result)
             if api_result:
-                pref["api_triggered"] = True
-                pref["preferred_method"] = method
-                pref["count"] += 1
-                save_user_memory(self.user_id, self.memory)
-                return api_result, True
+                results.append((api_result, True))
+            else:
+                results.append((rule_result or "今天玩点别的吧～", False))
         
-        pref["count"] += 1
-        save_user_memory(self.user_id, self.memory)
-        return rule_result or "今天玩点别的吧～", False
+        self.context.mark_dirty()
+        return results
     
     def feedback(self, accurate):
         pref = self.memory["divination"]
@@ -391,4 +603,4 @@ class DivinationController:
             pref["preferred_method"] = pref.get("preferred_method")
         else:
             pref["api_triggered"] = False
-        save_user_memory(self.user_id, self.memory)
+        self.context.mark_dirty()
@@ -0,0 +1,95 @@
+# nua_prompt.py
+import os
+import re
+
+# ========= 上下文配置 =========
+# 历史消息最多占多少token（估算值），超出时丢掉最早的
+CONTEXT_TOKEN_BUDGET = int(os.getenv("NUA_CONTEXT_TOKEN_BUDGET", "1200"))
+# 每条消息的格式开销（role、分隔符）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 中日韩文字和全角符号
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text):
+    """
+    本地估算token数（不调用分词器）
+    按DeepSeek的经验值：一个中文字符约0.6个token，一个英文字符约0.3个token
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextBuilder:
+    """
+    组装发给DeepSeek的消息：
+      [固定的人格前缀] + [最近的历史（按token预算截取）] + [当前状态] + [用户这句话]
+    - 人格前缀启动时生成一次，每轮完全相同，DeepSeek的前缀缓存可以命中
+    - 会变的状态（情绪、时间、称呼）放在历史之后，不破坏前面的缓存
+    """
+
+    def __init__(self, persona, budget=CONTEXT_TOKEN_BUDGET):
+        self.prefix = {"role": "system", "content": persona}
+        self.prefix_tokens = message_tokens(self.prefix)
+        self.budget = budget
+        self.counters = {
+            "requests": 0,
+            "estimated_prompt_tokens": 0,
+            "history_messages": 0,
+            "history_truncated": 0,
+        }
+
+    def _pick_history(self, history, user_message):
+        history = list(history or [])
+        # main.py在生成回复前已把这句话加进历史，不要发两遍
+        if history and history[-1].get("role") == "user" and history[-1].get("content") == user_message:
+            history.pop()
+
+        picked = []
+        used = 0
+        for message in reversed(history):
+            cost = message_tokens(message)
+            if used + cost > self.budget:
+                self.counters["history_truncated"] += 1
+                break
+            picked.append({"role": message["role"], "content": message["content"]})
+            used += cost
+        picked.reverse()
+        # 不以助手的话开头
+        while picked and picked[0]["role"] != "user":
+            used -= message_tokens(picked.pop(0))
+        return picked, used
+
+    def build(self, state, history, user_message):
+        """state为[(名称, 值)]，返回消息列表"""
+        picked, history_tokens = self._pick_history(history, user_message)
+        state_message = {
+            "role": "system",
+            "content": "【当前状态】\n" + "\n".join(f"- {name}: {value}" for name, value in state),
+        }
+        user = {"role": "user", "content": user_message}
+
+        self.counters["requests"] += 1
+        self.counters["history_messages"] += len(picked)
+        self.counters["estimated_prompt_tokens"] += (
+            self.prefix_tokens + history_tokens + message_tokens(state_message) + message_tokens(user)
+        )
+        return [self.prefix, *picked, state_message, user]
+
+    def stats(self):
+        requests = self.counters["requests"]
+        return {
+            "prefix_tokens": self.prefix_tokens,
+            "history_budget_tokens": self.budget,
+            "requests": requests,
+            "history_truncated": self.counters["history_truncated"],
+            "avg_history_messages": round(self.counters["history_messages"] / requests, 2) if requests else 0.0,
+            "avg_estimated_prompt_tokens": round(self.counters["estimated_prompt_tokens"] / requests, 1) if requests else 0.0,
+        }
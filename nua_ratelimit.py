@@ -0,0 +1,68 @@
+# nua_ratelimit.py
+import os
+import time
+from collections import OrderedDict
+
+# ========= 每个用户调用DeepSeek的频率限制 =========
+# 令牌桶：平时每秒补充rate个，最多攒burst个；没有令牌时这一轮用规则回复
+# 默认关闭：打开后连发超过burst条的用户会收到规则回复，属于产品行为变化，按需用NUA_RATE_LIMIT=1开启
+RATE_LIMIT_ENABLED = os.getenv("NUA_RATE_LIMIT", "0") == "1"
+RATE_LIMIT_RATE = float(os.getenv("NUA_RATE_LIMIT_RATE", "0.2"))      # 每秒补充的令牌（默认每分钟12次）
+RATE_LIMIT_BURST = float(os.getenv("NUA_RATE_LIMIT_BURST", "10"))     # 桶容量（允许的短时连发）
+RATE_LIMIT_MAX_KEYS = int(os.getenv("NUA_RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+class TokenBucketLimiter:
+    """
+    每个(接口, key)一个令牌桶，key是user_id（没有时是main.py按IP+UA算的哈希）
+    - 聊天和占卜各用各的桶，占卜用掉的令牌不影响聊天
+    - 不用后台任务：取令牌时按距上次的时间补充
+    - key数量有上限，超过时淘汰最久没用的（它的桶多半早已补满，淘汰后重建等价）
+    """
+
+    def __init__(self, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST,
+                 max_keys=RATE_LIMIT_MAX_KEYS, enabled=RATE_LIMIT_ENABLED):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.enabled = enabled
+        self._buckets = OrderedDict()   # key -> [剩余令牌, 上次更新时间]
+        self.allowed = 0
+        self.rejected = 0
+
+    def allow(self, key, cost=1, endpoint="chat"):
+        """有令牌时扣掉并返回True"""
+        if not self.enabled:
+            return True
+        key = (endpoint, key)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            self.allowed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "tracked_keys": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+        }
+
+
+# ========= 全局实例（人格模块和占卜控制器共用） =========
+llm_rate_limiter = TokenBucketLimiter()
@@ -0,0 +1,87 @@
+# nua_registry.py
+import os
+from collections import Counter, OrderedDict
+from datetime import datetime
+from itertools import islice
+
+# 最多记录多少个用户（超过后淘汰最久没出现的）
+REGISTRY_MAX_USERS = int(os.getenv("NUA_REGISTRY_MAX_USERS", "100000"))
+
+
+class UserRegistry:
+    """
+    用户元数据的内存索引（时区、最后出现时间、消息数、占卜数）
+    - 每次聊天/占卜时增量更新，不读任何文件
+    - 按last_seen排序，分页只遍历当前页
+    - 时区分布和总数随更新一起维护，统计是O(1)
+    """
+
+    def __init__(self, max_users=REGISTRY_MAX_USERS):
+        self.max_users = max_users
+        self._users = OrderedDict()   # 按last_seen从旧到新
+        self._timezones = Counter()
+        self.totals = {"messages": 0, "divinations": 0}
+
+    def _touch(self, user_id):
+        now = datetime.now().isoformat()
+        meta = self._users.get(user_id)
+        if meta is None:
+            meta = {
+                "user_id": user_id,
+                "timezone": "未知",
+                "first_seen": now,
+                "last_seen": now,
+                "message_count": 0,
+                "divination_count": 0
+            }
+            self._users[user_id] = meta
+            self._timezones[meta["timezone"]] += 1
+            while len(self._users) > self.max_users:
+                _, old = self._users.popitem(last=False)
+                self._forget_timezone(old["timezone"])
+        else:
+            meta["last_seen"] = now
+            self._users.move_to_end(user_id)
+        return meta
+
+    def _forget_timezone(self, timezone):
+        self._timezones[timezone] -= 1
+        if self._timezones[timezone] <= 0:
+            del self._timezones[timezone]
+
+    # ===== 增量更新 =====
+    def record_chat(self, user_id, timezone=None):
+        meta = self._touch(user_id)
+        if timezone and timezone != meta["timezone"]:
+            self._forget_timezone(meta["timezone"])
+            self._timezones[timezone] += 1
+            meta["timezone"] = timezone
+        meta["message_count"] += 1
+        self.totals["messages"] += 1
+
+    def record_divination(self, user_id):
+        meta = self._touch(user_id)
+        meta["divination_count"] += 1
+        self.totals["divinations"] += 1
+
+    # ===== 查询 =====
+    def get(self, user_id):
+        return self._users.get(user_id)
+
+    def page(self, offset=0, limit=50):
+        """按last_seen从新到旧分页"""
+        return [dict(meta) for meta in islice(reversed(self._users.values()), offset, offset + limit)]
+
+    def __len__(self):
+        return len(self._users)
+
+    def stats(self):
+        return {
+            "total_users": len(self._users),
+            "total_messages": self.totals["messages"],
+            "total_divinations": self.totals["divinations"],
+            "users_per_timezone": dict(self._timezones.most_common())
+        }
+
+
+user_registry = UserRegistry()
@@ -0,0 +1,139 @@
+# nua_static.py
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# ========= 静态页面配置 =========
+STATIC_CACHE_CONTROL = os.getenv("NUA_STATIC_CACHE_CONTROL", "public, max-age=60, must-revalidate")
+# 开发时设为1，文件修改后自动重新加载
+STATIC_RELOAD = os.getenv("NUA_STATIC_RELOAD", "0") == "1"
+STATIC_RELOAD_INTERVAL = float(os.getenv("NUA_STATIC_RELOAD_INTERVAL", "1"))
+
+
+class StaticPage:
+    """
+    启动时读一次页面，预先算好ETag和gzip/brotli压缩版本
+    - 请求时不碰磁盘
+    - If-None-Match命中时返回304
+    - 开发模式下后台检查mtime，文件变了再重新加载
+    """
+
+    def __init__(self, possible_paths, fallback_html, media_type="text/html; charset=utf-8"):
+        self.possible_paths = possible_paths
+        self.fallback_html = fallback_html
+        self.media_type = media_type
+        self.path = None
+        self.mtime = None
+        self._variants = {}
+        self._etag = None
+        self._task = None
+
+    # ===== 加载 =====
+    def _find(self):
+        for path in self.possible_paths:
+            try:
+                with open(path, "rb") as f:
+                    return path, f.read()
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                logger.error("❌ 读取错误 %s: %s", path, e)
+                continue
+        return None, self.fallback_html.encode("utf-8")
+
+    def load(self):
+        path, body = self._find()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+
+        # 每种编码是不同的表示，各自用不同的强ETag
+        variants = {None: (body, f'"{digest}"')}
+        variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        if brotli is not None:
+            variants["br"] = (brotli.compress(body), f'"{digest}-br"')
+
+        self.path = path
+        self.mtime = os.path.getmtime(path) if path else None
+        self._variants = variants
+        self._etag = digest
+        logger.info("📄 页面已加载: %s，%d 字节", path or "（默认页面）", len(body))
+
+    # ===== 响应 =====
+    def _pick_encoding(self, accept_encoding):
+        accepted = {
+            part.split(";")[0].strip().lower()
+            for part in accept_encoding.split(",")
+            if not part.strip().endswith("q=0")
+        }
+        if "br" in accepted and "br" in self._variants:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def _matches(self, if_none_match):
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag.strip('"').split("-")[0] == self._etag:
+                return True
+        return False
+
+    def response(self, request):
+        if not self._variants:
+            self.load()
+
+        encoding = self._pick_encoding(request.headers.get("accept-encoding", ""))
+        body, etag = self._variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": STATIC_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and self._matches(if_none_match):
+            return Response(status_code=304, headers=headers)
+
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+    # ===== 开发模式：文件变化时重新加载 =====
+    async def start(self):
+        if STATIC_RELOAD and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(STATIC_RELOAD_INTERVAL)
+            try:
+                path = self._existing_path()
+                mtime = os.path.getmtime(path) if path else None
+                if path != self.path or mtime != self.mtime:
+                    self.load()
+            except Exception as e:
+                logger.warning("⚠️ 页面重新加载失败: %s", e)
+
+    def _existing_path(self):
+        for path in self.possible_paths:
+            if os.path.exists(path):
+                return path
+        return None
@@ -0,0 +1,213 @@
+# nua_storage.py
+import concurrent.futures
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# ========= 多worker共享状态 =========
+# local  = 对话历史和记忆缓存在进程内（默认，只能跑一个worker）
+# sqlite = 同一台机器上的多个worker共用STORAGE_DB（uvicorn --workers N）
+# redis  = 多台机器共用NUA_REDIS_URL（需要安装redis包）
+SHARED_STATE = os.getenv("NUA_SHARED_STATE", "local")
+REDIS_URL = os.getenv("NUA_REDIS_URL", "redis://localhost:6379/0")
+
+# ========= 存储配置 =========
+# file = 每个用户一个JSON + JSONL日志；sqlite = 记忆、对话、日志都放进一个WAL库
+# 开启共享状态时默认sqlite（多个worker同时追加同一个JSONL、各自轮转会互相覆盖）
+STORAGE = os.getenv("NUA_STORAGE", "sqlite" if SHARED_STATE != "local" else "file")
+STORAGE_DB = os.getenv("NUA_STORAGE_DB", "nua.db")
+STORAGE_BATCH_SIZE = int(os.getenv("NUA_STORAGE_BATCH_SIZE", "500"))   # 一个事务最多合并多少个写操作
+STORAGE_BUSY_TIMEOUT = float(os.getenv("NUA_STORAGE_BUSY_TIMEOUT", "5"))
+# NORMAL在WAL下只在checkpoint时fsync，断电最多丢最后几个事务；要更稳设为FULL
+STORAGE_SYNCHRONOUS = os.getenv("NUA_STORAGE_SYNCHRONOUS", "NORMAL")
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS user_memory ("
+    "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS user_memory_corrupt ("
+    "user_id TEXT, data TEXT, quarantined_at TEXT)",
+    "CREATE TABLE IF NOT EXISTS conversation_spill ("
+    "user_id TEXT PRIMARY KEY, messages TEXT NOT NULL, spilled_at REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS conversation_history ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, role TEXT NOT NULL, "
+    "content TEXT NOT NULL, created_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS conversation_history_user ON conversation_history (user_id, id)",
+    "CREATE TABLE IF NOT EXISTS chat_logs ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, user_id TEXT, "
+    "user_message TEXT, nua_reply TEXT, timezone TEXT)",
+    "CREATE INDEX IF NOT EXISTS chat_logs_user ON chat_logs (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS chat_logs_ts ON chat_logs (timestamp)",
+    "CREATE TABLE IF NOT EXISTS storage_meta (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+_STOP = object()
+
+
+class SqliteDatabase:
+    """
+    WAL模式的SQLite
+    - 所有写操作交给一个专用写线程，排队中的写操作合并成一个事务提交
+    - 每个读线程有自己的连接，WAL下读不阻塞写
+    - SQL都是固定文本，sqlite3按文本缓存预编译语句，不会每次重新解析
+    """
+
+    def __init__(self, path=STORAGE_DB, batch_size=STORAGE_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self.stats = {"writes": 0, "transactions": 0, "failed": 0}
+
+        conn = self._connect()
+        with conn:
+            for sql in SCHEMA:
+                conn.execute(sql)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(user_memory)")}
+            if "version" not in columns:
+                conn.execute("ALTER TABLE user_memory ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self._local.conn = conn
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=STORAGE_BUSY_TIMEOUT,
+            check_same_thread=False, cached_statements=256
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={STORAGE_SYNCHRONOUS}")
+        return conn
+
+    # ===== 读（调用方线程，每个线程一个连接） =====
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def query(self, sql, args=()):
+        return self._reader().execute(sql, args).fetchall()
+
+    def query_one(self, sql, args=()):
+        return self._reader().execute(sql, args).fetchone()
+
+    # ===== 写（排队给写线程） =====
+    def submit(self, fn):
+        """
+        排队一个写操作fn(conn)，返回Future（结果为fn的返回值）
+        不等待时调用方立即返回，写线程会把它和其他排队的操作一起提交
+        """
+        future = concurrent.futures.Future()
+        self._ensure_writer()
+        self._queue.put((fn, future))
+        return future
+
+    def execute(self, sql, args=()):
+        return self.submit(lambda conn: conn.execute(sql, args).rowcount)
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        return self.submit(lambda conn: conn.executemany(sql, rows).rowcount)
+
+    def write(self, fn):
+        """排队并等待提交完成（在线程里调用，不要在事件循环里直接调用）"""
+        return self.submit(fn).result()
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            with self._writer_lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(
+                        target=self._run, name="nua-sqlite-writer", daemon=True
+                    )
+                    self._writer.start()
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            ops = [self._queue.get()]
+            while len(ops) < self.batch_size:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in ops:
+                stopping = True
+                ops = [op for op in ops if op is not _STOP]
+            if ops:
+                self._commit(conn, ops)
+        conn.close()
+
+    def _commit(self, conn, ops):
+        results = []
+        try:
+            with conn:
+                for fn, _ in ops:
+                    results.append(fn(conn))
+        except Exception as e:
+            # 整批失败时逐个重试，只让出错的那个操作失败
+            if len(ops) > 1:
+                for op in ops:
+                    self._commit(conn, [op])
+                return
+            self.stats["failed"] += 1
+            ops[0][1].set_exception(e)
+            return
+        self.stats["transactions"] += 1
+        self.stats["writes"] += len(ops)
+        for (_, future), result in zip(ops, results):
+            future.set_result(result)
+
+    def close(self):
+        """等排队中的写操作全部提交后关闭写线程"""
+        if self._writer is not None:
+            self._queue.put(_STOP)
+            self._writer.join()
+            self._writer = None
+
+
+# ========= 共享实例（同一个库文件只开一个写线程） =========
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(path=STORAGE_DB):
+    with _databases_lock:
+        db = _databases.get(path)
+        if db is None:
+            db = _databases[path] = SqliteDatabase(path)
+        return db
+
+
+def close_databases():
+    with _databases_lock:
+        databases = list(_databases.values())
+        _databases.clear()
+        clients = list(_redis_clients.values())
+        _redis_clients.clear()
+    for db in databases:
+        db.close()
+    for client in clients:
+        client.close()
+
+
+# ========= Redis（可选依赖，只有NUA_SHARED_STATE=redis时才导入） =========
+_redis_clients = {}
+
+
+def get_redis(url=REDIS_URL):
+    """同一个地址共用一个连接池"""
+    with _databases_lock:
+        client = _redis_clients.get(url)
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("NUA_SHARED_STATE=redis 需要先安装redis包：pip install redis") from e
+            client = _redis_clients[url] = redis.Redis.from_url(url, decode_responses=True)
+        return client
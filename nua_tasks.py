@@ -0,0 +1,146 @@
+# nua_tasks.py
+import asyncio
+import inspect
+import logging
+import os
+import time
+
+from nua_metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# ========= 响应后工作队列配置 =========
+POST_RESPONSE_WORKERS = int(os.getenv("NUA_POST_RESPONSE_WORKERS", "4"))
+POST_RESPONSE_QUEUE_SIZE = int(os.getenv("NUA_POST_RESPONSE_QUEUE_SIZE", "10000"))
+POST_RESPONSE_DRAIN_SECONDS = float(os.getenv("NUA_POST_RESPONSE_DRAIN", "30"))   # 停机时等多久还没做完就告警（之后继续等）
+
+jobs = registry.counter(
+    "nua_post_response_jobs_total", "响应后工作的执行结果（done/failed/inline）", ("job", "outcome"))
+lag = registry.histogram(
+    "nua_post_response_lag_seconds", "响应后工作从入队到开始执行的等待", ("job",))
+
+
+class PostResponseQueue:
+    """
+    响应发出之后才做的工作（写对话历史、写日志、统计、保存记忆并释放用户锁）
+    - 进程内asyncio队列 + 固定数量的worker任务，工作可以是普通函数或协程函数
+    - submit()：队列满时在调用方直接执行（背压，不丢）
+    - submit_nowait()：给同步回调用，队列满时另起一个任务执行（不丢），stop()会等它做完
+    - 没启动或已经在停止时同样直接执行（脚本场景、停机期间都不丢）
+    - stop()先不再入队，等队列里的和另起的任务都做完再退出；超时只告警，不丢
+    """
+
+    def __init__(self, workers=POST_RESPONSE_WORKERS, max_size=POST_RESPONSE_QUEUE_SIZE):
+        self.workers = workers
+        self.max_size = max_size
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._tasks = []
+        self._inline = set()   # submit_nowait()另起的任务
+        self._accepting = False
+        self.busy = 0
+        self.counters = {"submitted": 0, "done": 0, "failed": 0, "inline": 0}
+
+    # ===== 提交 =====
+    async def submit(self, name, fn, *args):
+        if self._accepting:
+            try:
+                self._queue.put_nowait((name, fn, args, time.monotonic()))
+                self.counters["submitted"] += 1
+                return
+            except asyncio.QueueFull:
+                pass
+        self.counters["inline"] += 1
+        jobs.inc(name, "inline")
+        if not await self._run(name, fn, args):
+            self._count(name, "failed")
+
+    def submit_nowait(self, name, fn, *args):
+        """放进队列就返回；没启动、正在停止或队列满时另起一个任务执行（没有事件循环时当场执行）"""
+        if self._accepting:
+            try:
+                self._queue.put_nowait((name, fn, args, time.monotonic()))
+                self.counters["submitted"] += 1
+                return
+            except asyncio.QueueFull:
+                logger.warning("⚠️ 响应后工作队列已满（%d），%s另起任务执行", self.max_size, name)
+        self.counters["inline"] += 1
+        jobs.inc(name, "inline")
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._run_inline(name, fn, args))
+            return
+        task = asyncio.create_task(self._run_inline(name, fn, args))
+        self._inline.add(task)
+        task.add_done_callback(self._inline.discard)
+
+    # ===== 执行 =====
+    def _count(self, name, outcome):
+        self.counters[outcome] += 1
+        jobs.inc(name, outcome)
+
+    async def _run(self, name, fn, args):
+        try:
+            result = fn(*args)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.exception("❌ 响应后工作%s失败: %s", name, e)
+            return False
+        return True
+
+    async def _run_inline(self, name, fn, args):
+        if not await self._run(name, fn, args):
+            self._count(name, "failed")
+
+    async def _worker(self):
+        while True:
+            name, fn, args, queued_at = await self._queue.get()
+            lag.observe(time.monotonic() - queued_at, name)
+            self.busy += 1
+            try:
+                ok = await self._run(name, fn, args)
+            finally:
+                self.busy -= 1
+                self._queue.task_done()
+            self._count(name, "done" if ok else "failed")
+
+    # ===== 生命周期 =====
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._accepting = True
+
+    async def join(self):
+        """等队列里已有的工作和另起的任务都做完"""
+        await self._queue.join()
+        while self._inline:
+            await asyncio.gather(*self._inline, return_exceptions=True)
+
+    async def stop(self, timeout=POST_RESPONSE_DRAIN_SECONDS):
+        """不再入队（之后的工作直接执行），等所有工作做完；超过timeout秒告警后继续等，不丢"""
+        self._accepting = False
+        drained = asyncio.ensure_future(self.join())
+        await asyncio.wait({drained}, timeout=timeout)
+        if not drained.done():
+            logger.error("❌ 停机%g秒后还有%d个响应后工作没做完，继续等待",
+                         timeout, self._queue.qsize() + self.busy + len(self._inline))
+        await drained
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "workers": len(self._tasks),
+            "busy": self.busy,
+            "depth": self._queue.qsize(),
+            "inline_running": len(self._inline),
+            "max_size": self.max_size,
+            **self.counters,
+        }
+
+
+# ========= 全局实例（请求上下文收尾、main.py的各接口共用） =========
+post_response = PostResponseQueue()
@@ -0,0 +1,103 @@
+# nua_time.py
+import logging
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+logger = logging.getLogger(__name__)
+
+# ========= 问候语表：小时 -> (问候语, 表情) =========
+def _greeting_for_hour(hour):
+    if 5 <= hour < 11:
+        return "早安", "☀️"
+    elif 11 <= hour < 13:
+        return "午安", "🍱"
+    elif 13 <= hour < 18:
+        return "下午好", "☕"
+    elif 18 <= hour < 22:
+        return "晚上好", "🌙"
+    elif 22 <= hour < 24:
+        return "夜深了", "🌃"
+    else:  # 0 <= hour < 5
+        return "还没睡呀", "🌃"
+
+GREETING_BY_HOUR = tuple(_greeting_for_hour(hour) for hour in range(24))
+
+
+# ========= 时区对象缓存 =========
+@lru_cache(maxsize=1024)
+def get_tzinfo(timezone_str):
+    """
+    时区名称 -> tzinfo（优先zoneinfo，没有时用pytz）
+    未知时区返回None，结果同样被缓存，每个名字只校验一次
+    """
+    if ZoneInfo is not None:
+        try:
+            return ZoneInfo(timezone_str)
+        except Exception:
+            pass
+    if pytz is not None:
+        try:
+            return pytz.timezone(timezone_str)
+        except Exception:
+            pass
+    logger.warning("⚠️ 未知时区: %s，使用时区偏移计算", timezone_str)
+    return None
+
+
+# ========= 🌍 核心：用户时区感知的时间函数 =========
+def get_user_local_time(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
+    """
+    获取用户当地时间
+    优先级：
+    1. 使用前端传来的local_time_str（最准确）
+    2. 使用时区名称 + 当前UTC时间
+    3. 使用时区偏移量计算
+    4. 默认北京时间
+    """
+    # 方法1：直接使用前端传来的当地时间（最准确！）
+    if local_time_str:
+        try:
+            time_parts = local_time_str.split(':')
+            if len(time_parts) >= 2:
+                hour = int(time_parts[0])
+                minute = int(time_parts[1])
+                return datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+        except (ValueError, TypeError):
+            pass
+
+    # 方法2：使用时区名称（缓存的tzinfo）
+    if timezone_str and timezone_str != "Asia/Shanghai":
+        tz = get_tzinfo(timezone_str)
+        if tz is not None:
+            return datetime.now(tz)
+
+    # 方法3：使用偏移量计算
+    utc_now = datetime.utcnow()
+    if offset is not None:
+        try:
+            return utc_now + timedelta(hours=offset)
+        except (TypeError, OverflowError) as e:
+            logger.warning("⚠️ 时区偏移错误: %s", e)
+
+    # 方法4：默认北京时间
+    return utc_now + timedelta(hours=8)
+
+
+def get_time_greeting(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
+    """
+    根据用户时区获取问候语
+    """
+    local_time = get_user_local_time(timezone_str, offset, local_time_str)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("🌍 用户时区: %s，当地时间: %d:%02d", timezone_str, local_time.hour, local_time.minute)
+    return GREETING_BY_HOUR[local_time.hour]
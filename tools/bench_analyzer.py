@@ -0,0 +1,155 @@
+# tools/bench_analyzer.py
+"""
+消息分析的微基准：改造前的多次扫描 vs nua_analyzer的一次扫描
+- old：占卜/亲近/开心/低落各一遍 any(word in message ...)，extract_name逐个试5个正则，
+  main.py里再扫一遍“准/不准”（和改造前的代码一致）
+- new：nua_analyzer.analyze_message
+先检查两边对每条消息的结果一致，再按消息长度分组报告每条的耗时
+
+语料默认用内置的短句拼成不同长度的消息；给了--log时用聊天日志里用户真实说的话
+用法：python tools/bench_analyzer.py [--messages 20000] [--repeat 5] [--log nua_chat_logs.jsonl]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nua_analyzer import analyze_message
+
+# ========= 改造前的扫描（照搬原来的关键词和写法） =========
+DIVINATION_KEYWORDS = ["占卜", "塔罗", "梅花易数", "算卦", "占卦", "卜卦", "轻占卜", "算一算", "占一卦", "会占卜吗", "会塔罗吗"]
+LOVE_KEYWORDS = ["想你", "爱你", "喜欢你", "我爱你", "想你啦", "想你了"]
+HAPPY_WORDS = ["开心", "喜欢", "快乐", "高兴", "不错", "好", "幸福", "温暖"]
+QUIET_WORDS = ["嗯", "唉", "...", "累", "烦", "难过", "伤心", "疲惫"]
+
+
+def old_extract_name(user_message):
+    patterns = [
+        r"我叫(\w+)",
+        r"我是(\w+)",
+        r"可以叫我(\w+)",
+        r"喊我(\w+)",
+        r"名字是(\w+)"
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, user_message)
+        if match:
+            return match.group(1)
+    return None
+
+
+def old_analyze(user_message):
+    feedback = None
+    if "准" in user_message and "不准" not in user_message:
+        feedback = True
+    elif "不准" in user_message or "不准确" in user_message:
+        feedback = False
+
+    emotion = "平稳"
+    if any(word in user_message for word in HAPPY_WORDS):
+        emotion = "开心"
+    elif any(word in user_message for word in QUIET_WORDS) and len(user_message) < 20:
+        emotion = "低落"
+
+    return {
+        "divination": any(word in user_message for word in DIVINATION_KEYWORDS),
+        "close_mode": any(word in user_message for word in LOVE_KEYWORDS),
+        "emotion": emotion,
+        "feedback": feedback,
+        "name": old_extract_name(user_message),
+    }
+
+
+# ========= 语料 =========
+PHRASES = [
+    "今天下班有点晚", "外面一直在下雨", "刚吃完饭", "有点累了", "想你了", "今天挺开心的",
+    "老板又让我加班", "地铁上人好多", "我叫小林", "你会占卜吗", "帮我看看塔罗", "上次说得挺准",
+    "感觉不准", "唉", "嗯", "晚安", "最近睡得不好", "周末想出去走走", "朋友送了我一束花",
+    "心里有点烦", "不知道该怎么办", "谢谢你一直陪着我", "窗外的月亮很圆", "可以叫我阿青",
+    "工作上遇到点难过的事", "考试终于结束了", "明天要早起", "想听你说说话", "今天的晚霞好温暖",
+]
+
+
+def build_corpus(count, rng):
+    messages = []
+    for _ in range(count):
+        # 1～12个短句，长度大致落在2～150字
+        parts = rng.choices(PHRASES, k=rng.choice([1, 1, 1, 2, 2, 3, 4, 6, 8, 12]))
+        messages.append("，".join(parts))
+    return messages
+
+
+def load_corpus(path, count):
+    messages = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                message = json.loads(line).get("user_message")
+            except ValueError:
+                continue
+            if message:
+                messages.append(message)
+            if len(messages) >= count:
+                break
+    return messages
+
+
+def timed(fn, messages, repeat):
+    """每条消息取repeat次里最快的一次（微秒）"""
+    samples = []
+    for message in messages:
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn(message)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        samples.append(best * 1e6)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息分析：多次扫描 vs 一次扫描")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--log", default=None, help="用聊天日志里的用户消息作语料")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    messages = load_corpus(args.log, args.messages) if args.log else build_corpus(args.messages, random.Random(args.seed))
+
+    def new_fields(message):
+        result = analyze_message(message)
+        return {key: result[key] for key in ("divination", "close_mode", "emotion", "feedback", "name")}
+
+    mismatches = [m for m in messages if old_analyze(m) != new_fields(m)]
+    if mismatches:
+        print(f"❌ {len(mismatches)}条消息结果不一致，例如: {mismatches[0]!r}")
+        print(f"   old: {old_analyze(mismatches[0])}")
+        print(f"   new: {new_fields(mismatches[0])}")
+        sys.exit(1)
+    print(f"✅ {len(messages)}条消息两边结果一致")
+
+    old = timed(old_analyze, messages, args.repeat)
+    new = timed(analyze_message, messages, args.repeat)
+
+    buckets = [(0, 20), (20, 50), (50, 100), (100, 10 ** 9)]
+    print(f"{'长度':>10}{'条数':>8}{'old µs':>10}{'new µs':>10}{'加速':>8}")
+    for low, high in buckets + [(0, 10 ** 9)]:
+        index = [i for i, m in enumerate(messages) if low <= len(m) < high]
+        if not index:
+            continue
+        old_us = statistics.median(old[i] for i in index)
+        new_us = statistics.median(new[i] for i in index)
+        label = "全部" if (low, high) == (0, 10 ** 9) else (f"{low}-{high}" if high < 10 ** 9 else f"{low}+")
+        print(f"{label:>10}{len(index):>8}{old_us:>10.2f}{new_us:>10.2f}{old_us / new_us:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# tools/bench_chat_log.py
+"""
+聊天日志每请求的写入代价和日志已有行数的关系
+- old：改造前的做法，readlines()整个文件、改最后一行的时区、整个重写，再追加一行
+- new：nua_chat_log.ChatLogWriter，请求里append()只进缓冲，后台任务批量追加
+  报告请求路径上append()的耗时，以及把后台写盘（含fsync）摊到每条之后的耗时
+日志先预填到1k/10k/100k/1M行（不轮转），再测appends次写入
+
+用法：python tools/bench_chat_log.py [--sizes 1000,10000,100000,1000000] [--appends 2000]
+                                    [--old-appends 5] [--dir /tmp/nua-bench-log]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nua_chat_log import ChatLogWriter
+
+USER_MESSAGE = "今天下班路上看到很好看的晚霞，想跟你说一声"
+NUA_REPLY = "☀️ 🌸 真好呀，晚霞会把一天的疲惫都染成温柔的颜色。"
+
+
+def entry_line(i, timezone="Asia/Shanghai"):
+    return json.dumps({
+        "timestamp": datetime.now().isoformat(),
+        "user_id": f"user{i % 5000:05d}",
+        "user_message": USER_MESSAGE,
+        "nua_reply": NUA_REPLY,
+        "timezone": timezone,
+    }, ensure_ascii=False) + "\n"
+
+
+def prefill(path, lines):
+    chunk = 10000
+    with open(path, "w", encoding="utf-8") as f:
+        for start in range(0, lines, chunk):
+            f.write("".join(entry_line(i) for i in range(start, min(lines, start + chunk))))
+
+
+# ========= 改造前：每次请求重写整个文件 =========
+def old_request(path, user_id):
+    with open(path, "r", encoding="utf-8") as f:
+        logs = f.readlines()
+    if logs:
+        last_log = json.loads(logs[-1])
+        if last_log.get("user_id") == user_id:
+            last_log["timezone"] = "Asia/Shanghai"
+            logs[-1] = json.dumps(last_log, ensure_ascii=False) + "\n"
+            with open(path, "w", encoding="utf-8") as f:
+                f.writelines(logs)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(entry_line(0, None))
+
+
+def bench_old(path, appends):
+    # 最后一行是同一个用户时才会重写，按用户连续说话的情况测
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(entry_line(0))
+    samples = []
+    for _ in range(appends):
+        t0 = time.perf_counter()
+        old_request(path, "user00000")
+        samples.append((time.perf_counter() - t0) * 1e6)
+    return statistics.median(samples)
+
+
+# ========= 改造后：缓冲 + 后台批量追加 =========
+async def bench_new_async(path, appends):
+    writer = ChatLogWriter(path, max_bytes=0, rotate_daily=False)
+    await writer.start()
+    samples = []
+    started = time.perf_counter()
+    for i in range(appends):
+        t0 = time.perf_counter()
+        writer.append(f"user{i % 5000:05d}", USER_MESSAGE, NUA_REPLY, "Asia/Shanghai")
+        samples.append((time.perf_counter() - t0) * 1e6)
+        if i % 50 == 49:
+            # 模拟请求之间让出事件循环，后台任务有机会写盘
+            await asyncio.sleep(0)
+    await writer.stop()
+    elapsed = time.perf_counter() - started
+    return {"append_us": statistics.median(samples), "total_us": elapsed * 1e6 / appends}
+
+
+def bench_new(path, appends):
+    return asyncio.run(bench_new_async(path, appends))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天日志写入代价 vs 日志行数")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--appends", type=int, default=2000, help="new每个规模写多少条")
+    parser.add_argument("--old-appends", type=int, default=5, help="old每个规模写多少条（每条都重写整个文件）")
+    parser.add_argument("--dir", default="/tmp/nua-bench-log")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+    os.makedirs(args.dir)
+    path = os.path.join(args.dir, "nua_chat_logs.jsonl")
+
+    print(f"{'已有行数':>10}{'文件MB':>9}{'old µs/请求':>16}{'new append µs':>16}{'new含写盘 µs/条':>18}")
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            prefill(path, size)
+            megabytes = os.path.getsize(path) / 1024 / 1024
+            old = bench_old(path, args.old_appends) if args.old_appends else None
+            prefill(path, size)
+            new = bench_new(path, args.appends)
+            old_text = f"{old:.0f}" if old else "-"
+            print(f"{size:>10}{megabytes:>9.1f}{old_text:>16}{new['append_us']:>16.2f}{new['total_us']:>18.2f}")
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# tools/bench_llm_client.py
+"""
+对比聊天接口里两种调用DeepSeek的方式在多用户并发下的延迟
+- sync：async接口里直接调用同步的OpenAI客户端（改造前的写法，一次调用期间整个事件循环被卡住）
+- async：nua_llm.chat_completion（共享的AsyncOpenAI客户端）
+两种方式各起一个只有 POST /chat 的FastAPI服务（uvicorn跑在后台线程里），都连 tools/fake_deepseek.py，
+users个用户同时不停地发请求，报告每个请求的p50/p99和吞吐
+
+用法：python tools/bench_llm_client.py [--users 50] [--requests 500] [--latency 0.3]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+
+class ChatRequest(BaseModel):
+    message: str
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} 没有启动")
+
+
+# ========= 两种接口 =========
+def sync_app(base_url):
+    from openai import OpenAI
+
+    client = OpenAI(api_key="bench", base_url=base_url)
+    app = FastAPI()
+
+    @app.post("/chat")
+    async def chat(request: ChatRequest):
+        response = client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[{"role": "user", "content": request.message}],
+            max_tokens=200,
+        )
+        return {"reply": response.choices[0].message.content}
+
+    return app
+
+
+def async_app(base_url):
+    import nua_llm
+
+    app = FastAPI()
+
+    @app.post("/chat")
+    async def chat(request: ChatRequest):
+        reply = await nua_llm.chat_completion(
+            messages=[{"role": "user", "content": request.message}],
+            max_tokens=200,
+            endpoint="bench",
+            coalesce=False,
+        )
+        return {"reply": reply}
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await nua_llm.close_client()
+
+    return app
+
+
+# ========= 压测 =========
+async def drive(url, users, requests):
+    samples = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def user(client, n):
+        nonlocal errors
+        for i in counter:
+            t0 = time.perf_counter()
+            try:
+                response = await client.post(url, json={"message": f"用户{n}的第{i}句话"})
+                response.raise_for_status()
+                samples.append((time.perf_counter() - t0) * 1000)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(user(client, n) for n in range(users)))
+        elapsed = time.perf_counter() - started
+    return samples, errors, elapsed
+
+
+def run(name, app, args):
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{name} 服务没有启动")
+        time.sleep(0.05)
+    try:
+        samples, errors, elapsed = asyncio.run(drive(f"{url}/chat", args.users, args.requests))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+    return {
+        "mode": name,
+        "requests": len(samples),
+        "errors": errors,
+        "p50_ms": round(statistics.median(samples), 1) if samples else None,
+        "p99_ms": round(percentile(samples, 0.99), 1) if samples else None,
+        "requests_per_s": round(len(samples) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同步/异步DeepSeek客户端的并发延迟对比")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500, help="每种方式的请求总数")
+    parser.add_argument("--latency", type=float, default=0.3, help="假DeepSeek的固定延迟（秒）")
+    parser.add_argument("--modes", default="sync,async")
+    args = parser.parse_args()
+
+    fake_port = free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "tools", "fake_deepseek.py"), "--port", str(fake_port),
+        "--latency", str(args.latency), "--latency-dist", "fixed",
+    ])
+    # 只比较客户端：准入名额给够，不让排队和合并影响结果
+    os.environ.update({
+        "DEEPSEEK_BASE_URL": fake_url,
+        "DEEPSEEK_API_KEY": "bench",
+        "NUA_LLM_MAX_CONCURRENCY": str(args.users),
+        "NUA_LLM_MAX_CONNECTIONS": str(max(args.users, 100)),
+        "NUA_LOG_LEVEL": os.environ.get("NUA_LOG_LEVEL", "WARNING"),
+    })
+    try:
+        wait_http(f"{fake_url}/stats")
+        apps = {"sync": sync_app, "async": async_app}
+        results = [run(name, apps[name](fake_url), args) for name in args.modes.split(",")]
+    finally:
+        fake.terminate()
+        fake.wait(timeout=15)
+
+    print(f"📊 {args.users}个并发用户，DeepSeek延迟{args.latency * 1000:.0f}ms")
+    print(f"{'方式':<8}{'请求':>7}{'错误':>6}{'p50ms':>10}{'p99ms':>10}{'每秒':>9}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['requests']:>7}{r['errors']:>6}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['requests_per_s']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# tools/bench_storage.py
+"""
+对比每个请求的存储耗时：每用户一个JSON文件 + JSONL日志 vs SQLite(WAL)
+一个“请求”= 读用户记忆 + 写回记忆 + 追加一条日志（绕过内存缓存，直接测磁盘层）
+
+用法：python tools/bench_storage.py [--users 20000] [--requests 5000] [--dir /tmp/nua-bench]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nua_storage import SqliteDatabase
+from nua_memory import JsonDirBackend, SqliteBackend, default_memory
+from nua_chat_log import ChatLogWriter, SqliteChatLogWriter
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def run(name, backend, chat_log, users, requests):
+    # 预先写入所有用户，模拟已有大量访客的目录/表
+    backend.save_many({
+        user_id: json.dumps(default_memory(), ensure_ascii=False, indent=2) for user_id in users
+    })
+
+    samples = []
+    started = time.perf_counter()
+    for i in range(requests):
+        user_id = random.choice(users)
+        t0 = time.perf_counter()
+        memory = backend.load(user_id) or default_memory()
+        memory["close_mode_count"] = memory.get("close_mode_count", 0) + 1
+        backend.save_many({user_id: json.dumps(memory, ensure_ascii=False, indent=2)})
+        chat_log.append(user_id, f"消息{i}", "🌸 嗯，我在听。", "Asia/Shanghai")
+        samples.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "backend": name,
+        "requests": requests,
+        "p50_ms": round(statistics.median(samples), 3),
+        "p95_ms": round(percentile(samples, 0.95), 3),
+        "p99_ms": round(percentile(samples, 0.99), 3),
+        "requests_per_s": round(requests / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="存储层每请求耗时对比")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--dir", default="/tmp/nua-bench")
+    parser.add_argument("--output", default="", help="结果另存为JSON文件")
+    args = parser.parse_args()
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+    os.makedirs(args.dir)
+    users = [f"user{i:06d}" for i in range(args.users)]
+
+    results = []
+    results.append(run(
+        "json-files",
+        JsonDirBackend(os.path.join(args.dir, "user_memories")),
+        ChatLogWriter(os.path.join(args.dir, "nua_chat_logs.jsonl")),
+        users, args.requests
+    ))
+
+    db = SqliteDatabase(os.path.join(args.dir, "nua.db"))
+    try:
+        results.append(run("sqlite-wal", SqliteBackend(db), SqliteChatLogWriter(db), users, args.requests))
+    finally:
+        db.close()
+
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
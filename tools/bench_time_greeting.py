@@ -0,0 +1,137 @@
+# tools/bench_time_greeting.py
+"""
+问候语每次调用的耗时：改造前 vs nua_time，覆盖zoneinfo.available_timezones()里的所有时区
+- old：改造前的get_time_greeting（每次import pytz、pytz.timezone()、三行print、两次utcnow）
+  print写到/dev/null，和线上写stdout一样计入耗时
+- new：nua_time.get_time_greeting（tzinfo的LRU缓存 + 按小时查表，调试输出走logger）
+每个时区先各调用一次（new的首次调用要建tzinfo，单独报告），再各调用calls次取中位数
+同时核对两边给出的问候语一致
+
+用法：python tools/bench_time_greeting.py [--calls 200]
+需要pytz（requirements.txt里有）和系统时区数据
+"""
+import argparse
+import contextlib
+import logging
+import os
+import statistics
+import sys
+import time
+import zoneinfo
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nua_time
+
+
+# ========= 改造前的实现（照搬原来的写法） =========
+def old_get_user_local_time(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
+    try:
+        if local_time_str:
+            try:
+                now = datetime.now()
+                time_parts = local_time_str.split(':')
+                if len(time_parts) >= 2:
+                    hour = int(time_parts[0])
+                    minute = int(time_parts[1])
+                    return now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            except:
+                pass
+
+        try:
+            import pytz
+            if timezone_str and timezone_str != "Asia/Shanghai":
+                tz = pytz.timezone(timezone_str)
+                return datetime.now(tz)
+        except ImportError:
+            print("⚠️ pytz未安装，使用时区偏移计算")
+        except Exception as e:
+            print(f"⚠️ 时区转换错误: {e}")
+
+        if offset is not None:
+            utc_now = datetime.utcnow()
+            return utc_now + timedelta(hours=offset)
+
+    except Exception as e:
+        print(f"⚠️ 时区计算错误: {e}")
+
+    utc_now = datetime.utcnow()
+    return utc_now + timedelta(hours=8)
+
+
+def old_get_time_greeting(timezone_str="Asia/Shanghai", offset=None, local_time_str=None):
+    local_time = old_get_user_local_time(timezone_str, offset, local_time_str)
+    hour = local_time.hour
+    minute = local_time.minute
+
+    print(f"🌍 用户时区: {timezone_str}")
+    print(f"🕐 用户当地时间: {hour}:{minute:02d}")
+    print(f"⚠️ 服务器UTC时间: {datetime.utcnow().hour}:{datetime.utcnow().minute:02d}")
+
+    if 5 <= hour < 11:
+        return "早安", "☀️"
+    elif 11 <= hour < 13:
+        return "午安", "🍱"
+    elif 13 <= hour < 18:
+        return "下午好", "☕"
+    elif 18 <= hour < 22:
+        return "晚上好", "🌙"
+    elif 22 <= hour < 24:
+        return "夜深了", "🌃"
+    else:
+        return "还没睡呀", "🌃"
+
+
+def per_call_us(fn, zone, calls):
+    samples = []
+    for _ in range(calls):
+        t0 = time.perf_counter()
+        fn(zone, 8)
+        samples.append((time.perf_counter() - t0) * 1e6)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="问候语耗时：改造前 vs nua_time，覆盖所有IANA时区")
+    parser.add_argument("--calls", type=int, default=200, help="每个时区调用多少次")
+    args = parser.parse_args()
+
+    # 线上默认INFO，nua_time的调试输出不会真正格式化
+    logging.basicConfig(level=logging.INFO)
+    zones = sorted(zoneinfo.available_timezones())
+    nua_time.get_tzinfo.cache_clear()
+
+    mismatches = []
+    first_new = []
+    old_us, new_us = [], []
+    with open(os.devnull, "w", encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        for zone in zones:
+            old_greeting = old_get_time_greeting(zone, 8)
+            t0 = time.perf_counter()
+            new_greeting = nua_time.get_time_greeting(zone, 8)
+            first_new.append((time.perf_counter() - t0) * 1e6)
+            if old_greeting != new_greeting:
+                mismatches.append((zone, old_greeting, new_greeting))
+            old_us.append(per_call_us(old_get_time_greeting, zone, args.calls))
+            new_us.append(per_call_us(nua_time.get_time_greeting, zone, args.calls))
+
+    print(f"🌍 {len(zones)}个时区，每个调用{args.calls}次（每时区取中位数，再看所有时区的分布）")
+    print(f"{'':>14}{'p50 µs':>10}{'p99 µs':>10}{'最大 µs':>10}")
+    for name, samples in (("old", old_us), ("new 首次", first_new), ("new", new_us)):
+        ordered = sorted(samples)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        print(f"{name:>14}{statistics.median(samples):>10.2f}{p99:>10.2f}{max(samples):>10.2f}")
+    print(f"⚡ 每次调用中位数加速 {statistics.median(old_us) / statistics.median(new_us):.1f}x")
+    if mismatches:
+        # new优先用zoneinfo（系统tzdata），old用pytz自带的数据：两份数据不同或pytz不认识的时区会不一致；
+        # 正好跨过整点时也可能差一个小时
+        print(f"⚠️ {len(mismatches)}个时区问候语不一致（时区数据来源不同）:")
+        for zone, old_greeting, new_greeting in mismatches:
+            print(f"   {zone}: old={old_greeting} new={new_greeting}")
+    else:
+        print("✅ 所有时区两边的问候语一致")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# tools/check_disconnect.py
+"""
+检查客户端断开后，进行中的DeepSeek调用会被取消，这次的回复不会写进历史、日志和记忆
+- 在临时目录里用uvicorn起main.app（真实的HTTP连接，断开才会变成http.disconnect）
+- 不调用DeepSeek：换成假客户端，每次调用要upstream秒才回，记下是否被取消
+- /chat：客户端timeout秒后断开；/chat/stream：收到第一个片段后断开
+- 中间件吃掉http.disconnect（如BaseHTTPMiddleware）时，这里会看到调用一直跑到结束
+
+用法：python tools/check_disconnect.py [--timeout 1] [--upstream 4]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SlowCompletions:
+    """假的chat.completions：普通调用和流式调用都要upstream秒，记下每次调用的结局"""
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.calls = []   # [{"stream": bool, "outcome": "running"/"cancelled"/"finished", "seconds": float}]
+
+    async def create(self, messages, stream=False, **kwargs):
+        call = {"stream": stream, "outcome": "running", "started": time.monotonic()}
+        self.calls.append(call)
+        if stream:
+            return self._stream(call)
+        await self._wait(call)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="迟到的回复"))],
+            usage=None,
+        )
+
+    async def _wait(self, call):
+        try:
+            await asyncio.sleep(self.upstream)
+        except asyncio.CancelledError:
+            call["outcome"] = "cancelled"
+            raise
+        finally:
+            call["seconds"] = time.monotonic() - call["started"]
+        call["outcome"] = "finished"
+
+    def _stream(self, call):
+        async def chunks():
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="嗯"))], usage=None)
+            await self._wait(call)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="迟到的回复"))], usage=None)
+
+        generator = chunks()
+
+        class Stream:
+            def __aiter__(self):
+                return generator
+
+            response = SimpleNamespace(aclose=generator.aclose)
+
+        return Stream()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客户端断开后取消DeepSeek调用的检查")
+    parser.add_argument("--timeout", type=float, default=1.0, help="/chat客户端等多久就断开（秒）")
+    parser.add_argument("--upstream", type=float, default=4.0, help="假DeepSeek每次调用的耗时（秒）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nua-disconnect-")
+    os.chdir(workdir)
+    os.environ.update({
+        "NUA_RATE_LIMIT": "0",
+        "DEEPSEEK_API_KEY": os.environ.get("DEEPSEEK_API_KEY", "offline"),
+        "NUA_LOG_LEVEL": os.environ.get("NUA_LOG_LEVEL", "CRITICAL"),
+    })
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "nua-chat")]
+
+    import httpx
+    import uvicorn
+    import nua_llm
+    completions = SlowCompletions(args.upstream)
+    nua_llm._client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    import main as nua
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(nua.app, host="127.0.0.1", port=port, log_level="critical"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    url = f"http://127.0.0.1:{port}"
+
+    failures = []
+    try:
+        # ===== /chat：等不及就断开 =====
+        try:
+            httpx.post(f"{url}/chat", json={"message": "在吗", "user_id": "gone-chat"}, timeout=args.timeout)
+            failures.append("/chat 在客户端断开之前就返回了，调大--upstream")
+        except httpx.TimeoutException:
+            pass
+
+        # ===== /chat/stream：收到第一个片段就断开 =====
+        with httpx.stream("POST", f"{url}/chat/stream", json={"message": "在吗", "user_id": "gone-stream"},
+                          timeout=args.upstream * 2) as response:
+            for line in response.iter_lines():
+                if line.startswith("data:"):
+                    break
+
+        # 留足时间：没被取消的调用会在这期间跑完并收尾
+        time.sleep(args.upstream + 1)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+
+    try:
+        logged = []
+        if os.path.exists(nua.LOG_FILE):
+            with open(nua.LOG_FILE, "r", encoding="utf-8") as f:
+                logged = [json.loads(line)["user_id"] for line in f if line.strip()]
+
+        print(f"🔌 客户端断开检查（/chat {args.timeout}s后断开，上游每次{args.upstream}s）")
+        for path, call, user_id in zip(("/chat", "/chat/stream"), completions.calls, ("gone-chat", "gone-stream")):
+            replies = [m for m in nua.user_conversations.get(user_id) if m["role"] == "assistant"]
+            memory = nua.memory_store.get(user_id)
+            print(f"   {path:<14}上游调用{call['outcome']}（{call.get('seconds', 0):.1f}s），"
+                  f"历史里的回复{len(replies)}条，日志{logged.count(user_id)}条，"
+                  f"记忆里{'有' if memory.get('last_active') else '没有'}这次的时区")
+            if call["outcome"] != "cancelled":
+                failures.append(f"{path}：客户端断开后上游调用没有被取消（{call['outcome']}）")
+            if replies or user_id in logged or memory.get("last_active"):
+                failures.append(f"{path}：客户端断开后这次的回复仍被写进了历史/日志/记忆")
+        if len(completions.calls) < 2:
+            failures.append(f"只收到{len(completions.calls)}次上游调用，应为2次")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        sys.exit(1)
+    print("✅ 客户端断开后上游调用被取消，回复没有写进历史、日志和记忆")
+
+
+if __name__ == "__main__":
+    main()
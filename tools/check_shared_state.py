@@ -0,0 +1,116 @@
+# tools/check_shared_state.py
+"""
+检查多worker共享状态：同一个用户的连续请求轮流落到N个独立进程上，对话和记忆不能断
+- 每个worker是一个独立进程，各自导入main.py（和uvicorn --workers N一样互不共享内存）
+- 请求不粘连：第t轮由 (t + 用户序号) % N 号worker处理
+- 每轮检查：该worker读到的历史条数、记忆版本号，以及发给DeepSeek的消息里带着之前的对话
+- 不调用DeepSeek：worker里换成离线的假客户端
+- 保存记忆、写历史在响应后的工作队列里做，每轮等它做完再发下一轮（相当于用户打字的间隔）
+
+用法：python tools/check_shared_state.py [--workers 4] [--users 5] [--turns 6] [--state sqlite]
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class OfflineCompletions:
+    """假的chat.completions：回复里带上收到了几条历史对话"""
+
+    async def create(self, messages, **kwargs):
+        history = [m for m in messages[1:] if m["role"] != "system"][:-1]
+        content = f"（收到{len(history)}条历史）"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=None,
+        )
+
+
+def worker(index, workdir, state, commands, results):
+    os.chdir(workdir)
+    os.environ.update({
+        "NUA_SHARED_STATE": state,
+        "NUA_STORAGE_DB": os.path.join(workdir, "nua.db"),
+        "DEEPSEEK_API_KEY": os.environ.get("DEEPSEEK_API_KEY", "offline"),
+        "NUA_LOG_LEVEL": "WARNING",
+    })
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "nua-chat")]
+
+    import nua_llm
+    nua_llm._client = SimpleNamespace(chat=SimpleNamespace(completions=OfflineCompletions()))
+    import main
+    from fastapi.testclient import TestClient
+
+    with TestClient(main.app) as client:
+        for user_id, message in iter(commands.get, None):
+            seen = len(main.user_conversations.get(user_id))
+            version = main.memory_store.get(user_id).get("_version", 0)
+            reply = client.post("/chat", json={"message": message, "user_id": user_id}).json()["reply"]
+            client.portal.call(main.post_response.join)
+            results.put((index, user_id, seen, version, reply))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多worker共享状态检查")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--state", default="sqlite", choices=["sqlite", "redis"])
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    from nua_conversations import HISTORY_LENGTH
+
+    workdir = tempfile.mkdtemp(prefix="nua-shared-")
+    ctx = multiprocessing.get_context("spawn")
+    commands = [ctx.Queue() for _ in range(args.workers)]
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=worker, args=(i, workdir, args.state, commands[i], results), daemon=True)
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    failures = []
+    served_by = set()
+    try:
+        users = [f"shared-user-{i}" for i in range(args.users)]
+        for turn in range(args.turns):
+            for n, user_id in enumerate(users):
+                target = (turn + n) % args.workers
+                commands[target].put((user_id, f"第{turn + 1}句话"))
+                index, _, seen, version, reply = results.get(timeout=60)
+                served_by.add(index)
+
+                # 每轮新增用户的一句和多多的一句
+                expected = min(2 * turn, HISTORY_LENGTH)
+                if seen != expected:
+                    failures.append(f"{user_id} 第{turn + 1}轮 worker{index}：历史{seen}条，应为{expected}条")
+                if version != turn:
+                    failures.append(f"{user_id} 第{turn + 1}轮 worker{index}：记忆版本{version}，应为{turn}")
+                if turn and "（收到0条历史）" in reply:
+                    failures.append(f"{user_id} 第{turn + 1}轮 worker{index}：发给模型的消息没有带上历史")
+    finally:
+        for queue in commands:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"🧪 {args.workers}个worker，{args.users}个用户 × {args.turns}轮，实际处理请求的worker：{sorted(served_by)}")
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        sys.exit(1)
+    print("✅ 对话历史和用户记忆在所有worker之间保持连续")
+
+
+if __name__ == "__main__":
+    main()
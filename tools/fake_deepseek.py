@@ -0,0 +1,220 @@
+# tools/fake_deepseek.py
+"""
+本地的假DeepSeek（OpenAI兼容的 /chat/completions），离线压测用
+- 延迟：fixed / uniform / lognormal 分布，可以让一部分请求卡住模拟超时
+- 按比例返回错误（默认500，可改成429/503）
+- 支持stream=True（SSE，逐段输出，最后一段带usage）
+- usage里的token数按nua_prompt的估算方式计算，并模拟DeepSeek的前缀缓存
+  （和之前某个请求的前几条消息完全相同时，这部分算prompt_cache_hit_tokens）
+- GET /stats 返回请求数、错误数、最大并发
+
+用法：python tools/fake_deepseek.py [--port 8765] [--latency 0.8] [--latency-dist lognormal]
+                                   [--error-rate 0.02] [--completion-tokens 40]
+然后：DEEPSEEK_BASE_URL=http://127.0.0.1:8765 DEEPSEEK_API_KEY=fake uvicorn nua-chat.main:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from nua_prompt import estimate_tokens, message_tokens
+
+REPLY_PHRASES = [
+    "我在这里。", "慢慢说，我听着。", "今天的风很轻。", "先喝口水吧。",
+    "嗯，我明白。", "这样的时刻也很好。", "不着急，我陪着你。", "窗外的光正好。",
+]
+# 前缀缓存最多记多少个不同的前缀
+PREFIX_CACHE_SIZE = 100000
+
+
+class FakeDeepSeek:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self._prefixes = OrderedDict()
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "hangs": 0,
+                      "inflight": 0, "max_inflight": 0}
+
+    # ===== 延迟和错误 =====
+    def latency(self):
+        args = self.args
+        if args.latency_dist == "fixed":
+            value = args.latency
+        elif args.latency_dist == "uniform":
+            value = self.rng.uniform(args.latency - args.latency_spread, args.latency + args.latency_spread)
+        else:
+            # latency是中位数，spread是对数标准差
+            value = args.latency * math.exp(self.rng.gauss(0, args.latency_spread))
+        return max(0.0, value)
+
+    def error(self):
+        return self.rng.random() < self.args.error_rate
+
+    def hang(self):
+        return self.rng.random() < self.args.hang_rate
+
+    # ===== token =====
+    def prompt_usage(self, messages):
+        """按消息逐条累计前缀哈希，命中过的最长前缀算缓存命中"""
+        total = sum(message_tokens(m) for m in messages)
+        digest = hashlib.sha256()
+        used = hit = 0
+        for message in messages:
+            digest.update(json.dumps([message.get("role"), message.get("content")], ensure_ascii=False).encode("utf-8"))
+            used += message_tokens(message)
+            key = digest.hexdigest()
+            if key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                hit = used
+            else:
+                self._prefixes[key] = True
+        while len(self._prefixes) > PREFIX_CACHE_SIZE:
+            self._prefixes.popitem(last=False)
+        return total, hit
+
+    def reply_text(self):
+        target = max(1, int(self.rng.gauss(self.args.completion_tokens, self.args.completion_tokens * 0.25)))
+        parts = []
+        while estimate_tokens("".join(parts)) < target:
+            parts.append(self.rng.choice(REPLY_PHRASES))
+        return "".join(parts)
+
+    def usage(self, messages, content):
+        prompt, hit = self.prompt_usage(messages)
+        completion = estimate_tokens(content)
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+            "prompt_cache_hit_tokens": hit,
+            "prompt_cache_miss_tokens": prompt - hit,
+        }
+
+
+def create_app(fake):
+    app = FastAPI(title="fake-deepseek")
+
+    def error_response():
+        fake.stats["errors"] += 1
+        status = fake.args.error_status
+        return JSONResponse(
+            {"error": {"message": "fake upstream error", "type": "server_error", "code": status}},
+            status_code=status,
+        )
+
+    async def completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        model = body.get("model", "deepseek-chat")
+        fake.stats["requests"] += 1
+        fake.stats["inflight"] += 1
+        fake.stats["max_inflight"] = max(fake.stats["max_inflight"], fake.stats["inflight"])
+        streaming = False
+        try:
+            if fake.hang():
+                fake.stats["hangs"] += 1
+                await asyncio.sleep(fake.args.hang_seconds)
+            # 流式时latency是首个片段前的等待
+            await asyncio.sleep(fake.latency())
+            if fake.error():
+                return error_response()
+
+            content = fake.reply_text()
+            usage = fake.usage(messages, content)
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+            created = int(time.time())
+
+            if not body.get("stream"):
+                return JSONResponse({
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+
+            fake.stats["streams"] += 1
+            streaming = True   # 流发完时再减在途数
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            return StreamingResponse(
+                stream(completion_id, created, model, content, usage if include_usage else None),
+                media_type="text/event-stream",
+            )
+        finally:
+            if not streaming:
+                fake.stats["inflight"] -= 1
+
+    async def stream(completion_id, created, model, content, usage):
+        def chunk(choices, **extra):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                    "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        try:
+            yield chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            step = max(1, fake.args.stream_chunk_chars)
+            for i in range(0, len(content), step):
+                await asyncio.sleep(fake.args.stream_chunk_delay)
+                yield chunk([{"index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None}])
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if usage is not None:
+                yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+        finally:
+            fake.stats["inflight"] -= 1
+
+    # DeepSeek的base_url不带/v1，OpenAI的带，两个都接
+    app.add_api_route("/chat/completions", completions, methods=["POST"])
+    app.add_api_route("/v1/chat/completions", completions, methods=["POST"])
+
+    @app.get("/stats")
+    async def stats():
+        return fake.stats
+
+    return app
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="假的DeepSeek服务（OpenAI兼容）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.8, help="延迟（秒）：fixed为固定值，其余为中位数/中心")
+    parser.add_argument("--latency-dist", default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--latency-spread", type=float, default=0.5,
+                        help="uniform为±秒数，lognormal为对数标准差")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的比例")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="卡住hang-seconds秒的比例（模拟超时）")
+    parser.add_argument("--hang-seconds", type=float, default=60)
+    parser.add_argument("--completion-tokens", type=int, default=40, help="回复的平均token数")
+    parser.add_argument("--stream-chunk-chars", type=int, default=2)
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    uvicorn.run(create_app(FakeDeepSeek(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
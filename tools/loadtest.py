@@ -0,0 +1,424 @@
+# tools/loadtest.py
+"""
+端到端压测：按设定的比例请求 /chat、/chat/stream、/divination、/、管理接口
+报告每个接口的吞吐、p50/p95/p99、错误数，以及服务进程的内存增长；结果存成JSON方便跨提交对比
+
+两种用法：
+1. 不给--url：自动在临时目录启动 tools/fake_deepseek.py 和 NUA（uvicorn），压完关掉
+   python tools/loadtest.py --duration 30 --concurrency 50 --output results/$(git rev-parse --short HEAD).json
+2. 压一个已经在跑的服务（内存增长只在本机、给了--pid时统计）
+   python tools/loadtest.py --url http://127.0.0.1:8000 --pid 12345
+
+对比两次结果：python tools/loadtest.py --compare results/old.json results/new.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 默认的请求比例
+DEFAULT_MIX = "chat=55,stream=10,divination=15,home=10,admin=10"
+
+# ========= 模拟用户说的话 =========
+CHAT_MESSAGES = [
+    "今天好累啊", "有点难过", "今天好开心！", "睡不着", "我叫小林", "想你了",
+    "外面下雨了", "刚下班", "你在干嘛", "没什么，就是想说说话", "好烦",
+    "晚安", "早上好", "最近压力好大", "谢谢你", "想占卜一下", "挺准的", "不准",
+]
+DIVINATIONS = [
+    ("塔罗", lambda rng: rng.sample(range(1, 23), 3)),
+    ("梅花易数", lambda rng: [rng.randint(1, 8), rng.randint(1, 8)]),
+    ("轻占卜", lambda rng: [rng.choice(["红", "蓝", "绿", "黄", "紫"]), rng.randint(1, 10)]),
+]
+QUESTIONS = ["", "", "最近的工作", "感情会好吗", "明天顺利吗"]
+ADMIN_ROUTES = ["/health", "/metrics", "/admin/llm", "/admin/stats", "/admin/cache", "/admin/logs?limit=20"]
+TIMEZONES = [("Asia/Shanghai", 8), ("America/New_York", -5), ("Europe/London", 0), ("Asia/Tokyo", 9)]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight)
+    unknown = set(mix) - {"chat", "stream", "divination", "home", "admin"}
+    if unknown:
+        raise SystemExit(f"未知的请求类型: {sorted(unknown)}")
+    return mix
+
+
+# ========= 内存（读/proc，只支持Linux） =========
+def rss_bytes(pid):
+    """进程及其子进程（uvicorn --workers）的常驻内存之和"""
+    total = 0
+    for p in [pid] + child_pids(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            pass
+    return total or None
+
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+# ========= 压测客户端 =========
+class LoadTest:
+    def __init__(self, args, base_url):
+        self.args = args
+        self.base_url = base_url
+        self.mix = parse_mix(args.mix)
+        self.rng = random.Random(args.seed)
+        self.samples = {}   # 接口 -> [耗时秒]
+        self.errors = {}    # 接口 -> {状态: 次数}
+        self.first_byte = []
+        # 少数活跃用户发得多（近似真实分布）
+        self.users = [f"load-{i:05d}" for i in range(args.users)]
+        self.user_weights = [1 / (i + 1) ** 0.8 for i in range(args.users)]
+
+    def pick_user(self):
+        return self.rng.choices(self.users, self.user_weights)[0]
+
+    def chat_body(self):
+        timezone, offset = self.rng.choice(TIMEZONES)
+        return {
+            "message": self.rng.choice(CHAT_MESSAGES),
+            "user_id": self.pick_user(),
+            "timezone": timezone,
+            "timezone_offset": offset,
+            "local_time": time.strftime("%H:%M:%S"),
+        }
+
+    def record(self, name, elapsed, status):
+        self.samples.setdefault(name, []).append(elapsed)
+        if status >= 400:
+            errors = self.errors.setdefault(name, {})
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+    async def one(self, client, kind):
+        started = time.perf_counter()
+        status = 0
+        try:
+            if kind == "chat":
+                response = await client.post("/chat", json=self.chat_body())
+                status = response.status_code
+            elif kind == "stream":
+                async with client.stream("POST", "/chat/stream", json=self.chat_body()) as response:
+                    status = response.status_code
+                    first = None
+                    async for _ in response.aiter_bytes():
+                        if first is None:
+                            first = time.perf_counter() - started
+                    if first is not None:
+                        self.first_byte.append(first)
+            elif kind == "divination":
+                method, params = self.rng.choice(DIVINATIONS)
+                response = await client.post("/divination", json={
+                    "user_id": self.pick_user(), "method": method,
+                    "params": params(self.rng), "question": self.rng.choice(QUESTIONS),
+                })
+                status = response.status_code
+            elif kind == "home":
+                response = await client.get("/", headers={"Accept-Encoding": "gzip"})
+                status = response.status_code
+            else:
+                path = self.rng.choice(ADMIN_ROUTES)
+                kind = path.split("?")[0]   # 管理接口按路径分别统计
+                response = await client.get(path)
+                status = response.status_code
+        except httpx.HTTPError as e:
+            status = 599
+            if self.args.verbose:
+                print(f"⚠️ {kind}: {e!r}")
+        self.record(kind, time.perf_counter() - started, status)
+
+    async def worker(self, client, deadline):
+        kinds = list(self.mix)
+        weights = [self.mix[k] for k in kinds]
+        while time.monotonic() < deadline:
+            await self.one(client, self.rng.choices(kinds, weights)[0])
+
+    async def run(self, duration):
+        limits = httpx.Limits(max_connections=self.args.concurrency, max_keepalive_connections=self.args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.args.timeout, limits=limits) as client:
+            deadline = time.monotonic() + duration
+            started = time.perf_counter()
+            await asyncio.gather(*(self.worker(client, deadline) for _ in range(self.args.concurrency)))
+            return time.perf_counter() - started
+
+    def report(self, elapsed):
+        routes = {}
+        for name, samples in sorted(self.samples.items()):
+            errors = self.errors.get(name, {})
+            routes[name] = {
+                "requests": len(samples),
+                "errors": sum(errors.values()),
+                "error_statuses": errors,
+                "requests_per_s": round(len(samples) / elapsed, 2),
+                "p50_ms": round(statistics.median(samples) * 1000, 1),
+                "p95_ms": round(percentile(samples, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 0.99) * 1000, 1),
+                "max_ms": round(max(samples) * 1000, 1),
+            }
+        if self.first_byte and "stream" in routes:
+            routes["stream"]["first_byte_p50_ms"] = round(statistics.median(self.first_byte) * 1000, 1)
+            routes["stream"]["first_byte_p95_ms"] = round(percentile(self.first_byte, 0.95) * 1000, 1)
+        total = sum(len(s) for s in self.samples.values())
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests": total,
+            "errors": sum(r["errors"] for r in routes.values()),
+            "requests_per_s": round(total / elapsed, 2),
+            "routes": routes,
+        }
+
+
+# ========= 自动启动假DeepSeek和NUA =========
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} 没有启动")
+
+
+def start_services(args, workdir):
+    fake_port, app_port = free_port(), free_port()
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "tools", "fake_deepseek.py"),
+        "--port", str(fake_port),
+        "--latency", str(args.llm_latency), "--latency-dist", args.llm_latency_dist,
+        "--latency-spread", str(args.llm_latency_spread),
+        "--error-rate", str(args.llm_error_rate), "--completion-tokens", str(args.llm_tokens),
+    ] + (["--seed", str(args.seed)] if args.seed is not None else []))
+
+    # 数据文件都写在临时目录里；nua-chat链接过去，首页和Procfile里的模块路径都照常可用
+    os.symlink(os.path.join(ROOT, "nua-chat"), os.path.join(workdir, "nua-chat"))
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])),
+        "DEEPSEEK_BASE_URL": f"http://127.0.0.1:{fake_port}",
+        "DEEPSEEK_API_KEY": "loadtest",
+        "NUA_LOG_LEVEL": os.environ.get("NUA_LOG_LEVEL", "WARNING"),
+    }
+    if args.shared_state:
+        env["NUA_SHARED_STATE"] = args.shared_state
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "nua-chat.main:app", "--host", "127.0.0.1",
+         "--port", str(app_port), "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=workdir, env=env,
+    )
+    wait_http(f"http://127.0.0.1:{fake_port}/stats")
+    wait_http(f"http://127.0.0.1:{app_port}/health")
+    return fake, app, f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fetch_json(url):
+    try:
+        return httpx.get(url, timeout=5).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+def run(args):
+    workdir = None
+    fake = app = None
+    fake_url = None
+    base_url = args.url
+    pid = args.pid
+    if base_url is None:
+        workdir = tempfile.mkdtemp(prefix="nua-load-")
+        fake, app, fake_url, base_url = start_services(args, workdir)
+        pid = app.pid
+
+    try:
+        test = LoadTest(args, base_url)
+        if args.warmup > 0:
+            asyncio.run(test.run(args.warmup))
+            test.samples.clear()
+            test.errors.clear()
+            test.first_byte.clear()
+
+        memory = {"rss_start_bytes": rss_bytes(pid) if pid else None}
+        peak = memory["rss_start_bytes"] or 0
+
+        async def sample_memory(stop_event):
+            nonlocal peak
+            while not stop_event.is_set():
+                peak = max(peak, rss_bytes(pid) or 0)
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+        async def main_run():
+            stop_event = asyncio.Event()
+            sampler = asyncio.create_task(sample_memory(stop_event)) if pid else None
+            elapsed = await test.run(args.duration)
+            stop_event.set()
+            if sampler:
+                await sampler
+            return elapsed
+
+        elapsed = asyncio.run(main_run())
+        if pid:
+            memory["rss_end_bytes"] = rss_bytes(pid)
+            memory["rss_peak_bytes"] = max(peak, memory["rss_end_bytes"] or 0)
+            if memory["rss_start_bytes"] and memory["rss_end_bytes"]:
+                memory["rss_growth_bytes"] = memory["rss_end_bytes"] - memory["rss_start_bytes"]
+
+        result = {
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("compare", "output", "verbose")},
+            **test.report(elapsed),
+            "memory": memory,
+            "server": {
+                "llm": fetch_json(f"{base_url}/admin/llm"),
+                "fake_deepseek": fetch_json(f"{fake_url}/stats") if fake_url else None,
+            },
+        }
+    finally:
+        if app is not None:
+            stop(app)
+        if fake is not None:
+            stop(fake)
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def print_result(result):
+    print(f"📊 {result['revision']}  {result['elapsed_s']}s  {result['requests']}个请求  "
+          f"{result['requests_per_s']}/s  错误{result['errors']}")
+    print(f"{'接口':<14}{'请求':>8}{'错误':>6}{'每秒':>9}{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}")
+    for name, r in result["routes"].items():
+        print(f"{name:<14}{r['requests']:>8}{r['errors']:>6}{r['requests_per_s']:>9}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+    memory = result["memory"]
+    if memory.get("rss_end_bytes"):
+        print(f"💾 RSS {memory['rss_start_bytes'] / 2**20:.1f}MB -> {memory['rss_end_bytes'] / 2**20:.1f}MB"
+              f"（峰值 {memory['rss_peak_bytes'] / 2**20:.1f}MB）")
+
+
+def compare(old_path, new_path):
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"📊 {old.get('revision')} -> {new.get('revision')}")
+
+    def delta(a, b):
+        if not a:
+            return f"{b}"
+        return f"{a} -> {b} ({(b - a) / a * 100:+.1f}%)"
+
+    print(f"总吞吐/s: {delta(old['requests_per_s'], new['requests_per_s'])}")
+    for name in sorted(set(old["routes"]) | set(new["routes"])):
+        a, b = old["routes"].get(name), new["routes"].get(name)
+        if not a or not b:
+            print(f"{name}: 只在{'新' if b else '旧'}结果里")
+            continue
+        print(f"{name}: p50 {delta(a['p50_ms'], b['p50_ms'])}  p95 {delta(a['p95_ms'], b['p95_ms'])}  "
+              f"p99 {delta(a['p99_ms'], b['p99_ms'])}  每秒 {delta(a['requests_per_s'], b['requests_per_s'])}")
+    old_growth = old.get("memory", {}).get("rss_growth_bytes")
+    new_growth = new.get("memory", {}).get("rss_growth_bytes")
+    if old_growth is not None and new_growth is not None:
+        print(f"内存增长MB: {old_growth / 2**20:.1f} -> {new_growth / 2**20:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NUA端到端压测")
+    parser.add_argument("--url", default=None, help="压已经在跑的服务；不给时自动启动假DeepSeek和NUA")
+    parser.add_argument("--pid", type=int, default=None, help="配合--url统计该进程的内存")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"请求比例（默认 {DEFAULT_MIX}）")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1, help="自动启动时uvicorn的worker数")
+    parser.add_argument("--shared-state", default=None, choices=["sqlite", "redis"],
+                        help="自动启动时的NUA_SHARED_STATE（workers>1时需要）")
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--llm-latency-dist", default="lognormal", choices=["fixed", "uniform", "lognormal"])
+    parser.add_argument("--llm-latency-spread", type=float, default=0.5)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-tokens", type=int, default=40)
+    parser.add_argument("--output", default="", help="结果存成JSON文件")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两次结果")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run(args)
+    print_result(result)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"✅ 结果已保存：{args.output}")
+
+
+if __name__ == "__main__":
+    main()
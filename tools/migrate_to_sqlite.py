@@ -0,0 +1,149 @@
+# tools/migrate_to_sqlite.py
+"""
+一次性把文件存储导入SQLite（NUA_STORAGE=sqlite 之前运行）
+- user_memories/*.json          -> user_memory
+- user_memory_{id}.json（旧版main.py在当前目录留下的时区记录） -> 合并进 user_memory
+- nua_chat_logs*.jsonl          -> chat_logs
+
+可以重复运行：已有的记忆不覆盖，每个日志文件记住导入到的位置，只导入新增的行
+
+用法：python tools/migrate_to_sqlite.py [--db nua.db] [--memory-dir user_memories]
+                                       [--legacy-dir .] [--logs nua_chat_logs.jsonl ...]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nua_storage import SqliteDatabase, STORAGE_DB
+from nua_memory import default_memory
+
+LOG_BATCH = 5000
+
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ 跳过无法读取的文件 {path}: {e}")
+        return None
+
+
+def collect_memories(memory_dir, legacy_dir):
+    memories = {}
+    for path in glob.glob(os.path.join(memory_dir, "*.json")):
+        user_id = os.path.basename(path)[:-len(".json")]
+        data = read_json(path)
+        if isinstance(data, dict):
+            memories[user_id] = data
+
+    # 旧版main.py单独记录的时区和最后活跃时间
+    merged = 0
+    for path in glob.glob(os.path.join(legacy_dir, "user_memory_*.json")):
+        user_id = os.path.basename(path)[len("user_memory_"):-len(".json")]
+        data = read_json(path)
+        if not isinstance(data, dict):
+            continue
+        if user_id not in memories:
+            memories[user_id] = default_memory()
+            memories[user_id].update(
+                {key: data[key] for key in ("timezone", "timezone_offset") if key in data}
+            )
+        memory = memories[user_id]
+        if data.get("last_seen"):
+            memory.setdefault("last_active", data["last_seen"])
+        merged += 1
+    return memories, merged
+
+
+def migrate_memories(db, memories):
+    rows = [
+        (user_id, json.dumps(memory, ensure_ascii=False, indent=2), memory.get("_version", 0))
+        for user_id, memory in memories.items()
+    ]
+    return db.write(lambda conn: conn.executemany(
+        "INSERT OR IGNORE INTO user_memory (user_id, data, version) VALUES (?, ?, ?)", rows
+    ).rowcount)
+
+
+def migrate_log(db, path):
+    """从上次导入的位置继续，只导入完整的行"""
+    key = f"migrated_log:{os.path.abspath(path)}"
+    row = db.query_one("SELECT value FROM storage_meta WHERE key = ?", (key,))
+    offset = int(row[0]) if row else 0
+    if offset > os.path.getsize(path):
+        offset = 0   # 文件被截断或替换过，从头导入
+
+    imported = 0
+    rows = []
+
+    def save(rows, offset):
+        def write(conn):
+            conn.executemany(
+                "INSERT INTO chat_logs (timestamp, user_id, user_message, nua_reply, timezone) "
+                "VALUES (?, ?, ?, ?, ?)", rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO storage_meta (key, value) VALUES (?, ?)", (key, str(offset))
+            )
+        db.write(write)
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            offset += len(raw)
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+            rows.append((
+                entry.get("timestamp") or "",
+                entry.get("user_id"),
+                entry.get("user_message"),
+                entry.get("nua_reply"),
+                entry.get("timezone"),
+            ))
+            if len(rows) >= LOG_BATCH:
+                save(rows, offset)
+                imported += len(rows)
+                rows = []
+    save(rows, offset)
+    return imported + len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把JSON/JSONL文件存储导入SQLite")
+    parser.add_argument("--db", default=STORAGE_DB)
+    parser.add_argument("--memory-dir", default="user_memories")
+    parser.add_argument("--legacy-dir", default=".")
+    parser.add_argument("--logs", nargs="*", default=None,
+                        help="要导入的日志文件（默认：nua_chat_logs*.jsonl，按时间从旧到新）")
+    args = parser.parse_args()
+
+    db = SqliteDatabase(args.db)
+    try:
+        memories, merged = collect_memories(args.memory_dir, args.legacy_dir)
+        inserted = migrate_memories(db, memories)
+        print(f"💾 用户记忆：读取 {len(memories)} 个（合并旧版时区文件 {merged} 个），新导入 {inserted} 个")
+
+        logs = args.logs
+        if logs is None:
+            # 轮转出的文件名带时间戳，排在当前文件前面
+            rotated = sorted(glob.glob("nua_chat_logs-*.jsonl"))
+            logs = rotated + (["nua_chat_logs.jsonl"] if os.path.exists("nua_chat_logs.jsonl") else [])
+        for path in logs:
+            count = migrate_log(db, path)
+            print(f"📝 {path}：导入 {count} 条日志")
+    finally:
+        db.close()
+    print(f"✅ 导入完成：{args.db}")
+
+
+if __name__ == "__main__":
+    main()
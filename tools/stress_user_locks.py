@@ -0,0 +1,137 @@
+# tools/stress_user_locks.py
+"""
+同一批用户的大量并发请求下，每个用户的记忆计数一次都不能丢
+- 在一个进程里起main.app（和uvicorn一样跑startup/shutdown），requests个请求同时打进来，
+  轮流落在users个用户上：/divination（divination.count +1）和 /chat "想你了"（close_mode_count +1）
+- 默认--state sqlite（NUA_SHARED_STATE=sqlite）：每个请求从共享存储读一份自己的记忆、提交时CAS写回，
+  同一用户的读-改-写全靠用户锁串行，少了锁计数就会丢
+  --state local：单进程缓存模式，所有请求拿到同一个缓存dict，测不出锁，只检查write-behind保存
+- 另有一个user_id为"a/b"的用户一起发请求：文件后端存不了它（路径里有分隔符），
+  它保存失败不能拖累同一批的其他用户
+- shutdown（写完所有记忆）之后用新的后端重新读，逐个用户核对计数和发出的请求数一致
+- --no-locks：把用户锁换成每次新建的锁，确认这个检查能发现锁失效（应当失败）
+- 不调用DeepSeek：换成离线的假客户端
+
+用法：python tools/stress_user_locks.py [--requests 1000] [--users 5] [--state sqlite|local]
+                                       [--storage file|sqlite] [--no-locks]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BAD_USER = "a/b"
+
+
+class OfflineCompletions:
+    """假的chat.completions：稍等一下再回复，让同一用户的请求真正交错"""
+
+    async def create(self, messages, **kwargs):
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="嗯嗯，我在呢"))],
+            usage=None,
+        )
+
+
+async def run(args):
+    import httpx
+    import nua_llm
+    nua_llm._client = SimpleNamespace(chat=SimpleNamespace(completions=OfflineCompletions()))
+    import main
+    from nua_memory import create_backend
+    if args.no_locks:
+        main.user_locks.get = lambda user_id: asyncio.Lock()
+
+    users = [f"stress-user-{i}" for i in range(args.users)]
+    plan = []
+    for i in range(args.requests):
+        user_id = users[i % len(users)]
+        kind = "divination" if (i // len(users)) % 2 == 0 else "chat"
+        plan.append((user_id, kind))
+    plan += [(BAD_USER, "divination"), (BAD_USER, "chat")]
+
+    async def send(client, user_id, kind):
+        if kind == "divination":
+            response = await client.post("/divination", json={
+                "user_id": user_id, "method": "梅花易数", "params": [3, 8],
+            })
+        else:
+            response = await client.post("/chat", json={"message": "想你了", "user_id": user_id})
+        response.raise_for_status()
+
+    await main.app.router.startup()
+    started = time.perf_counter()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://stress", timeout=120) as client:
+            results = await asyncio.gather(
+                *(send(client, user_id, kind) for user_id, kind in plan), return_exceptions=True
+            )
+    finally:
+        await main.app.router.shutdown()
+    elapsed = time.perf_counter() - started
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    sent = Counter(plan)
+    backend = create_backend()
+    failures = [f"请求失败: {e!r}" for e in errors[:5]]
+    mode = f"共享状态{args.state}" if args.state != "local" else f"本地缓存，存储{args.storage}"
+    locks = "，不加用户锁" if args.no_locks else ""
+    print(f"🧪 {len(plan)}个并发请求（{args.users}个用户 + {BAD_USER}），{mode}{locks}，用时{elapsed:.2f}s，失败{len(errors)}个")
+    print(f"{'用户':<16}{'占卜':>6}{'count':>7}{'亲近':>6}{'close':>7}")
+    for user_id in users:
+        memory = backend.load(user_id) or {}
+        count = memory.get("divination", {}).get("count", 0)
+        close = memory.get("close_mode_count", 0)
+        print(f"{user_id:<16}{sent[(user_id, 'divination')]:>6}{count:>7}{sent[(user_id, 'chat')]:>6}{close:>7}")
+        if count != sent[(user_id, "divination")]:
+            failures.append(f"{user_id}: divination.count={count}，应为{sent[(user_id, 'divination')]}")
+        if close != sent[(user_id, "chat")]:
+            failures.append(f"{user_id}: close_mode_count={close}，应为{sent[(user_id, 'chat')]}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="同一用户并发请求下的记忆计数检查")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--state", default="sqlite", choices=["sqlite", "local"],
+                        help="NUA_SHARED_STATE；local时所有请求共用缓存里的dict，测不出用户锁")
+    parser.add_argument("--storage", default="file", choices=["file", "sqlite"], help="--state local时的存储")
+    parser.add_argument("--no-locks", action="store_true", help="去掉用户锁，验证这个检查能发现")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nua-stress-")
+    os.chdir(workdir)
+    os.environ.update({
+        "NUA_SHARED_STATE": args.state,
+        "NUA_STORAGE": args.storage if args.state == "local" else "sqlite",
+        "NUA_STORAGE_DB": os.path.join(workdir, "nua.db"),
+        "NUA_RATE_LIMIT": "0",
+        "DEEPSEEK_API_KEY": os.environ.get("DEEPSEEK_API_KEY", "offline"),
+        "NUA_LOG_LEVEL": os.environ.get("NUA_LOG_LEVEL", "CRITICAL"),
+    })
+    sys.path[:0] = [ROOT, os.path.join(ROOT, "nua-chat")]
+    try:
+        failures = asyncio.run(run(args))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        sys.exit(1)
+    print("✅ 每个用户的计数都和发出的请求数一致")
+
+
+if __name__ == "__main__":
+    main()